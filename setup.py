@@ -138,6 +138,7 @@ setup(name = NAME,
                  'bin/feat-couchpy',
                  'bin/feat-dbload',
                  'bin/feat-locate',
+                 'bin/feat-replay',
                  'bin/feat-service'],
       package_data = {'feat': ['agencies/messaging/amqp0-8.xml',
                                'gateway/static/default.css']},
@@ -411,6 +411,18 @@ class AgencyAgent(log.LogProxy, log.Logger, manhole.Manhole,
     def delete_document(self, document):
         return self._database.delete_document(document)
 
+    @serialization.freeze_tag('AgencyAgency.save_documents')
+    def save_documents(self, documents):
+        return self._database.save_documents(documents)
+
+    @serialization.freeze_tag('AgencyAgency.get_documents')
+    def get_documents(self, document_ids):
+        return self._database.get_documents(document_ids)
+
+    @serialization.freeze_tag('AgencyAgency.delete_documents')
+    def delete_documents(self, documents):
+        return self._database.delete_documents(documents)
+
     @serialization.freeze_tag('AgencyAgent.register_change_listener')
     @replay.named_side_effect('AgencyAgent.register_change_listener')
     def register_change_listener(self, filter_, callback, **kwargs):
@@ -21,6 +21,7 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import copy
 import uuid
 import urllib
 
@@ -32,10 +33,16 @@ from feat.common.serialization import json
 from feat.agents.base import document
 
 from feat.agencies.interface import (IDatabaseClient, IDatabaseDriver,
-                                     IRevisionStore)
+                                     IRevisionStore, DatabaseError,
+                                     ConflictError, NotFoundError)
 from feat.interface.generic import ITimeProvider
 from feat.interface.view import IViewFactory, DESIGN_DOC_ID
 
+# Maximum number of documents kept by the document cache, 0 disables it
+DEFAULT_CACHE_SIZE = 0
+# Number of rows of a view fetched at once by the cursors
+DEFAULT_PAGE_SIZE = 100
+
 
 class ViewFilter(object):
 
@@ -47,9 +54,11 @@ class ViewFilter(object):
         self._listeners = dict()
 
     def match(self, doc):
-        # used only by emu
         return self.view.filter(doc, self._request)
 
+    def has_listeners(self):
+        return bool(self._listeners)
+
     def add_listener(self, callback, listener_id):
         self._listeners[listener_id] = callback
 
@@ -77,10 +86,6 @@ class DocIdFilter(object):
         # doc_ids -> [(callback, listener_id)]
         self._listeners = {}
 
-    def match(self, doc):
-        # used only by emu
-        return doc['_id'] in self._listeners.keys()
-
     def notified(self, doc_id, rev, deleted):
         listeners = self._listeners.get(doc_id, list())
         for cb, _ in listeners:
@@ -115,16 +120,159 @@ class DocIdFilter(object):
         return dict()
 
 
+class CacheFilter(object):
+    '''
+    Cache of the unserialized documents shared by the connections of the
+    agency. Only the documents of the types setting the cached flag are
+    kept. The cache listens to the changes of the database like the
+    other filters, a change to an other revision than the one kept drops
+    the document. Copies of the documents are kept and given, so the
+    callers can modify them.
+
+    When the cache is full the least recently used documents are dropped.
+    The documents are kept in two generations of at most half of the size
+    each. A document read from the old generation moves to the new one,
+    the old generation is dropped when the new one is full.
+
+    The change of a document can be notified while a request reading or
+    saving it is in flight, before its result is given to the cache. The
+    requests are told to the cache, a document they give is not kept if
+    an other revision has been notified meanwhile.
+    '''
+
+    def __init__(self, size):
+        self.name = 'cache'
+        self.size = size
+        # doc_id -> Document
+        self._new = dict()
+        self._old = dict()
+        # doc_id -> [number of requests in flight, (rev, deleted) notified]
+        self._requests = dict()
+
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._evictions = 0
+
+    def get(self, doc_id):
+        '''Gives a copy of the cached document or None.'''
+        if not self.size:
+            return None
+        doc = self._new.get(doc_id)
+        if doc is None:
+            doc = self._old.pop(doc_id, None)
+            if doc is None:
+                self._misses += 1
+                return None
+            self._store(doc)
+        self._hits += 1
+        return copy.deepcopy(doc)
+
+    def put(self, doc):
+        '''Keeps a copy of the document if its type is cached.'''
+        if self.size and doc.cached:
+            self._old.pop(doc.doc_id, None)
+            self._store(copy.deepcopy(doc))
+        return doc
+
+    def request_started(self, doc_id):
+        '''Tells a request reading or saving the document is sent.'''
+        if self.size and doc_id is not None:
+            pending = self._requests.setdefault(doc_id, [0, None])
+            pending[0] += 1
+
+    def request_finished(self, doc_id, doc=None):
+        '''
+        Tells the request is finished, giving the document read or saved.
+        The document is not kept if an other revision has been notified.
+        '''
+        if not self.size:
+            return doc
+        pending = self._requests.get(doc_id)
+        notified = None
+        if pending is not None:
+            pending[0] -= 1
+            notified = pending[1]
+            if not pending[0]:
+                del self._requests[doc_id]
+        if doc is None:
+            return doc
+        if notified is not None:
+            rev, deleted = notified
+            if deleted or rev != doc.rev:
+                self._invalidations += 1
+                return doc
+        return self.put(doc)
+
+    def remove(self, doc_id):
+        found = self._new.pop(doc_id, None) or self._old.pop(doc_id, None)
+        return found is not None
+
+    def clear(self):
+        self._new.clear()
+        self._old.clear()
+        # the changes of the documents in flight might be missed
+        for pending in self._requests.itervalues():
+            pending[1] = (None, True)
+
+    def get_stats(self):
+        return [('cache documents', len(self)),
+                ('cache hits', self._hits),
+                ('cache misses', self._misses),
+                ('cache invalidations', self._invalidations),
+                ('cache evictions', self._evictions)]
+
+    def __contains__(self, doc_id):
+        return doc_id in self._new or doc_id in self._old
+
+    def __len__(self):
+        return len(self._new) + len(self._old)
+
+    ### filter interface ###
+
+    def notified(self, doc_id, rev, deleted):
+        pending = self._requests.get(doc_id)
+        if pending is not None:
+            pending[1] = (rev, deleted)
+        doc = self._new.get(doc_id) or self._old.get(doc_id)
+        if doc is not None and (deleted or doc.rev != rev):
+            self.remove(doc_id)
+            self._invalidations += 1
+
+    def cancel_listener(self, listener_id):
+        # the cache is not listening on behalf of anyone
+        return False
+
+    def extract_params(self):
+        if not self.size:
+            # returning None prevents channel for being established
+            return
+        # the documents are cached after the channel is established,
+        # their ids are not known yet
+        return dict()
+
+    ### private ###
+
+    def _store(self, doc):
+        self._new[doc.doc_id] = doc
+        if len(self._new) >= max(self.size // 2, 1):
+            self._evictions += len(self._old)
+            self._old = self._new
+            self._new = dict()
+
+
 class ChangeListener(log.Logger):
     '''
     Base class for .net.database.Database and emu.database.Database.
     '''
 
-    def __init__(self, logger):
+    def __init__(self, logger, cache_size=None):
         log.Logger.__init__(self, logger)
+        self.cache = CacheFilter(cache_size or DEFAULT_CACHE_SIZE)
         # name -> Filter
         self._filters = dict()
         self._filters['doc_ids'] = DocIdFilter()
+        self._filters['cache'] = self.cache
 
     def listen_changes(self, filter_, callback, kwargs=dict()):
         assert callable(callback), ("Callback should be callable, got %r" %
@@ -159,8 +307,33 @@ class ChangeListener(log.Logger):
                 defers.append(self._setup_notifier(filter_i))
         return defer.DeferredList(defers, consumeErrors=True)
 
+    def notify_change(self, doc_id, rev, deleted, doc=None):
+        '''
+        Tells the filters about a change of the database. The filters of
+        document ids are looked up by id, the view filters with listeners
+        are matched against the document when it is given.
+        '''
+        # the cached document is dropped before the listeners are told
+        self.cache.notified(doc_id, rev, deleted)
+        self._filters['doc_ids'].notified(doc_id, rev, deleted)
+        if doc is None:
+            return
+        for filter_i in self._filters.values():
+            if (isinstance(filter_i, ViewFilter) and filter_i.has_listeners()
+                and filter_i.match(doc)):
+                filter_i.notified(doc_id, rev, deleted)
+
     ### protected
 
+    def _is_listening(self):
+        return any(filter_i.extract_params() is not None
+                   for filter_i in self._filters.itervalues())
+
+    def _needs_documents(self):
+        return any(isinstance(filter_i, ViewFilter) and
+                   filter_i.has_listeners()
+                   for filter_i in self._filters.itervalues())
+
     def _setup_notifier(self, filter_):
         # to be overriden in the child classes
         return defer.succeed(None)
@@ -175,8 +348,6 @@ class Connection(log.Logger, log.LogProxy):
         log.Logger.__init__(self, database)
         log.LogProxy.__init__(self, database)
         self._database = IDatabaseDriver(database)
-        self._serializer = json.Serializer()
-        self._unserializer = json.PaisleyUnserializer()
 
         # listner_id -> doc_ids
         self._listeners = dict()
@@ -206,25 +377,63 @@ class Connection(log.Logger, log.LogProxy):
         return self._database.create_db()
 
     def save_document(self, doc):
-        serialized = self._serializer.convert(doc)
+        serialized = json.serializer_pool.convert(doc)
+        self._database.cache.request_started(doc.doc_id)
         d = self._database.save_doc(serialized, doc.doc_id)
         d.addCallback(self._update_id_and_rev, doc)
+        d.addBoth(self._cache_document, doc.doc_id)
         return d
 
     def get_document(self, doc_id):
-        d = self._database.open_doc(doc_id)
-        d.addCallback(self._unserializer.convert)
-        d.addCallback(self._notice_doc_revision)
-        return d
+        doc = self._database.cache.get(doc_id)
+        if doc is not None:
+            return defer.succeed(self._notice_doc_revision(doc))
+        return self._fetch_document(doc_id)
 
     def reload_document(self, doc):
         assert isinstance(doc, document.Document)
-        return self.get_document(doc.doc_id)
+        # always asks the database, the cache might not be notified yet
+        return self._fetch_document(doc.doc_id)
 
     def delete_document(self, doc):
         assert isinstance(doc, document.Document)
         d = self._database.delete_doc(doc.doc_id, doc.rev)
         d.addCallback(self._update_id_and_rev, doc)
+        d.addCallback(self._forget_document)
+        return d
+
+    def save_documents(self, docs):
+        serialized = [json.serializer_pool.convert(doc) for doc in docs]
+        doc_ids = [doc.doc_id for doc in docs]
+        for doc_id in doc_ids:
+            self._database.cache.request_started(doc_id)
+        d = self._database.save_docs(serialized, doc_ids)
+        d.addCallback(self._update_ids_and_revs, docs)
+        d.addBoth(self._cache_documents, doc_ids)
+        return d
+
+    def get_documents(self, doc_ids):
+        cached = [self._database.cache.get(doc_id) for doc_id in doc_ids]
+        missing = [doc_id for doc_id, doc in zip(doc_ids, cached)
+                   if doc is None]
+        if not missing:
+            return defer.succeed([self._notice_doc_revision(doc)
+                                  for doc in cached])
+        for doc_id in missing:
+            self._database.cache.request_started(doc_id)
+        d = self._database.open_docs(missing)
+        d.addCallback(self._unserialize_documents, missing)
+        d.addBoth(self._cache_documents, missing)
+        d.addCallback(self._merge_documents, cached)
+        return d
+
+    def delete_documents(self, docs):
+        for doc in docs:
+            assert isinstance(doc, document.Document)
+        d = self._database.delete_docs([(doc.doc_id, doc.rev)
+                                        for doc in docs])
+        d.addCallback(self._update_ids_and_revs, docs)
+        d.addCallback(self._for_documents, self._forget_document)
         return d
 
     def changes_listener(self, filter_, callback, **kwargs):
@@ -250,6 +459,9 @@ class Connection(log.Logger, log.LogProxy):
         d.addCallback(self._parse_view_results, factory, options)
         return d
 
+    def iter_view(self, factory, page_size=None, **options):
+        return ViewCursor(self._database, factory, page_size, options)
+
     def disconnect(self):
         for l_id in self._listeners.keys():
             self._cancel_listener(l_id)
@@ -272,12 +484,66 @@ class Connection(log.Logger, log.LogProxy):
         reduced = factory.use_reduce and options.get('reduce', True)
         return map(lambda row: factory.parse(row[0], row[1], reduced), rows)
 
+    def _fetch_document(self, doc_id):
+        self._database.cache.request_started(doc_id)
+        d = self._database.open_doc(doc_id)
+        d.addCallback(json.paisley_unserializer_pool.convert)
+        d.addCallback(self._notice_doc_revision)
+        d.addBoth(self._cache_document, doc_id)
+        return d
+
+    def _cache_document(self, result, doc_id):
+        # errors are given in place of the documents
+        doc = result if isinstance(result, document.Document) else None
+        self._database.cache.request_finished(doc_id, doc)
+        return result
+
+    def _cache_documents(self, results, doc_ids):
+        if not isinstance(results, list):
+            # the whole request failed
+            for doc_id in doc_ids:
+                self._database.cache.request_finished(doc_id)
+            return results
+        for result, doc_id in zip(results, doc_ids):
+            self._cache_document(result, doc_id)
+        return results
+
     def _update_id_and_rev(self, resp, doc):
         doc.doc_id = unicode(resp.get('id', None))
         doc.rev = unicode(resp.get('rev', None))
         self._notice_doc_revision(doc)
         return doc
 
+    def _forget_document(self, doc):
+        self._database.cache.remove(doc.doc_id)
+        return doc
+
+    def _for_documents(self, results, method):
+        # the errors of the bulk requests are given in place of the documents
+        return [result if isinstance(result, Exception) else method(result)
+                for result in results]
+
+    def _merge_documents(self, fetched, cached):
+        fetched = iter(fetched)
+        return [next(fetched) if doc is None
+                else self._notice_doc_revision(doc)
+                for doc in cached]
+
+    def _update_ids_and_revs(self, results, docs):
+        return [_bulk_error(resp) if 'error' in resp
+                else self._update_id_and_rev(resp, doc)
+                for resp, doc in zip(results, docs)]
+
+    def _unserialize_documents(self, docs, doc_ids):
+        result = []
+        for doc, doc_id in zip(docs, doc_ids):
+            if doc is None:
+                result.append(NotFoundError("missing %s" % (doc_id, )))
+                continue
+            doc = json.paisley_unserializer_pool.convert(doc)
+            result.append(self._notice_doc_revision(doc))
+        return result
+
     def _notice_doc_revision(self, doc):
         self.log('Storing knowledge about doc rev. ID: %r, REV: %r',
                  doc.doc_id, doc.rev)
@@ -285,6 +551,15 @@ class Connection(log.Logger, log.LogProxy):
         return doc
 
 
+def _bulk_error(resp):
+    reason = "%s: %s" % (resp.get('id'), resp.get('reason', resp['error']))
+    if resp['error'] == 'conflict':
+        return ConflictError(reason)
+    if resp['error'] == 'not_found':
+        return NotFoundError(reason)
+    return DatabaseError(reason)
+
+
 def _parse_doc_revision(rev):
     rev_index, rev_hash = rev.split("-", 1)
     return int(rev_index), rev_hash
@@ -322,3 +597,57 @@ class RevisionAnalytic(log.Logger):
                 own_change = True
 
         self._callback(doc_id, rev, deleted, own_change)
+
+
+class ViewCursor(object):
+    '''
+    Pages through the rows of a view without fetching all of them at once.
+    Every page is queried from the key and document id of the row
+    following the last one of the previous page, one row more than the
+    page size is asked for to know it. The rows are parsed as they are
+    received, they are never reduced.
+    '''
+
+    def __init__(self, database, factory, page_size=None, options=dict()):
+        self._database = IDatabaseDriver(database)
+        self._factory = IViewFactory(factory)
+        self._options = dict(options)
+        if self._factory.use_reduce:
+            self._options['reduce'] = False
+        self.page_size = page_size or DEFAULT_PAGE_SIZE
+        self.finished = False
+
+    def next_page(self):
+        '''
+        Fetches the next page of the view. The next page should only be
+        asked for once the previous one is received.
+        @return: Deferred fired with the list of the parsed rows, empty
+                 when all of them have been received.
+        '''
+        if self.finished:
+            return defer.succeed([])
+        rows = []
+        next_row = []
+
+        def row_received(key, value, doc_id):
+            if len(rows) < self.page_size:
+                rows.append(self._factory.parse(key, value, False))
+            else:
+                next_row.append((key, doc_id))
+
+        options = dict(self._options, limit=self.page_size + 1)
+        d = self._database.query_view_rows(self._factory, row_received,
+                                           **options)
+        d.addCallback(defer.drop_param, self._page_received, next_row)
+        d.addCallback(defer.override_result, rows)
+        return d
+
+    ### private ###
+
+    def _page_received(self, next_row):
+        if not next_row:
+            self.finished = True
+            return
+        key, doc_id = next_row[0]
+        self._options['startkey'] = key
+        self._options['startkey_docid'] = doc_id
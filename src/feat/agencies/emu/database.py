@@ -49,10 +49,10 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
     log_category = "emu-database"
 
-    def __init__(self):
+    def __init__(self, cache_size=None):
         common.ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, log.FluLogKeeper())
-        ChangeListener.__init__(self, self)
+        ChangeListener.__init__(self, self, cache_size)
         common.Statistics.__init__(self)
 
         # id -> document
@@ -66,6 +66,9 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         # simulations
         self._doc_type_counters = dict()
 
+    def get_stats(self):
+        return common.Statistics.get_stats(self) + self.cache.get_stats()
+
     ### IDbConnectionFactory
 
     def get_connection(self):
@@ -81,29 +84,29 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         d = defer.Deferred()
 
         try:
-            if not isinstance(doc, (str, unicode, )):
-                raise ValueError('Doc should be either str or unicode')
-            doc = json.loads(doc)
-            doc = self._set_id_and_revision(doc, doc_id)
-
+            r = self._save_doc(doc, doc_id)
             self.increase_stat('save_doc')
-
-            self._documents[doc['_id']] = doc
-            self._expire_cache(doc['_id'])
-
-            r = Response(ok=True, id=doc['_id'], rev=doc['_rev'])
-            self._analize_changes(doc)
             d.callback(r)
         except (ConflictError, ValueError, ) as e:
             d.errback(e)
 
         return d
 
+    def save_docs(self, docs, doc_ids):
+        '''Imitate sending the documents to _bulk_docs of CouchDB'''
+        self.increase_stat('save_docs')
+        results = []
+        for doc, doc_id in zip(docs, doc_ids):
+            try:
+                resp = self._save_doc(doc, doc_id)
+                results.append(dict(id=resp['id'], rev=resp['rev']))
+            except ConflictError as e:
+                results.append(_bulk_error(doc_id, 'conflict', e))
+        return defer.succeed(results)
+
     def _analize_changes(self, doc):
-        for filter_i in self._filters.itervalues():
-            if filter_i.match(doc):
-                deleted = doc.get('_deleted', False)
-                filter_i.notified(doc['_id'], doc['_rev'], deleted)
+        deleted = doc.get('_deleted', False)
+        self.notify_change(doc['_id'], doc['_rev'], deleted, doc)
 
     def open_doc(self, doc_id):
         '''Imitated fetching the document from the database.
@@ -113,16 +116,23 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         d = defer.Deferred()
         self.increase_stat('open_doc')
         try:
-            doc = self._get_doc(doc_id)
-            doc = copy.deepcopy(doc)
-            if doc.get('_deleted', None):
-                raise NotFoundError('deleted')
-            d.callback(Response(doc))
+            d.callback(self._open_doc(doc_id))
         except NotFoundError as e:
             d.errback(e)
 
         return d
 
+    def open_docs(self, doc_ids):
+        '''Imitates fetching the documents from _all_docs of CouchDB'''
+        self.increase_stat('open_docs')
+        results = []
+        for doc_id in doc_ids:
+            try:
+                results.append(self._open_doc(doc_id))
+            except NotFoundError:
+                results.append(None)
+        return defer.succeed(results)
+
     def delete_doc(self, doc_id, revision):
         '''Imitates sending DELETE request to CouchDB server'''
         d = defer.Deferred()
@@ -130,22 +140,26 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         self.increase_stat('delete_doc')
 
         try:
-            doc = self._get_doc(doc_id)
-            if doc['_rev'] != revision:
-                raise ConflictError("Document update conflict.")
-            if doc.get('_deleted', None):
-                raise NotFoundError('deleted')
-            doc['_rev'] = self._generate_rev(doc)
-            doc['_deleted'] = True
-            self._expire_cache(doc['_id'])
-            self.log('Marking document %r as deleted', doc_id)
-            self._analize_changes(doc)
-            d.callback(Response(ok=True, id=doc_id, rev=doc['_rev']))
+            d.callback(self._delete_doc(doc_id, revision))
         except (ConflictError, NotFoundError, ) as e:
             d.errback(e)
 
         return d
 
+    def delete_docs(self, docs):
+        '''Imitates deleting the documents through _bulk_docs of CouchDB'''
+        self.increase_stat('delete_docs')
+        results = []
+        for doc_id, revision in docs:
+            try:
+                resp = self._delete_doc(doc_id, revision)
+                results.append(dict(id=resp['id'], rev=resp['rev']))
+            except ConflictError as e:
+                results.append(_bulk_error(doc_id, 'conflict', e))
+            except NotFoundError as e:
+                results.append(_bulk_error(doc_id, 'not_found', e))
+        return defer.succeed(results)
+
     def query_view(self, factory, **options):
         factory = IViewFactory(factory)
         use_reduce = factory.use_reduce and options.get('reduce', True)
@@ -157,8 +171,78 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             d.addCallback(self._perform_reduce, factory)
         return d
 
+    def query_view_rows(self, factory, callback, **options):
+        factory = IViewFactory(factory)
+        if factory.use_reduce and options.get('reduce', True):
+            d = self.query_view(factory, **options)
+            d.addCallback(self._pass_rows, callback)
+            return d
+        rows = [(key, value, doc['_id'])
+                for doc in self._iterdocs()
+                for key, value in self._perform_map(doc, factory)
+                if self._matches_filter((key, value), **options)]
+        rows.sort(key=lambda row: (row[0], row[2]))
+        rows = self._page_rows(rows, **options)
+        d = defer.succeed(rows)
+        d.addCallback(self._pass_rows, callback)
+        return d
+
     ### private
 
+    def _page_rows(self, rows, startkey=None, startkey_docid=None,
+                   limit=None, **_):
+        '''
+        Imitates the paging of the view result. The keys are compared
+        the python way, not following the collation of CouchDB.
+        '''
+        if startkey is not None:
+            if startkey_docid is None:
+                rows = [row for row in rows if row[0] >= startkey]
+            else:
+                rows = [row for row in rows
+                        if (row[0], row[2]) >= (startkey, startkey_docid)]
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+    def _pass_rows(self, rows, callback):
+        for row in rows:
+            key, value = row[:2]
+            callback(key, value, row[2] if len(row) > 2 else None)
+
+    def _save_doc(self, doc, doc_id):
+        if not isinstance(doc, (str, unicode, )):
+            raise ValueError('Doc should be either str or unicode')
+        doc = json.loads(doc)
+        doc = self._set_id_and_revision(doc, doc_id)
+
+        self._documents[doc['_id']] = doc
+        self._expire_cache(doc['_id'])
+
+        r = Response(ok=True, id=doc['_id'], rev=doc['_rev'])
+        self._analize_changes(doc)
+        return r
+
+    def _open_doc(self, doc_id):
+        doc = self._get_doc(doc_id)
+        doc = copy.deepcopy(doc)
+        if doc.get('_deleted', None):
+            raise NotFoundError('deleted')
+        return Response(doc)
+
+    def _delete_doc(self, doc_id, revision):
+        doc = self._get_doc(doc_id)
+        if doc['_rev'] != revision:
+            raise ConflictError("Document update conflict.")
+        if doc.get('_deleted', None):
+            raise NotFoundError('deleted')
+        doc['_rev'] = self._generate_rev(doc)
+        doc['_deleted'] = True
+        self._expire_cache(doc['_id'])
+        self.log('Marking document %r as deleted', doc_id)
+        self._analize_changes(doc)
+        return Response(ok=True, id=doc_id, rev=doc['_rev'])
+
     def _matches_filter(self, tup, **filter_options):
         # We only support filtering by key at the moment
         if 'key' in filter_options:
@@ -269,3 +353,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 class Response(dict):
 
     pass
+
+
+def _bulk_error(doc_id, error, exception):
+    return dict(id=doc_id, error=error, reason=str(exception))
@@ -282,6 +282,43 @@ class IDatabaseClient(Interface):
         @returns: Deferred called with the updated document (latest revision).
         '''
 
+    def save_documents(documents):
+        '''
+        Save the documents into the database with a single request.
+        Unlike save_document() a conflict does not fail the whole call,
+        the other documents are still saved.
+
+        @param documents: Documents to be saved.
+        @type documents: list of L{feat.agents.document.Document}
+        @returns: Deferred called with the list of the updated Documents,
+                  in the same order, with a ConflictError instance in place
+                  of the documents which could not be saved.
+        '''
+
+    def get_documents(document_ids):
+        '''
+        Download the documents from the database with a single request
+        and instantiate them.
+
+        @param document_ids: The ids of the documents in the database.
+        @returns: Deferred called with the list of the documents, in the
+                  same order, with a NotFoundError instance in place of
+                  the documents which are missing or deleted.
+        '''
+
+    def delete_documents(documents):
+        '''
+        Marks the documents in the database as deleted with a single
+        request.
+
+        @param documents: Documents to be deleted.
+        @type documents: list of L{feat.agents.document.Document}
+        @returns: Deferred called with the list of the updated documents,
+                  in the same order, with a ConflictError or NotFoundError
+                  instance in place of the documents which could not be
+                  deleted.
+        '''
+
     def changes_listener(doc_ids, callback):
         '''
         Register a callback called when the document is changed.
@@ -301,6 +338,19 @@ class IDatabaseClient(Interface):
         @return: C{list} of results.
         '''
 
+    def iter_view(factory, page_size=None, **options):
+        '''
+        Creates a cursor paging through the rows of the view, for the
+        views too big to be fetched at once. The rows are not reduced.
+        @param factory: View factory to query.
+        @type factory: L{feat.interface.view.IViewFactory}
+        @param page_size: Number of rows of each page.
+        @param options: Dictionary of parameters to pass to the query.
+        @return: L{feat.agencies.database.ViewCursor}, its next_page()
+                 method gives a Deferred fired with the list of results
+                 of the next page, empty once all of them are read.
+        '''
+
     def disconnect():
         '''
         Disconnect from database server.
@@ -317,6 +367,9 @@ class IDatabaseDriver(Interface):
     Interface implemeneted by the database driver.
     '''
 
+    cache = Attribute("CacheFilter with the documents shared by the "
+                      "connections.")
+
     def create_db():
         '''
         Request creating the database.
@@ -346,6 +399,35 @@ class IDatabaseDriver(Interface):
                  ConflictError
         '''
 
+    def save_docs(docs, doc_ids):
+        '''
+        Create new or update existing documents in a single request.
+        @param docs: list of strings with json documents
+        @param doc_ids: list of the ids of the documents, None for the new
+                        documents without id
+        @return: Deferred fired with the list of the results in the order
+                 of the documents, dict(id, rev) for the saved ones and
+                 dict(id, error, reason) for the others
+        '''
+
+    def open_docs(doc_ids):
+        '''
+        Fetch the documents from database in a single request.
+        @param doc_ids: list of the ids of the documents to fetch
+        @return: Deferred fired with the list of the json parsed documents
+                 in the order of the ids, None for the missing or deleted
+                 ones.
+        '''
+
+    def delete_docs(docs):
+        '''
+        Mark documents as deleted in a single request.
+        @param docs: list of tuples (doc_id, revision)
+        @return: Deferred fired with the list of the results in the order
+                 of the documents, dict(id, rev) for the deleted ones and
+                 dict(id, error, reason) for the others
+        '''
+
     def listen_changes(doc_ids, callback):
         '''
         Register callback called when one of the documents get changed.
@@ -368,6 +450,17 @@ class IDatabaseDriver(Interface):
         Query the view. See L{IDatabaseClient.query_view}.
         '''
 
+    def query_view_rows(factory, callback, **options):
+        '''
+        Query the view passing the rows to the callback as they are
+        received, without keeping them. Supports the startkey,
+        startkey_docid and limit options used by the cursors.
+        @param callback: callable called with the key, the value and
+                         the document id (None for reduced rows) of
+                         each row, in the order of the view
+        @return: Deferred fired when all the rows have been passed
+        '''
+
 
 class IJournaler(Interface):
     """
@@ -422,6 +515,12 @@ class IJournaler(Interface):
         Returns bool saying if there are pending entries to get flushed.
         """
 
+    def get_stats():
+        """
+        Returns a list of (name, value) pairs with the statistics of
+        the entries cache and flushing.
+        """
+
 
 class IRecord(Interface):
     '''
@@ -443,6 +542,8 @@ class IRecord(Interface):
         result             - serialized result of the call
         side_effects       - serialized list of side effects produced
                              by the call
+        Serialized values can also be given as journaler.FlattenedValue,
+        the journaler finishes their serialization before writing them.
         '''
 
 
@@ -498,6 +599,12 @@ class IJournalWriter(Interface):
         Returns bool saying if there are pending entries to get flushed.
         """
 
+    def get_stats():
+        """
+        Returns a list of (name, value) pairs with the statistics of
+        the entries cache and flushing.
+        """
+
 
 class IRevisionStore(Interface):
     '''
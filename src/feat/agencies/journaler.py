@@ -21,12 +21,20 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
-import sqlite3
+import itertools
+import marshal
+import mmap
 import operator
+import os
+import sqlite3
+import struct
+import tempfile
 import types
+import urllib
 
 from zope.interface import implements
 from twisted.enterprise import adbapi
+from twisted.internet import threads
 from twisted.spread import pb
 
 from twisted.python import log as twisted_log
@@ -45,6 +53,46 @@ from feat.agencies.interface import (IJournaler, IJournalWriter, IRecord,
                                      IJournalerConnection)
 
 
+# Maximum number of entries written by SqliteWriter in one transaction
+DEFAULT_FLUSH_SIZE = 1000
+# Seconds SqliteWriter waits for more entries before flushing
+DEFAULT_FLUSH_INTERVAL = 0
+DEFAULT_JOURNAL_MODE = 'wal'
+DEFAULT_SYNCHRONOUS = 'normal'
+# Number of entries kept in memory before spilling them to disk
+DEFAULT_HIGH_WATER_MARK = 10000
+
+INSERT_ENTRY_SQL = "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+INSERT_LOG_SQL = "INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+# layout of the records in the files of SegmentWriter
+RECORD_LENGTH = struct.Struct('!I')
+FIELD_LENGTH = struct.Struct('!I')
+# length of the fields and value of the header integers written for None
+NULL_LENGTH = 0xFFFFFFFF
+NULL_INTEGER = -2 ** 31
+# fiber_depth, timestamp
+ENTRY_HEADER = struct.Struct('!iq')
+# level, line_num, timestamp
+LOG_HEADER = struct.Struct('!iiq')
+# history_id, instance_id
+HISTORY_HEADER = struct.Struct('!II')
+# offset, length, timestamp
+INDEX_RECORD = struct.Struct('!QIq')
+# position of the snapshot entry in the index
+SNAPSHOT_RECORD = struct.Struct('!Q')
+
+# Number of entries read at once by the cursors
+DEFAULT_PAGE_SIZE = 1000
+
+
+class FlushCancelled(Exception):
+    '''
+    Raised to the entries waiting for the delayed flush of a writer
+    closed without flushing. They were not written.
+    '''
+
+
 class State(enum.Enum):
     '''
     disconnected - there is no connection to database
@@ -56,26 +104,54 @@ class State(enum.Enum):
 class EntriesCache(object):
     '''
     Helper class storing the data and giving the back in transactional way.
+
+    If a high-water mark is specified, only that many entries are kept
+    in memory, the overflow is appended to a temporary file. Spilled
+    entries are loaded back in order when the memory is freed by commit().
     '''
 
-    def __init__(self):
+    def __init__(self, high_water_mark=None, spill_dir=None,
+                 prepare_spill=None):
+        '''
+        @param high_water_mark: Maximum number of entries kept in memory,
+                                None means no limit.
+        @param spill_dir: Directory for the spill file,
+                          defaults to the system temporary directory.
+        @param prepare_spill: Optional callable converting an entry to a
+                              dictionary of plain values before spilling.
+        '''
         self._cache = list()
         self._fetched = None
 
+        self._high_water_mark = high_water_mark
+        self._spill_dir = spill_dir
+        self._prepare_spill = prepare_spill
+        self._spill_file = None
+        self._spilled = 0
+        self._spill_read = 0
+        self._spill_write = 0
+
     def append(self, entry):
-        self._cache.append(entry)
+        if self._spilled or self._is_full():
+            self._spill(entry)
+        else:
+            self._cache.append(entry)
 
-    def fetch(self):
+    def fetch(self, limit=None):
         '''
         Gives all the data it has stored, and remembers what it has given.
         Later we need to call commit() to actually remove the data from the
         cache.
+        @param limit: Maximum number of entries to give, None means all.
         '''
         if self._fetched is not None:
             raise RuntimeError('fetch() was called but the previous one has '
                                'not yet been applied. Not supported')
+        self._unspill()
         if self._cache:
             self._fetched = len(self._cache)
+            if limit is not None:
+                self._fetched = min(self._fetched, limit)
         return self._cache[0:self._fetched]
 
     def commit(self):
@@ -86,6 +162,7 @@ class EntriesCache(object):
             raise RuntimeError('commit() was called but nothing was fetched')
         self._cache = self._cache[self._fetched:]
         self._fetched = None
+        self._unspill()
 
     def rollback(self):
         if self._fetched is None:
@@ -98,8 +175,44 @@ class EntriesCache(object):
         '''
         return self._fetched is not None
 
+    def get_stats(self):
+        return [('cache depth', len(self)),
+                ('cache spilled entries', self._spilled),
+                ('cache spill bytes', self._spill_write - self._spill_read)]
+
     def __len__(self):
-        return len(self._cache)
+        return len(self._cache) + self._spilled
+
+    ### private ###
+
+    def _is_full(self):
+        return (self._high_water_mark is not None
+                and len(self._cache) >= self._high_water_mark)
+
+    def _spill(self, entry):
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(
+                prefix='feat_journal_', suffix='.spill', dir=self._spill_dir)
+        if self._prepare_spill is not None:
+            entry = self._prepare_spill(entry)
+        self._spill_file.seek(self._spill_write)
+        marshal.dump(entry, self._spill_file)
+        self._spill_write = self._spill_file.tell()
+        self._spilled += 1
+
+    def _unspill(self):
+        if not self._spilled or self._is_full():
+            return
+        self._spill_file.seek(self._spill_read)
+        while self._spilled and not self._is_full():
+            self._cache.append(marshal.load(self._spill_file))
+            self._spilled -= 1
+        self._spill_read = self._spill_file.tell()
+        if not self._spilled:
+            # everything is back in memory, reclaim the disk space
+            self._spill_file.truncate(0)
+            self._spill_read = 0
+            self._spill_write = 0
 
 
 @decorator.parametrized_function
@@ -125,14 +238,22 @@ class Journaler(log.Logger, common.StateMachineMixin):
     # FIXME: at some point switch to False and remove this attribute
     should_keep_on_logging_to_flulog = True
 
-    def __init__(self, logger):
+    def __init__(self, logger, high_water_mark=DEFAULT_HIGH_WATER_MARK,
+                 spill_dir=None):
         log.Logger.__init__(self, self)
 
         common.StateMachineMixin.__init__(self, State.disconnected)
         self._writer = None
         self._flush_task = None
-        self._cache = EntriesCache()
+        self._flush_started = None
+        self._flush_latency = None
+        self._cache = EntriesCache(high_water_mark, spill_dir,
+                                   prepare_spill=self._pack_entry)
         self._notifier = defer.Notifier()
+        # only used from the packing thread, one flush at a time
+        self._codec = banana.BananaCodec()
+        # used to pack the entries spilled from the reactor thread
+        self._spill_codec = banana.BananaCodec()
 
     def configure_with(self, writer):
         self._ensure_state(State.disconnected)
@@ -192,6 +313,14 @@ class Journaler(log.Logger, common.StateMachineMixin):
             return self._writer.is_idle()
         return True
 
+    def get_stats(self):
+        stats = self._cache.get_stats()
+        stats.append(('flush latency', self._flush_latency))
+        if self._writer:
+            stats.extend([('writer ' + k, v)
+                          for k, v in self._writer.get_stats()])
+        return stats
+
     ### ILogObserver provider ###
 
     def on_twisted_log(self, event_dict):
@@ -250,16 +379,54 @@ class Journaler(log.Logger, common.StateMachineMixin):
     def _flush(self):
         entries = self._cache.fetch()
         if entries:
-            d = self._writer.insert_entries(entries)
+            self._flush_started = time.time()
+            d = self._pack_entries(entries)
+            d.addCallback(self._writer.insert_entries)
             d.addCallbacks(defer.drop_param, self._flush_error,
                            callbackArgs=(self._flush_complete, ))
             return d
         else:
             self._flush_complete()
 
+    def _pack_entries(self, entries):
+        '''
+        Finishes the serialization of the values flattened by the
+        journal entries in a thread. Entries are updated in place,
+        so the order in which they were committed is not affected.
+        '''
+        pending = [entry for entry in entries
+                   if any(isinstance(v, FlattenedValue)
+                          for v in entry.itervalues())]
+        if not pending:
+            return defer.succeed(entries)
+        d = threads.deferToThread(self._do_pack_entries, pending)
+        d.addCallback(defer.override_result, entries)
+        return d
+
+    def _do_pack_entries(self, entries):
+        '''
+        BEWARE: This method runs in a thread.
+        '''
+        for entry in entries:
+            for key, value in entry.items():
+                if isinstance(value, FlattenedValue):
+                    entry[key] = self._codec.encode(value.pack())
+
+    def _pack_entry(self, entry):
+        '''
+        Packs an entry before the cache spills it to disk.
+        '''
+        for key, value in entry.items():
+            if isinstance(value, FlattenedValue):
+                entry[key] = self._spill_codec.encode(value.pack())
+        return entry
+
     def _flush_complete(self):
         if self._cache.is_locked():
             self._cache.commit()
+        if self._flush_started is not None:
+            self._flush_latency = time.time() - self._flush_started
+            self._flush_started = None
         self._flush_task = None
         self._notifier.callback('flush', None)
         if len(self._cache) > 0:
@@ -267,6 +434,12 @@ class Journaler(log.Logger, common.StateMachineMixin):
 
     def _flush_error(self, fail):
         self._cache.rollback()
+        self._flush_task = None
+        if fail.check(FlushCancelled):
+            # the entries are written by the next writer
+            self.debug("Flush cancelled, %d entries kept",
+                       len(self._cache))
+            return
         fail.raiseException()
 
     def _close_writer(self, flush_writer=True):
@@ -282,25 +455,30 @@ class BrokerProxyWriter(log.Logger, common.StateMachineMixin):
 
     _error_handler = error_handler
 
-    def __init__(self, broker):
+    def __init__(self, broker, high_water_mark=DEFAULT_HIGH_WATER_MARK,
+                 spill_dir=None):
         '''
-        @param encoding: Optional encoding to be used for blob fields.
-        @type encoding: Should be a valid parameter for str.encode() method.
-        @param filename: File to use for entries. Defaults to :memory:
-        @param logger: ILogger to use
+        @param broker: Broker used to get the reference to master's writer.
+        @param high_water_mark: Number of entries kept in memory while
+                                the master is not reachable, the overflow
+                                is spilled to disk.
+        @param spill_dir: Directory used for spilling entries.
         '''
         log.Logger.__init__(self, broker)
         common.StateMachineMixin.__init__(self, State.disconnected)
 
         self._broker = broker
         self._set_writer(None)
-        self._cache = EntriesCache()
+        self._cache = EntriesCache(high_water_mark, spill_dir)
         self._semaphore = defer.DeferredSemaphore(1)
+        self._flush_latency = None
 
     def initiate(self):
         d = self._broker.get_journal_writer()
         d.addCallback(self._set_writer)
         d.addCallback(defer.drop_param, self._set_state, State.connected)
+        # push what was cached while disconnected
+        d.addCallback(defer.drop_param, self._flush_next)
         return d
 
     def close(self, flush=True):
@@ -333,6 +511,11 @@ class BrokerProxyWriter(log.Logger, common.StateMachineMixin):
             return False
         return True
 
+    def get_stats(self):
+        stats = self._cache.get_stats()
+        stats.append(('flush latency', self._flush_latency))
+        return stats
+
     ### private ###
 
     @in_state(State.connected)
@@ -348,7 +531,10 @@ class BrokerProxyWriter(log.Logger, common.StateMachineMixin):
         entries = self._cache.fetch()
         if entries:
             try:
+                started = time.time()
                 d = self._writer.callRemote('insert_entries', entries)
+                d.addCallback(defer.bridge_param,
+                              self._update_latency, started)
                 d.addCallbacks(defer.drop_param, defer.drop_param,
                                callbackArgs=(self._cache.commit, ),
                                errbackArgs=(self._cache.rollback, ))
@@ -358,6 +544,9 @@ class BrokerProxyWriter(log.Logger, common.StateMachineMixin):
                 # instead of giving failed Deferred
                 self._cache.rollback()
 
+    def _update_latency(self, started):
+        self._flush_latency = time.time() - started
+
     def _set_writer(self, writer):
         self._writer = writer
         if isinstance(self._writer, pb.RemoteReference):
@@ -375,12 +564,31 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
     _error_handler = error_handler
 
     def __init__(self, logger, filename=":memory:", encoding=None,
-                 on_rotate=None):
+                 on_rotate=None, flush_size=DEFAULT_FLUSH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 journal_mode=DEFAULT_JOURNAL_MODE,
+                 synchronous=DEFAULT_SYNCHRONOUS, page_size=None,
+                 high_water_mark=DEFAULT_HIGH_WATER_MARK, spill_dir=None):
         '''
         @param encoding: Optional encoding to be used for blob fields.
         @type encoding: Should be a valid parameter for str.encode() method.
         @param filename: File to use for entries. Defaults to :memory:
         @param logger: ILogger to use
+        @param flush_size: Maximum number of entries inserted in a single
+                           transaction, None means no limit.
+        @param flush_interval: Seconds to wait for more entries before
+                               flushing, unless flush_size entries are
+                               already waiting. 0 flushes immediately.
+        @param journal_mode: Value for sqlite journal_mode pragma,
+                             None keeps the sqlite default.
+        @param synchronous: Value for sqlite synchronous pragma,
+                            None keeps the sqlite default.
+        @param page_size: Page size in bytes, only applies to newly
+                          created databases.
+        @param high_water_mark: Number of entries waiting for being written
+                                kept in memory, the overflow is spilled
+                                to disk. None means no limit.
+        @param spill_dir: Directory used for spilling entries.
         '''
         log.Logger.__init__(self, logger)
         log.LogProxy.__init__(self, logger)
@@ -390,11 +598,25 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
         self._db = None
         self._filename = filename
         self._reset_history_id_cache()
-        self._cache = EntriesCache()
+        self._cache = EntriesCache(high_water_mark, spill_dir)
         # the semaphore is used to always have at most running
         # .perform_instert() method
         self._semaphore = defer.DeferredSemaphore(1)
 
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._flush_call = None
+        self._flush_latency = None
+        self._notifier = defer.Notifier()
+
+        self._pragmas = []
+        if page_size is not None:
+            self._pragmas.append(('page_size', int(page_size)))
+        if journal_mode is not None and filename != ':memory:':
+            self._pragmas.append(('journal_mode', journal_mode))
+        if synchronous is not None:
+            self._pragmas.append(('synchronous', synchronous))
+
         self._sighup_installed = False
 
         self._on_rotate_cb = on_rotate
@@ -402,6 +624,7 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
     def initiate(self):
         self._db = adbapi.ConnectionPool('sqlite3', self._filename,
                                          cp_min=1, cp_max=1, cp_noisy=True,
+                                         cp_openfun=self._setup_connection,
                                          check_same_thread=False,
                                          timeout=10)
         self._install_sighup()
@@ -413,8 +636,12 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
         d = defer.succeed(None)
         if self._cmp_state(State.disconnected):
             return d
+        self._cancel_delayed_flush()
         if flush:
             d.addCallback(defer.drop_param, self._flush_next)
+        else:
+            self._notifier.errback('flushed', FlushCancelled(
+                "Writer closed without flushing"))
         d.addCallback(defer.drop_param, self._db.close)
         d.addCallback(defer.drop_param, self._uninstall_sighup)
         d.addCallback(defer.drop_param, self._set_state,
@@ -569,8 +796,21 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
     def insert_entries(self, entries):
         for data in entries:
             self._cache.append(data)
+        if self._flush_interval and not self._is_batch_ready():
+            return self._delay_flush()
         return self._flush_next()
 
+    def get_cursor(self, history, page_size=DEFAULT_PAGE_SIZE,
+                   from_snapshot=False):
+        '''
+        Returns the SqliteCursor over the entries of the history.
+        BEWARE: The cursor uses its own connection, the reads are blocking.
+        '''
+        if self._filename == ':memory:':
+            raise ValueError("Cursors cannot read the in-memory journal")
+        return SqliteCursor(self._filename, history, page_size,
+                            from_snapshot)
+
     @manhole.expose()
     def get_filename(self):
         return self._filename
@@ -580,6 +820,12 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
             return False
         return True
 
+    @manhole.expose()
+    def get_stats(self):
+        stats = self._cache.get_stats()
+        stats.append(('flush latency', self._flush_latency))
+        return stats
+
     ### Private ###
 
     def _add_timestamp_condition_sql(self, query, start_date, end_date):
@@ -595,10 +841,14 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
 
     def _sighup_handler(self, signum, frame):
         self.log("Received SIGHUP, reopening the journal.")
-        self.close()
-        self.initiate()
+        # the old connection has to be closed before opening the new one,
+        # otherwise the write-ahead log of the rotated file could be picked
+        # up by the new database
+        d = self.close()
+        d.addCallback(defer.drop_param, self.initiate)
         if callable(self._on_rotate_cb):
-            self._on_rotate_cb()
+            d.addCallback(defer.drop_param, self._on_rotate_cb)
+        d.addErrback(self._error_handler)
 
     def _install_sighup(self):
         if self._sighup_installed:
@@ -626,17 +876,7 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
         Returns rows in readable format.
         '''
 
-        def decode_blobs(row):
-            row = list(row)
-            for index, value in zip(range(len(row)), row):
-                if isinstance(value, types.BufferType):
-                    value = str(value)
-                    if self._encoding:
-                        value = value.decode(self._encoding)
-                    row[index] = value
-            return row
-
-        return map(decode_blobs, entries)
+        return [decode_row(row, self._encoding) for row in entries]
 
     def _encode(self, data):
         result = dict()
@@ -672,6 +912,15 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
 
         return result
 
+    def _setup_connection(self, connection):
+        '''
+        Applies the configured pragmas to the freshly opened connection.
+
+        BEWARE: This method runs in a thread.
+        '''
+        for name, value in self._pragmas:
+            connection.execute("PRAGMA %s = %s" % (name, value))
+
     def _check_schema(self):
         d = self._db.runQuery(
             'SELECT value FROM metadata WHERE name = "encoding"')
@@ -763,47 +1012,43 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
 
     def _perform_inserts(self, cache):
 
-        def do_insert_entry(connection, history_id, data):
-            command = text_helper.format_block("""
-            INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """)
-            connection.execute(
-                command, (history_id,
-                          data['journal_id'], data['function_id'],
-                          data['fiber_id'], data['fiber_depth'],
-                          data['args'], data['kwargs'],
-                          data['side_effects'], data['result'],
-                          data['timestamp']))
-
-        def do_insert_log(connection, data):
-            command = text_helper.format_block("""
-            INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?, ?)
-            """)
-            connection.execute(
-                command, (data['message'], int(data['level']),
-                          data['category'], data['log_name'],
-                          data['file_path'], data['line_num'],
-                          data['timestamp']))
-
-        def transaction(connection, cache):
-            entries = cache.fetch()
-            if not entries:
-                return
-            try:
-                entries = map(self._encode, entries)
-                for data in entries:
-                    if data['entry_type'] == 'journal':
-                        history_id = self._get_history_id(
-                            connection, data['agent_id'], data['instance_id'])
-                        do_insert_entry(connection, history_id, data)
-                    elif data['entry_type'] == 'log':
-                        do_insert_log(connection, data)
-                cache.commit()
-            except Exception:
-                cache.rollback()
-                raise
-
-        return self._db.runWithConnection(transaction, cache)
+        def transaction(connection, entries):
+            # rows of both tables are inserted in bulk, the order
+            # of the rows inside each of the tables is preserved
+            entry_rows = []
+            log_rows = []
+            for data in map(self._encode, entries):
+                if data['entry_type'] == 'journal':
+                    history_id = self._get_history_id(
+                        connection, data['agent_id'], data['instance_id'])
+                    entry_rows.append(
+                        (history_id,
+                         data['journal_id'], data['function_id'],
+                         data['fiber_id'], data['fiber_depth'],
+                         data['args'], data['kwargs'],
+                         data['side_effects'], data['result'],
+                         data['timestamp']))
+                elif data['entry_type'] == 'log':
+                    log_rows.append(
+                        (data['message'], int(data['level']),
+                         data['category'], data['log_name'],
+                         data['file_path'], data['line_num'],
+                         data['timestamp']))
+            if entry_rows:
+                connection.executemany(INSERT_ENTRY_SQL, entry_rows)
+            if log_rows:
+                connection.executemany(INSERT_LOG_SQL, log_rows)
+
+        # the cache is only used from the reactor thread, its spill file
+        # is written by the entries inserted meanwhile
+        entries = cache.fetch(self._flush_size)
+        if not entries:
+            return defer.succeed(None)
+        d = self._db.runWithConnection(transaction, entries)
+        d.addCallbacks(defer.drop_param, defer.bridge_param,
+                       callbackArgs=(cache.commit, ),
+                       errbackArgs=(cache.rollback, ))
+        return d
 
     def _get_history_id(self, connection, agent_id, instance_id):
         '''
@@ -835,15 +1080,814 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
                 self._history_id_cache[cache_key] = history_id
                 return history_id
 
+    def _is_batch_ready(self):
+        return (self._flush_size is not None
+                and len(self._cache) >= self._flush_size)
+
+    def _delay_flush(self):
+        if self._flush_call is None:
+            self._flush_call = time.call_later(self._flush_interval,
+                                               self._delayed_flush)
+        return self._notifier.wait('flushed')
+
+    def _delayed_flush(self):
+        self._flush_call = None
+        d = self._flush_next()
+        d.addErrback(self._delayed_flush_failed)
+
+    def _delayed_flush_failed(self, fail):
+        self._notifier.errback('flushed', fail)
+        self._error_handler(fail)
+
+    def _cancel_delayed_flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+
+    @in_state(State.connected)
+    def _flush_next(self):
+        if len(self._cache) == 0:
+            self._cancel_delayed_flush()
+            self._notifier.callback('flushed', None)
+            return defer.succeed(None)
+        else:
+            d = self._semaphore.run(self._timed_inserts)
+            d.addCallback(defer.drop_param, self._flush_next)
+            return d
+
+    def _timed_inserts(self):
+        started = time.time()
+        d = self._perform_inserts(self._cache)
+        d.addCallback(defer.bridge_param, self._update_latency, started)
+        return d
+
+    def _update_latency(self, started):
+        self._flush_latency = time.time() - started
+
+
+class SegmentWriter(log.Logger, log.LogProxy, common.StateMachineMixin,
+                    manhole.Manhole):
+    '''
+    Journal writer keeping the entries of each history in its own
+    append-only segment file.
+
+    The directory contains:
+     - metadata: the encoding used for the blob fields,
+     - histories: length-prefixed (history_id, instance_id, agent_id)
+       records,
+     - <history_id>.seg: length-prefixed journal entries of the history,
+     - <history_id>.idx: fixed size (offset, length, timestamp) records
+       of the entries in the segment file,
+     - logs.seg: length-prefixed log entries.
+
+    Reading the history of an agent doesn't need to touch the entries of
+    the other agents, the segment file is mapped in memory and read
+    sequentially.
+    '''
+    implements(IJournalWriter)
+
+    _error_handler = error_handler
+
+    def __init__(self, logger, dirname, encoding=None,
+                 flush_size=DEFAULT_FLUSH_SIZE,
+                 high_water_mark=DEFAULT_HIGH_WATER_MARK, spill_dir=None):
+        '''
+        @param dirname: Directory to keep the segment files in,
+                        it is created if it doesn't exist.
+        @param encoding: Optional encoding to be used for blob fields.
+        @type encoding: Should be a valid parameter for str.encode() method.
+        @param flush_size: Maximum number of entries written at once,
+                           None means no limit.
+        @param high_water_mark: Number of entries waiting for being written
+                                kept in memory, the overflow is spilled
+                                to disk. None means no limit.
+        @param spill_dir: Directory used for spilling entries.
+        '''
+        log.Logger.__init__(self, logger)
+        log.LogProxy.__init__(self, logger)
+        common.StateMachineMixin.__init__(self, State.disconnected)
+
+        self._dirname = dirname
+        self._encoding = encoding
+        self._flush_size = flush_size
+        self._flush_latency = None
+        self._cache = EntriesCache(high_water_mark, spill_dir)
+        # writes are done in a thread, at most one at a time
+        self._semaphore = defer.DeferredSemaphore(1)
+        # (agent_id, instance_id, ) -> History
+        self._histories = dict()
+
+    def initiate(self):
+        d = threads.deferToThread(self._load)
+        d.addCallback(defer.drop_param, self._initiated_ok)
+        return d
+
+    ### IJournalWriter ###
+
+    def close(self, flush=True):
+        d = defer.succeed(None)
+        if self._cmp_state(State.disconnected):
+            return d
+        if flush:
+            d.addCallback(defer.drop_param, self._flush_next)
+        d.addCallback(defer.drop_param, self._set_state,
+                      State.disconnected)
+        return d
+
+    @manhole.expose()
+    @in_state(State.connected)
+    def get_histories(self):
+        return sorted(self._histories.values(),
+                      key=operator.attrgetter('history_id'))
+
+    @manhole.expose()
+    @in_state(State.connected)
+    def get_entries(self, history, start_date=0, limit=None):
+        '''
+        Returns a list of journal entries  for the given history_id.
+        '''
+        if not isinstance(history, History):
+            raise AttributeError(
+                'First paremeter is expected to be History instance, got %r'
+                % history)
+        return threads.deferToThread(self._read_entries, history,
+                                     start_date, limit)
+
+    @in_state(State.connected)
+    def get_log_entries(self, start_date=None, end_date=None, filters=list()):
+        '''
+        @param start_date: epoch time to start search
+        @param end_date: epoch time to end search
+        @param filters: list of dictionaries with the following keys:
+                        level - mandatory, display entries with lvl <= level
+                        category - optional, limit to log_category
+                        name - optional, limit to log_name
+                        Leaving optional fields blank will match all the
+                        entries. The entries in this list are combined with
+                        OR operator.
+        '''
+        for spec in filters:
+            if spec.get('level', None) is None:
+                raise AttributeError("level is mandatory parameter.")
+
+        def matches(row):
+            if not filters:
+                return True
+            for spec in filters:
+                if row[1] > int(spec['level']):
+                    continue
+                if spec.get('category', None) not in (None, row[2]):
+                    continue
+                if spec.get('name', None) not in (None, row[3]):
+                    continue
+                return True
+            return False
+
+        d = threads.deferToThread(self._read_logs, start_date, end_date)
+        d.addCallback(lambda rows: filter(matches, rows))
+        return d
+
+    @in_state(State.connected)
+    def get_log_categories(self, start_date=None, end_date=None):
+        '''
+        @param start_date: epoch time to start search
+        @param end_date: epoch time to end search
+        '''
+        d = threads.deferToThread(self._read_logs, start_date, end_date)
+        d.addCallback(self._distinct, 2)
+        return d
+
+    def get_log_names(self, category, start_date=None, end_date=None):
+        '''
+        Fetches log names for the given category.
+        @param start_date: epoch time to start search
+        @param end_date: epoch time to end search
+        '''
+        d = threads.deferToThread(self._read_logs, start_date, end_date)
+        d.addCallback(lambda rows: [row for row in rows
+                                    if row[2] == category])
+        d.addCallback(self._distinct, 3)
+        return d
+
+    def get_log_time_boundaries(self):
+        '''
+        @returns: a tuple of log entry timestaps (first, last) or None
+        '''
+
+        def unpack(rows):
+            if rows:
+                timestamps = [row[6] for row in rows]
+                return min(timestamps), max(timestamps)
+
+        d = threads.deferToThread(self._read_logs)
+        d.addCallback(unpack)
+        return d
+
+    @manhole.expose()
+    def insert_entries(self, entries):
+        for data in entries:
+            self._cache.append(data)
+        return self._flush_next()
+
+    def get_cursor(self, history, page_size=DEFAULT_PAGE_SIZE,
+                   from_snapshot=False):
+        '''
+        Returns the SegmentCursor over the entries of the history.
+        BEWARE: The reads done by the cursor are blocking.
+        '''
+        return SegmentCursor(self._dirname, history, page_size,
+                             from_snapshot)
+
+    @manhole.expose()
+    def get_filename(self):
+        return self._dirname
+
+    def is_idle(self):
+        if len(self._cache) > 0:
+            return False
+        return True
+
+    @manhole.expose()
+    def get_stats(self):
+        stats = self._cache.get_stats()
+        stats.append(('flush latency', self._flush_latency))
+        return stats
+
+    ### Private ###
+
+    def _initiated_ok(self):
+        self.log('Journaler initiated correctly for the directory %r',
+                 self._dirname)
+        self._set_state(State.connected)
+        return self._flush_next()
+
+    def _path(self, name):
+        return os.path.join(self._dirname, name)
+
+    def _load(self):
+        '''
+        Reads the metadata and the histories of the existing directory.
+
+        BEWARE: This method runs in a thread.
+        '''
+        if not os.path.isdir(self._dirname):
+            os.makedirs(self._dirname)
+
+        metadata = self._path('metadata')
+        if os.path.exists(metadata):
+            encoding = read_segment_encoding(self._dirname)
+            if self._encoding is not None and encoding != self._encoding:
+                self.warning("Journaler created with encoding %r but the one "
+                             "loaded from existing directory is %r. Using "
+                             "the value of: %r",
+                             self._encoding, encoding, encoding)
+            self._encoding = encoding
+        else:
+            with open(metadata, 'wb') as f:
+                f.write(self._encoding or '')
+
+        self._histories.clear()
+        for history in read_histories(self._dirname):
+            key = (history.agent_id, history.instance_id)
+            self._histories[key] = history
+
+    def _perform_inserts(self, cache):
+        # the cache is only used from the reactor thread, its spill file
+        # is written by the entries inserted meanwhile
+        entries = cache.fetch(self._flush_size)
+        if not entries:
+            return defer.succeed(None)
+        d = threads.deferToThread(self._write_entries, entries)
+        d.addCallbacks(defer.drop_param, defer.bridge_param,
+                       callbackArgs=(cache.commit, ),
+                       errbackArgs=(cache.rollback, ))
+        return d
+
+    def _write_entries(self, entries):
+        '''
+        Appends the entries to the segment files, the rows in each of the
+        files keep the order in which they came.
+
+        BEWARE: This method runs in a thread.
+        '''
+        segments = dict()
+        logs = []
+        for data in entries:
+            if data['entry_type'] == 'journal':
+                history = self._get_history(data['agent_id'],
+                                            data['instance_id'])
+                # like SqliteWriter, the missing texts are stored empty
+                record = pack_record(
+                    ENTRY_HEADER.pack(encode_integer(data['fiber_depth']),
+                                      int(data['timestamp'])),
+                    self._encode(data['journal_id']),
+                    (data['function_id'] or '').encode('utf-8'),
+                    (data['fiber_id'] or '').encode('utf-8'),
+                    self._encode(data['args']),
+                    self._encode(data['kwargs']),
+                    self._encode(data['side_effects']),
+                    self._encode(data['result']))
+                segments.setdefault(history.history_id, []).append(
+                    (record, int(data['timestamp']),
+                     data['function_id'] == 'snapshot'))
+            elif data['entry_type'] == 'log':
+                header = LOG_HEADER.pack(int(data['level']),
+                                         encode_integer(data['line_num']),
+                                         int(data['timestamp']))
+                logs.append(pack_record(
+                    header,
+                    self._encode(data['message']),
+                    encode_text(data['category']),
+                    encode_text(data['log_name']),
+                    (data['file_path'] or '').encode('utf-8')))
+            else:
+                raise RuntimeError('Unknown entry type %r'
+                                   % data['entry_type'])
+
+        for history_id, records in segments.iteritems():
+            # the index is written after the segment, readers never
+            # see the offset of a record which is not complete
+            index_path = self._path('%d.idx' % (history_id, ))
+            position = 0
+            if os.path.exists(index_path):
+                position = os.path.getsize(index_path) // INDEX_RECORD.size
+            index = []
+            snapshots = []
+            with open(self._path('%d.seg' % (history_id, )), 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                for record, timestamp, is_snapshot in records:
+                    f.write(record)
+                    if is_snapshot:
+                        snapshots.append(SNAPSHOT_RECORD.pack(position))
+                    index.append(INDEX_RECORD.pack(offset, len(record),
+                                                   timestamp))
+                    offset += len(record)
+                    position += 1
+            with open(index_path, 'ab') as f:
+                f.write(''.join(index))
+            if snapshots:
+                with open(self._path('%d.snp' % (history_id, )), 'ab') as f:
+                    f.write(''.join(snapshots))
+
+        if logs:
+            with open(self._path('logs.seg'), 'ab') as f:
+                f.write(''.join(logs))
+
+    def _get_history(self, agent_id, instance_id):
+        '''
+        BEWARE: This method runs in a thread.
+        '''
+        key = (agent_id, instance_id)
+        history = self._histories.get(key)
+        if history is None:
+            history = History(history_id=len(self._histories) + 1,
+                              agent_id=agent_id, instance_id=instance_id)
+            with open(self._path('histories'), 'ab') as f:
+                f.write(pack_record(
+                    HISTORY_HEADER.pack(history.history_id, instance_id),
+                    agent_id.encode('utf-8')))
+            self._histories[key] = history
+        return history
+
+    def _read_entries(self, history, start_date=0, limit=None):
+        '''
+        BEWARE: This method runs in a thread.
+        '''
+        cursor = self.get_cursor(history)
+        try:
+            rows = (row for row in cursor if row[10] >= start_date)
+            return list(itertools.islice(rows, limit or None))
+        finally:
+            cursor.close()
+
+    def _read_logs(self, start_date=None, end_date=None):
+        '''
+        BEWARE: This method runs in a thread.
+        '''
+        rows = []
+        for level, line_num, timestamp, message, category, log_name, \
+                file_path in iter_records(self._path('logs.seg'),
+                                          LOG_HEADER, 4):
+            if start_date is not None and timestamp < int(start_date):
+                continue
+            if end_date is not None and timestamp > int(end_date):
+                continue
+            rows.append([decode_blob(message, self._encoding), level,
+                         decode_text(category), decode_text(log_name),
+                         decode_text(file_path), decode_integer(line_num),
+                         timestamp])
+        return rows
+
+    def _encode(self, value):
+        if value is not None and self._encoding:
+            value = value.encode(self._encoding)
+        return value
+
+    def _distinct(self, rows, column):
+        result = []
+        for row in rows:
+            if row[column] not in result:
+                result.append(row[column])
+        return result
+
     @in_state(State.connected)
     def _flush_next(self):
         if len(self._cache) == 0:
             return defer.succeed(None)
         else:
-            d = self._semaphore.run(self._perform_inserts, self._cache)
+            d = self._semaphore.run(self._timed_inserts)
             d.addCallback(defer.drop_param, self._flush_next)
             return d
 
+    def _timed_inserts(self):
+        started = time.time()
+        d = self._perform_inserts(self._cache)
+        d.addCallback(defer.bridge_param, self._update_latency, started)
+        return d
+
+    def _update_latency(self, started):
+        self._flush_latency = time.time() - started
+
+
+class SqliteCursor(object):
+    '''
+    Iterates over the journal entries of the history stored in the sqlite
+    file. The entries are read in pages of page_size rows, so the memory
+    used doesn't depend on the length of the history. The entries written
+    after the cursor has been created are not included.
+
+    BEWARE: The reads are blocking, the cursor is meant to be used by
+    the offline tools or from a thread.
+    '''
+
+    def __init__(self, filename, history, page_size=DEFAULT_PAGE_SIZE,
+                 from_snapshot=False):
+        '''
+        @param from_snapshot: Start from the latest snapshot of the agent
+                              instead of from the first entry.
+        '''
+        self.position = 0
+
+        self._history = history
+        self._page_size = page_size
+        self._page = list()
+        self._connection = connect_read_only(filename)
+        self._encoding = self._query_one(
+            'SELECT value FROM metadata WHERE name = "encoding"')
+        if self._encoding == 'None':
+            self._encoding = None
+
+        self._last_rowid = 0
+        if from_snapshot:
+            snapshot = self._query_one(
+                "SELECT max(rowid) FROM entries WHERE history_id = ? "
+                "AND function_id = 'snapshot'", history.history_id)
+            if snapshot is not None:
+                self._last_rowid = snapshot - 1
+        self._end_rowid = self._query_one(
+            "SELECT max(rowid) FROM entries WHERE history_id = ?",
+            history.history_id) or 0
+        self._total = self._query_one(
+            "SELECT count(*) FROM entries WHERE history_id = ? "
+            "AND rowid > ? AND rowid <= ?",
+            history.history_id, self._last_rowid, self._end_rowid)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return self._total
+
+    def next(self):
+        if not self._page:
+            self._read_page()
+        if not self._page:
+            self.close()
+            raise StopIteration()
+        self.position += 1
+        return self._page.pop()
+
+    ### private ###
+
+    def _query_one(self, query, *args):
+        res = self._connection.execute(query, args).fetchone()
+        return res[0] if res else None
+
+    def _read_page(self):
+        if self._connection is None or self.position >= self._total:
+            return
+        command = text_helper.format_block("""
+        SELECT rowid,
+               journal_id,
+               function_id,
+               fiber_id,
+               fiber_depth,
+               args,
+               kwargs,
+               side_effects,
+               result,
+               timestamp
+          FROM entries
+          WHERE history_id = ? AND rowid > ? AND rowid <= ?
+          ORDER BY rowid ASC
+          LIMIT ?""")
+        rows = self._connection.execute(
+            command, (self._history.history_id, self._last_rowid,
+                      self._end_rowid, self._page_size)).fetchall()
+        if rows:
+            self._last_rowid = rows[-1][0]
+        # the page is consumed from the end
+        self._page = [decode_row((self._history.agent_id,
+                                  self._history.instance_id) + row[1:],
+                                 self._encoding)
+                      for row in reversed(rows)]
+
+
+class SegmentCursor(object):
+    '''
+    Iterates over the journal entries of the history stored in the
+    directory of SegmentWriter. The index is read in pages of page_size
+    records and the entries are read from the segment file mapped
+    in memory. The entries written after the cursor has been created
+    are not included.
+
+    BEWARE: The reads are blocking, the cursor is meant to be used by
+    the offline tools or from a thread.
+    '''
+
+    def __init__(self, dirname, history, page_size=DEFAULT_PAGE_SIZE,
+                 from_snapshot=False):
+        '''
+        @param from_snapshot: Start from the latest snapshot of the agent
+                              instead of from the first entry.
+        '''
+        self.position = 0
+
+        self._history = history
+        self._encoding = read_segment_encoding(dirname)
+        self._page_size = page_size
+        self._page = list()
+        self._segment = None
+        self._segment_path = os.path.join(
+            dirname, '%d.seg' % (history.history_id, ))
+        self._index_path = os.path.join(
+            dirname, '%d.idx' % (history.history_id, ))
+
+        self._next = 0
+        self._end = 0
+        if os.path.exists(self._index_path):
+            self._end = (os.path.getsize(self._index_path)
+                         // INDEX_RECORD.size)
+        snapshots_path = os.path.join(
+            dirname, '%d.snp' % (history.history_id, ))
+        if from_snapshot and os.path.exists(snapshots_path):
+            with open(snapshots_path, 'rb') as f:
+                f.seek(-SNAPSHOT_RECORD.size, os.SEEK_END)
+                self._next, = SNAPSHOT_RECORD.unpack(f.read())
+        self._total = self._end - self._next
+
+    def close(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+        self._next = self._end
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return self._total
+
+    def next(self):
+        if not self._page:
+            self._read_page()
+        if not self._page:
+            self.close()
+            raise StopIteration()
+        self.position += 1
+        return self._page.pop()
+
+    ### private ###
+
+    def _read_page(self):
+        count = min(self._page_size, self._end - self._next)
+        if count <= 0:
+            return
+        with open(self._index_path, 'rb') as f:
+            f.seek(self._next * INDEX_RECORD.size)
+            index = f.read(count * INDEX_RECORD.size)
+        self._next += count
+
+        if self._segment is None:
+            with open(self._segment_path, 'rb') as f:
+                self._segment = mmap.mmap(f.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+        page = []
+        for pos in xrange(0, len(index), INDEX_RECORD.size):
+            offset, _length, _timestamp = INDEX_RECORD.unpack_from(index, pos)
+            fiber_depth, timestamp, fields = unpack_record(
+                self._segment, offset, ENTRY_HEADER, 7)
+            (journal_id, function_id, fiber_id, args, kwargs,
+             side_effects, result) = fields
+            page.append([self._history.agent_id, self._history.instance_id,
+                         decode_blob(journal_id, self._encoding),
+                         decode_text(function_id), decode_text(fiber_id),
+                         decode_integer(fiber_depth),
+                         decode_blob(args, self._encoding),
+                         decode_blob(kwargs, self._encoding),
+                         decode_blob(side_effects, self._encoding),
+                         decode_blob(result, self._encoding), timestamp])
+        # the page is consumed from the end
+        page.reverse()
+        self._page = page
+
+
+def read_histories(filename):
+    '''
+    Returns the list of histories of the sqlite journal file or
+    the directory of SegmentWriter.
+    BEWARE: The reads are blocking.
+    '''
+    if os.path.isdir(filename):
+        return [History(history_id=history_id,
+                        agent_id=agent_id.decode('utf-8'),
+                        instance_id=instance_id)
+                for history_id, instance_id, agent_id in iter_records(
+                    os.path.join(filename, 'histories'), HISTORY_HEADER, 1)]
+    connection = connect_read_only(filename)
+    try:
+        rows = connection.execute(
+            "SELECT id, agent_id, instance_id FROM histories").fetchall()
+        return History._parse_resp(rows)
+    finally:
+        connection.close()
+
+
+def connect_read_only(filename):
+    '''
+    Opens the sqlite journal file without write access. The python 2
+    sqlite3 module cannot ask for URI filenames, so the file is opened
+    with a read-only URI only when sqlite is built to accept them.
+    Otherwise it is opened for writing and the query_only pragma
+    forbids the changes.
+    '''
+    if _sqlite_uri_enabled():
+        uri = "file:%s?mode=ro" % (urllib.quote(os.path.abspath(filename)), )
+        return sqlite3.connect(uri)
+    connection = sqlite3.connect(filename)
+    connection.execute('PRAGMA query_only = 1')
+    return connection
+
+
+def open_cursor(filename, history, page_size=DEFAULT_PAGE_SIZE,
+                from_snapshot=False):
+    '''
+    Returns the cursor over the entries of the history stored in the
+    sqlite journal file or the directory of SegmentWriter.
+    '''
+    if os.path.isdir(filename):
+        return SegmentCursor(filename, history, page_size, from_snapshot)
+    return SqliteCursor(filename, history, page_size, from_snapshot)
+
+
+def _sqlite_uri_enabled():
+    # without it the URI would be taken as the name of a new file
+    connection = sqlite3.connect(':memory:')
+    try:
+        options = connection.execute('PRAGMA compile_options').fetchall()
+    finally:
+        connection.close()
+    return ('USE_URI', ) in options
+
+
+def read_segment_encoding(dirname):
+    with open(os.path.join(dirname, 'metadata'), 'rb') as f:
+        return f.read().strip() or None
+
+
+def iter_records(filename, header, num_fields):
+    '''
+    Iterates over the records of SegmentWriter file giving the values
+    of the header followed by the fields.
+    '''
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + RECORD_LENGTH.size <= len(data):
+        length, = RECORD_LENGTH.unpack_from(data, offset)
+        if offset + length > len(data):
+            # the record being written right now
+            break
+        values = unpack_record(data, offset, header, num_fields)
+        yield values[:-1] + tuple(values[-1])
+        offset += length
+
+
+def pack_record(header, *fields):
+    '''
+    Builds the length-prefixed record of SegmentWriter files.
+    '''
+    parts = [header]
+    for field in fields:
+        if field is None:
+            parts.append(FIELD_LENGTH.pack(NULL_LENGTH))
+            continue
+        parts.append(FIELD_LENGTH.pack(len(field)))
+        parts.append(field)
+    body = ''.join(parts)
+    return RECORD_LENGTH.pack(RECORD_LENGTH.size + len(body)) + body
+
+
+def unpack_record(data, offset, header, num_fields):
+    '''
+    Returns the values of the header followed by the list of fields
+    of the record starting at the offset, None for the fields written
+    for None.
+    '''
+    offset += RECORD_LENGTH.size
+    values = header.unpack_from(data, offset)
+    offset += header.size
+    fields = []
+    for _ in xrange(num_fields):
+        length, = FIELD_LENGTH.unpack_from(data, offset)
+        offset += FIELD_LENGTH.size
+        if length == NULL_LENGTH:
+            fields.append(None)
+            continue
+        fields.append(data[offset:offset + length])
+        offset += length
+    return values + (fields, )
+
+
+def encode_integer(value):
+    if value is None:
+        return NULL_INTEGER
+    return value
+
+
+def decode_integer(value):
+    if value == NULL_INTEGER:
+        return None
+    return value
+
+
+def encode_text(value):
+    if value is None:
+        return None
+    return value.encode('utf-8')
+
+
+def decode_text(value):
+    if value is None:
+        return None
+    return value.decode('utf-8')
+
+
+def decode_blob(value, encoding):
+    if value is None:
+        return None
+    value = str(value)
+    if encoding:
+        value = value.decode(encoding)
+    return value
+
+
+def decode_row(row, encoding):
+    '''
+    Takes the row returned by sqlite.
+    Returns row in readable format.
+    '''
+    row = list(row)
+    for index, value in enumerate(row):
+        if isinstance(value, types.BufferType):
+            row[index] = decode_blob(value, encoding)
+    return row
+
+
+class FlattenedValue(object):
+    '''
+    Value flattened by the serializer on the reactor thread,
+    the journaler finishes its serialization in a thread.
+    '''
+
+    __slots__ = ('serializer', 'flattened')
+
+    def __init__(self, serializer, value, freezing=False):
+        self.serializer = serializer
+        self.flattened = serializer.flatten(value, freezing=freezing)
+
+    def pack(self):
+        return self.serializer.pack_value(self.flattened)
+
 
 class Record(object):
     implements(IRecord)
@@ -1001,14 +2045,16 @@ class AgencyJournalEntry(object):
 
     def commit(self):
         try:
-            self._data['args'] = self._serializer.convert(
-                    self._not_serialized['args'])
-            self._data['kwargs'] = self._serializer.convert(
-                    self._not_serialized['kwargs'])
-            self._data['result'] = self._serializer.freeze(
-                    self._not_serialized['result'])
-            self._data['side_effects'] = self._serializer.convert(
-                    self._data['side_effects'])
+            # Only flatten the values, the journaler packs them later
+            self._data['args'] = FlattenedValue(
+                self._serializer, self._not_serialized['args'])
+            self._data['kwargs'] = FlattenedValue(
+                self._serializer, self._not_serialized['kwargs'])
+            self._data['result'] = FlattenedValue(
+                self._serializer, self._not_serialized['result'],
+                freezing=True)
+            self._data['side_effects'] = FlattenedValue(
+                self._serializer, self._data['side_effects'])
             self._record.commit(**self._data)
             self._record = None
             return self
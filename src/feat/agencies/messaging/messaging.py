@@ -29,11 +29,11 @@ class Channel(log.Logger):
         # list of IRecipients we are receiving messages for
         self._bindings = []
 
-        # traversal_id -> True
-        self._traversal_ids = container.ExpDict(self)
+        # traversal_ids already seen
+        self._traversal_ids = container.ExpSet(self)
 
-        # message_id -> True
-        self._message_ids = container.ExpDict(self)
+        # message_ids already received
+        self._message_ids = container.ExpSet(self)
 
     def initiate(self):
         return defer.succeed(self)
@@ -53,11 +53,13 @@ class Channel(log.Logger):
             if message.reply_to is None:
                 message.reply_to = self._get_own_address()
 
+        # the recipients get envelopes sharing a single copy of the message
+        # so that its fields are serialized only once for all of them
+        body = message.clone()
+        body._templates = None
         for recip in recipients:
             self.log('Sending message to %r', recip)
-            msg = message.clone()
-            msg.recipient = recip
-            self._messaging.dispatch(msg)
+            self._messaging.dispatch(body.envelope(recip))
 
     def release(self):
         for binding in self._bindings:
@@ -123,7 +125,7 @@ class Channel(log.Logger):
                      msg.get_msg_class())
             return False
         else:
-            self._message_ids.set(msg.message_id, True, msg.expiration_time)
+            self._message_ids.add(msg.message_id, msg.expiration_time)
 
         # Check for known traversal ids:
         if IFirstMessage.providedBy(msg):
@@ -142,7 +144,7 @@ class Channel(log.Logger):
                     self.post(recp, resp)
                 return False
             else:
-                self._traversal_ids.set(t_id, True, msg.expiration_time)
+                self._traversal_ids.add(t_id, msg.expiration_time)
 
         # Handle registered dialog
         if IDialogMessage.providedBy(msg):
@@ -253,6 +255,7 @@ class Messaging(log.Logger, log.LogProxy, common.ConnectionManager):
             return
         backend = self._backends.pop(backend_id)
         self.routing.remove_sink(backend)
+        return backend.disconnect()
 
     def get_backend(self, backend_id):
         back = self._backends.get(backend_id)
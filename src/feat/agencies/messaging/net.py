@@ -19,6 +19,7 @@
 # See "LICENSE.GPL" in the source distribution for more information.
 
 # Headers in this file shall remain intact.
+import collections
 import operator
 import os
 import warnings
@@ -40,6 +41,20 @@ from feat.agents.base.message import BaseMessage
 from feat.agencies.messaging.interface import IMessagingClient
 from feat.interface.generic import ITimeProvider
 
+# Maximum number of publications and acknowledgments committed
+# in the same transaction
+DEFAULT_BATCH_SIZE = 100
+# Seconds an idle channel waits for more messages before publishing
+DEFAULT_BATCH_WINDOW = 0
+# Number of unacknowledged messages the broker sends to a consumer,
+# they are acknowledged once half of them are delivered
+DEFAULT_PREFETCH_COUNT = 100
+# Maximum seconds a delivered message waits for its acknowledgment
+DEFAULT_ACK_INTERVAL = 0.1
+# Number of connections and of channels in each of them used to publish
+DEFAULT_POOL_CONNECTIONS = 1
+DEFAULT_POOL_CHANNELS = 1
+
 
 class MessagingClient(AMQClient, log.Logger):
 
@@ -52,6 +67,8 @@ class MessagingClient(AMQClient, log.Logger):
         AMQClient.__init__(self, delegate, vhost, spec, heartbeat=8)
 
         self._channel_counter = 0
+        # {CHANNEL_ID: CALLABLE} called with the flow setting of the broker
+        self._flow_cbs = dict()
 
     def connectionMade(self):
         AMQClient.connectionMade(self)
@@ -69,11 +86,28 @@ class MessagingClient(AMQClient, log.Logger):
         self.log('Initializing channel: %d', self._channel_counter)
         return self.channel(self._channel_counter)
 
+    def add_flow_cb(self, channel_id, cb):
+        self._flow_cbs[channel_id] = cb
+
+    def channel_flow(self, channel, active):
+        cb = self._flow_cbs.get(channel.id)
+        if cb is not None:
+            cb(active)
+        # the publications are queued by the callback, nothing is
+        # sent until the broker restarts the flow
+        return channel.channel_flow_ok(active=active)
+
     def _error_handler(self, fail):
         self.warning('Got error authenticating: %r. Hopefully we will get '
                      'this right during the next reconnection.', fail)
 
 
+class MessagingDelegate(TwistedDelegate):
+
+    def channel_flow(self, ch, msg):
+        self.client.channel_flow(ch, msg.active)
+
+
 class AMQFactory(protocol.ReconnectingClientFactory, log.Logger, log.LogProxy):
 
     protocol = MessagingClient
@@ -169,7 +203,9 @@ class RabbitMQ(ConnectionManager, log.Logger, log.LogProxy):
     log_category = "net-rabbitmq"
 
     def __init__(self, host, port, user='guest', password='guest',
-                 timeout=5):
+                 timeout=5, batch_size=None, batch_window=None,
+                 prefetch_count=None, ack_interval=None,
+                 pool_connections=None, pool_channels=None):
         ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, log.FluLogKeeper())
         log.Logger.__init__(self, self)
@@ -179,11 +215,24 @@ class RabbitMQ(ConnectionManager, log.Logger, log.LogProxy):
         self._host = host
         self._port = port
         self._timeout_connecting = timeout
-
-        self._factory = AMQFactory(self, TwistedDelegate(),
+        self._batch_size = batch_size
+        self._batch_window = batch_window
+        self._prefetch_count = prefetch_count
+        self._ack_interval = ack_interval
+        self._pool_connections = pool_connections or DEFAULT_POOL_CONNECTIONS
+        self._pool_channels = pool_channels or DEFAULT_POOL_CHANNELS
+
+        self._factory = AMQFactory(self, MessagingDelegate(),
                                    self._user, self._password,
                                    on_connected=self._on_connected,
                                    on_disconnected=self._on_disconnected)
+        self._connector = None
+        # the first connection of the pool is the one of the factory above
+        self._pool_factories = [AMQFactory(self, MessagingDelegate(),
+                                           self._user, self._password)
+                                for _ in range(self._pool_connections - 1)]
+        self._pool_connectors = []
+        self._pool = None
 
     ### public ###
 
@@ -195,6 +244,11 @@ class RabbitMQ(ConnectionManager, log.Logger, log.LogProxy):
         eta = self._factory.get_eta_to_reconnect()
         return "RabbitMQ", self.is_connected(), self._host, self._port, eta
 
+    def get_stats(self):
+        if self._pool is None:
+            return []
+        return self._pool.get_stats()
+
     ### IBackend ####
 
     def is_idle(self):
@@ -208,6 +262,11 @@ class RabbitMQ(ConnectionManager, log.Logger, log.LogProxy):
         self.log("Disconnect called.")
         self._factory.stopTrying()
         self._connector.disconnect()
+        for factory in self._pool_factories:
+            factory.stopTrying()
+        for connector in self._pool_connectors:
+            connector.disconnect()
+        self._pool_connectors = []
 
     def connect(self):
         self._configure(self._host, self._port)
@@ -216,10 +275,9 @@ class RabbitMQ(ConnectionManager, log.Logger, log.LogProxy):
         return defer.Timeout(timeout, self.wait_connected(), msg)
 
     def new_channel(self, agent, queue_name=None):
-        d = self._factory.get_client()
-        channel_wrapped = Channel(self, d, self._factory)
-
-        return Connection(channel_wrapped, agent, queue_name)
+        channel_wrapped = self._create_channel(self._factory)
+        return Connection(channel_wrapped, agent, queue_name,
+                          publisher=self._get_pool())
 
     # add_disconnected_cb() from common.ConnectionManager
 
@@ -232,9 +290,64 @@ class RabbitMQ(ConnectionManager, log.Logger, log.LogProxy):
         self._port = port
         self._connector = reactor.connectTCP(self._host, self._port,
                                              self._factory)
+        self._pool_connectors = [reactor.connectTCP(host, port, factory)
+                                 for factory in self._pool_factories]
         self.log('AMQP connector created. Host: %s, Port: %s',
                  self._host, self._port)
 
+    def _create_channel(self, factory):
+        return Channel(self, factory.get_client(), factory,
+                       batch_size=self._batch_size,
+                       batch_window=self._batch_window,
+                       prefetch_count=self._prefetch_count,
+                       ack_interval=self._ack_interval)
+
+    def _get_pool(self):
+        # without pool the messages are published by the channel
+        # of the connection
+        if self._pool_connections * self._pool_channels == 1:
+            return None
+        if self._pool is None:
+            factories = [self._factory] + self._pool_factories
+            channels = [self._create_channel(factory)
+                        for factory in factories
+                        for _ in range(self._pool_channels)]
+            self._pool = ChannelPool(self, channels)
+        return self._pool
+
+
+class ChannelPool(log.Logger):
+    '''
+    Publishing channels spread over several AMQP connections. The messages
+    for the same shard and routing key always use the same channel, so
+    they keep their order. Each channel has its own processing chain and
+    transactions, a slow, disconnected or paused by the broker one only
+    delays its messages.
+    The channels of a lost connection are set up again once the factory
+    reconnects, the calls recorded in the meantime are not lost.
+    '''
+
+    def __init__(self, logger, channels):
+        log.Logger.__init__(self, logger)
+        self._channels = list(channels)
+
+    def publish(self, key, shard, message):
+        channel = self._channels[hash((shard, key)) % len(self._channels)]
+        return channel.publish(key, shard, message)
+
+    def get_stats(self):
+        stats = [dict(x.get_stats()) for x in self._channels]
+        connected = [x for x in self._channels if x.is_connected()]
+        paused = [x for x in self._channels if x.is_paused()]
+        return [('pool channels', len(self._channels)),
+                ('pool connected channels', len(connected)),
+                ('pool paused channels', len(paused)),
+                ('pool queue depth', sum(x['queue depth'] for x in stats)),
+                ('pool paused publications',
+                 sum(x['paused publications'] for x in stats)),
+                ('pool max queue depth',
+                 max(x['queue max depth'] for x in stats))]
+
 
 class ChannelState(enum.Enum):
     '''
@@ -249,10 +362,12 @@ class ChannelState(enum.Enum):
 class ProcessingCall(object):
 
     def __init__(self, method, only_when_connected,
-                 remember_between_connections, *args, **kwargs):
+                 remember_between_connections, batched, *args, **kwargs):
         self.method = method
         self.only_when_connected = only_when_connected
         self.remember_between_connections = remember_between_connections
+        # Batched calls are committed in the same transaction
+        self.batched = batched
         self.args = args
         self.kwargs = kwargs
 
@@ -269,7 +384,9 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
 
     channel_type = "default"
 
-    def __init__(self, messaging, client_defer, factory):
+    def __init__(self, messaging, client_defer, factory,
+                 batch_size=None, batch_window=None,
+                 prefetch_count=None, ack_interval=None):
         StateMachineMixin.__init__(self, ChannelState.recording)
         log.Logger.__init__(self, messaging)
         log.LogProxy.__init__(self, messaging)
@@ -280,8 +397,25 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
 
         self._queues = []
         self._is_processing = False
-        self._processing_chain = []
-        self._seen_messages = container.ExpDict(self)
+        # [ProcessingCall] in the order they have to be sent
+        self._processing_chain = collections.deque()
+        # publications are paused while the broker stops the flow
+        self._flow_active = True
+        # [ProcessingCall] of the publications paused, in their order,
+        # the other calls do not wait for them
+        self._paused_publications = collections.deque()
+        self._max_depth = 0
+        self._performed_calls = 0
+        self._committed_batches = 0
+        self._seen_messages = container.ExpSet(self)
+        self._batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self._batch_window = (DEFAULT_BATCH_WINDOW if batch_window is None
+                              else batch_window)
+        self._prefetch_count = (DEFAULT_PREFETCH_COUNT
+                                if prefetch_count is None
+                                else prefetch_count)
+        self._ack_interval = (DEFAULT_ACK_INTERVAL if ack_interval is None
+                              else ack_interval)
 
         self.serializer = banana.Serializer()
         self.unserializer = banana.Unserializer()
@@ -295,6 +429,12 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
 
     ### Public methods exposed to Connection ###
 
+    def is_connected(self):
+        return self._cmp_state(ChannelState.performing)
+
+    def is_paused(self):
+        return not self._flow_active
+
     def configure_queue(self, queue):
         '''
         Configures the WrappedQueue to receive messages from the client.
@@ -305,12 +445,17 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
     def define_queue(self, name):
         self.log('Defining queue: %r', name)
 
-        queue = WrappedQueue(self, name)
+        # without prefetch limit the acknowledgments are sent as often
+        # as with the default one
+        prefetch = self._prefetch_count or DEFAULT_PREFETCH_COUNT
+        queue = WrappedQueue(self, name, ack_size=max(prefetch // 2, 1),
+                             ack_interval=self._ack_interval)
         self._queues.append(queue)
         return self.configure_queue(queue)
 
     def publish(self, key, shard, message):
-        return self._call_on_channel(self._publish, key, shard, message)
+        return self._call_on_channel(self._publish, key, shard, message,
+                                     batched=True)
 
     def disconnect(self):
         return self._call_on_channel(self._disconnect,
@@ -318,27 +463,35 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
 
     def define_exchange(self, name, exchange_type="direct"):
         return self._call_on_channel(self._define_exchange,
-                                     name, exchange_type)
+                                     name, exchange_type, batched=True)
 
     def create_binding(self, exchange, queue, key):
         return self._call_on_channel(self._create_binding,
-                                     exchange, key, queue)
+                                     exchange, key, queue, batched=True)
 
     def delete_binding(self, exchange, queue, key):
         return self._call_on_channel(self._delete_binding,
-                                     exchange, key, queue)
+                                     exchange, key, queue, batched=True)
 
-    def ack(self, message):
-        return self._call_on_channel(self._ack, message,
+    def ack(self, message, multiple=False):
+        return self._call_on_channel(self._ack, message, multiple,
                                      only_when_connected=True,
-                                     remember_between_connections=False)
+                                     remember_between_connections=False,
+                                     batched=True)
+
+    def get_stats(self):
+        return [('queue depth', len(self._processing_chain)),
+                ('queue max depth', self._max_depth),
+                ('paused publications', len(self._paused_publications)),
+                ('performed calls', self._performed_calls),
+                ('committed batches', self._committed_batches)]
 
     def parse_message(self, msg):
         result = self.unserializer.convert(msg.content.body)
 
         if result.message_id in self._seen_messages:
             return
-        self._seen_messages.set(result.message_id, True,
+        self._seen_messages.add(result.message_id,
                                 expiration=result.expiration_time)
         return result
 
@@ -353,6 +506,11 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
 
         d = self.channel.queue_declare(
             queue=queue.name, durable=True, auto_delete=False)
+        if self._prefetch_count:
+            d.addCallback(defer.drop_param, self.channel.basic_qos,
+                          prefetch_size=0,
+                          prefetch_count=self._prefetch_count,
+                          global_=False)
         d.addCallback(defer.drop_param, self.channel.basic_consume,
                       queue=queue.name, no_ack=False)
         d.addCallback(operator.attrgetter('consumer_tag'))
@@ -368,7 +526,7 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
                 self.log('Not sending expired message. msg=%s, shard=%s, '
                          'key=%s, delta=%r', message, shard, key, delta)
                 return
-        serialized = self.serializer.convert(message)
+        serialized = message.serialize(self.serializer)
         content = Content(serialized)
         content.properties['delivery mode'] = 1  # non-persistent
 
@@ -378,9 +536,9 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
                        'mess up the whole txamqp library state, therefore '
                        'this message is ignored')
             return defer.succeed(None)
+        # Committed by _process_batch()
         d = self.channel.basic_publish(exchange=shard, content=content,
                                        routing_key=key, immediate=False)
-        d.addCallback(defer.drop_param, self.channel.tx_commit)
         d.addCallback(defer.override_result, message)
         return d
 
@@ -392,9 +550,10 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
         return d
 
     def _define_exchange(self, name, exchange_type):
+        # Confirmed by the commit of _process_batch()
         d = self.channel.exchange_declare(
             exchange=name, type=exchange_type, durable=True,
-            nowait=False, auto_delete=False)
+            nowait=True, auto_delete=False)
         return d
 
     def _create_binding(self, exchange, key, queue):
@@ -404,7 +563,7 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
         d = self._define_exchange(exchange, exchange_type)
         d.addCallback(defer.drop_param, self.channel.queue_bind,
                       exchange=exchange, routing_key=key,
-                      queue=queue, nowait=False)
+                      queue=queue, nowait=True)
         return d
 
     def _delete_binding(self, exchange, key, queue):
@@ -413,12 +572,9 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
         return self.channel.queue_unbind(exchange=exchange, routing_key=key,
                                          queue=queue)
 
-    def _ack(self, message):
-        d = defer.succeed(None)
-        d.addCallback(defer.drop_param, self.channel.basic_ack,
-                      message.delivery_tag)
-        d.addCallback(defer.drop_param, self.channel.tx_commit)
-        return d
+    def _ack(self, message, multiple):
+        # Committed by _process_batch()
+        return self.channel.basic_ack(message.delivery_tag, multiple=multiple)
 
     ### Private methods managing processing chain ###
 
@@ -427,14 +583,16 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
         only_when_connected = kwargs.pop('only_when_connected', False)
         remember_between_connections = \
                             kwargs.pop('remember_between_connections', True)
+        batched = kwargs.pop('batched', False)
         if only_when_connected and self._cmp_state(ChannelState.recording):
             self.log("Ignoring call of %r as currently we are disconnected.",
                      method)
             return
         pc = ProcessingCall(method, only_when_connected,
-                            remember_between_connections,
+                            remember_between_connections, batched,
                             *args, **kwargs)
         self._processing_chain.append(pc)
+        self._max_depth = max(self._max_depth, len(self._processing_chain))
         self.process_next()
 
         return pc.callback
@@ -445,27 +603,100 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
             d = defer.Deferred()
             d.addCallback(self._process_next)
             d.addBoth(self._finish_processing)
-            time.callLater(0, d.callback, None)
+            if self._processing_chain and self._processing_chain[0].batched:
+                # give the time to the calls of the same reactor iteration,
+                # or of the batch window, to join the transaction
+                time.callLater(self._batch_window, d.callback, None)
+            else:
+                d.callback(None)
 
     def _finish_processing(self, param):
         self._is_processing = False
         return param
 
     def _process_next(self, _param):
-        if self._cmp_state(ChannelState.recording):
-            return
+        # The calls finishing right away are processed in this loop,
+        # the others continue it from their callback
+        chain = self._processing_chain
+        while chain and not self._cmp_state(ChannelState.recording):
+            if not self._can_perform(chain[0]):
+                # put back in the chain by _resume_publications()
+                self._paused_publications.append(chain.popleft())
+                continue
+            if chain[0].batched:
+                d = self._process_batch()
+            else:
+                call = chain.popleft()
+                self.log('Calling :%r, args: %r, kwargs: %r',
+                         call.method.__name__, call.args, call.kwargs)
+                self._performed_calls += 1
+                d = call.perform()
+                d.addErrback(self._processing_error_handler, call)
+            finished = []
+            d.addCallback(finished.append)
+            if not finished:
+                d.addCallback(self._process_next)
+                return d
+
+    def _process_batch(self):
+        # The batched methods are sent without waiting for the server,
+        # the commit confirms all of them at once
+        chain = self._processing_chain
+        batch = []
+        while (chain and chain[0].batched
+               and len(batch) < self._batch_size
+               and self._can_perform(chain[0])):
+            batch.append(chain.popleft())
+        self.log('Calling %d batched methods in one transaction', len(batch))
+        self._performed_calls += len(batch)
+
+        results = []
+        d = defer.succeed(None)
+        for call in batch:
+            d.addCallback(defer.drop_param, call.method,
+                          *call.args, **call.kwargs)
+            d.addCallback(results.append)
+        d.addCallback(defer.drop_param, self.channel.tx_commit)
+        d.addCallback(defer.drop_param, self._batch_committed,
+                      batch, results)
+        d.addErrback(self._batch_error_handler, batch)
+        return d
 
-        if len(self._processing_chain) == 0:
-            return
+    def _can_perform(self, call):
+        # only the publications wait for the broker to restart the flow
+        return self._flow_active or call.method != self._publish
 
-        call = self._processing_chain.pop(0)
-        self.log('Calling :%r, args: %r, kwargs: %r',
-                 call.method.__name__, call.args, call.kwargs)
-        d = call.perform()
-        d.addCallbacks(self._process_next,
-                       self._processing_error_handler,
-                       errbackArgs=(call, ))
-        return d
+    def _on_flow(self, active):
+        self.info("Broker %s the flow of the channel",
+                  "restarted" if active else "stopped")
+        if active:
+            self._resume_publications()
+            self.process_next()
+        else:
+            self._flow_active = False
+
+    def _resume_publications(self):
+        # the paused publications are sent before the ones queued since
+        self._flow_active = True
+        paused = self._paused_publications
+        self._processing_chain.extendleft(reversed(paused))
+        paused.clear()
+
+    def _batch_committed(self, batch, results):
+        self._committed_batches += 1
+        for call, result in zip(batch, results):
+            call.callback.callback(result)
+
+    def _batch_error_handler(self, f, batch):
+        error.handle_failure(
+            self, f, 'Failed to perform %d batched ProcessingCalls, '
+            'first method: %r', len(batch), batch[0].method.__name__)
+        if self.channel is not None:
+            # Nothing of the batch should be committed when retrying
+            d = defer.maybeDeferred(self.channel.tx_rollback)
+            d.addErrback(defer.override_result, None)
+        self._set_state(ChannelState.recording)
+        self._processing_chain.extendleft(reversed(batch))
 
     def _processing_error_handler(self, f, call):
         error.handle_failure(
@@ -473,14 +704,15 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
             'Method being processed: %r, args: %r, kwargs: %r',
             call.method.__name__, call.args, call.kwargs)
         self._set_state(ChannelState.recording)
-        self._processing_chain.insert(0, call)
+        self._processing_chain.appendleft(call)
 
     def _cleanup_processing_chain(self):
         """Called on reconnection. Removes all the entries which are don't
         have the remember_between_connections flag set"""
         self.log("Removing stale processing chain entries.")
-        self._processing_chain = [x for x in self._processing_chain
-                                  if x.remember_between_connections]
+        self._processing_chain = collections.deque(
+            x for x in self._processing_chain
+            if x.remember_between_connections)
 
     ### Private methods managing setup and resetup ###
 
@@ -502,6 +734,9 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
             self.log("Finished channel configuration.")
             self.channel = channel
             self.client = client
+            # a new channel is active
+            self._resume_publications()
+            client.add_flow_cb(channel.id, self._on_flow)
             return channel
 
         def errback(fail):
@@ -553,36 +788,104 @@ class Channel(log.Logger, log.LogProxy, StateMachineMixin):
 
 
 class WrappedQueue(Queue, log.Logger):
+    '''
+    Consumes the messages as they arrive from the broker, within the
+    prefetch window, and acknowledges them once they are delivered to the
+    sink: with a single acknowledgment for every ack_size messages, or
+    after ack_interval seconds.
+    '''
 
-    def __init__(self, channel, name):
+    def __init__(self, channel, name, ack_size=1, ack_interval=0):
         log.Logger.__init__(self, channel)
-        Queue.__init__(self, name)
+        Queue.__init__(self, name, on_deliver=self._on_delivered)
 
         self.channel = channel
         # TimeoutDeferred queue representning instance inside the txAMQP lib
         self.queue = None
 
+        self._ack_size = ack_size
+        self._ack_interval = ack_interval
+        # [[MESSAGE, DELIVERED, QUEUE]] in the order they were received
+        self._received = collections.deque()
+        # the entries of the messages waiting in the queue for the sink
+        self._delivering = collections.deque()
+        # last delivered message not acknowledged yet
+        self._to_ack = None
+        self._to_ack_count = 0
+        self._ack_call = None
+
     def configure(self, bare_queue):
         if bare_queue is None:
             raise ValueError('Got None, expected TimeoutDeferredQueue.')
         self.log('Configuring queue %r with the instance: %r',
                  self.name, bare_queue)
         self.queue = bare_queue
+        # the delivery tags are only valid for the channel they come from
+        self._cancel_ack()
 
         self._main_loop()
         return self
 
     def _main_loop(self, *_):
+        # the messages already waiting are handled in this loop
+        # instead of recursing through the callbacks
+        while True:
+            d = self.queue.get()
+            d.addCallback(self._on_received)
+            if not d.called:
+                d.addCallbacks(self._main_loop, self._error_handler)
+                return
+            received = []
+            d.addCallbacks(received.append, self._error_handler)
+            if not received:
+                return
 
-        def parse_and_enqueue(msg):
-            parsed = self.channel.parse_message(msg)
-            if parsed is not None:
-                self.enqueue(parsed)
-
-        d = self.queue.get()
-        d.addCallback(defer.keep_param, parse_and_enqueue)
-        d.addCallback(self.channel.ack)
-        d.addCallbacks(self._main_loop, self._error_handler)
+    def _on_received(self, msg):
+        entry = [msg, False, self.queue]
+        self._received.append(entry)
+        parsed = self.channel.parse_message(msg)
+        if parsed is None:
+            # duplicated message, nothing to deliver
+            entry[1] = True
+            self._update_ack()
+        else:
+            self._delivering.append(entry)
+            self.enqueue(parsed)
+
+    def _on_delivered(self):
+        self._delivering.popleft()[1] = True
+        self._update_ack()
+
+    def _update_ack(self):
+        # acknowledging a delivery tag acknowledges the previous ones,
+        # so only the messages received before are taken into account
+        received = self._received
+        while received and received[0][1]:
+            msg, _, queue = received.popleft()
+            if queue is self.queue:
+                self._to_ack = msg
+                self._to_ack_count += 1
+        if self._to_ack is None:
+            return
+        if self._to_ack_count >= self._ack_size:
+            self._send_ack()
+        elif self._ack_call is None:
+            self._ack_call = time.callLater(self._ack_interval,
+                                            self._send_ack)
+
+    def _send_ack(self):
+        msg = self._to_ack
+        self._cancel_ack()
+        if msg is not None:
+            self.channel.ack(msg, multiple=True)
+
+    def _cancel_ack(self):
+        if self._ack_call is not None:
+            if self._ack_call.active():
+                self._ack_call.cancel()
+            self._ack_call = None
+        self._to_ack = None
+        self._to_ack_count = 0
 
     def _error_handler(self, f):
         if f.check(Closed, txamqp_queue.Closed):
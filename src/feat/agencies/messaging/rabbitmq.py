@@ -154,10 +154,12 @@ class Connection(log.Logger):
 
     support_broadcast = True
 
-    def __init__(self, client, sink, queue_name=None):
+    def __init__(self, client, sink, queue_name=None, publisher=None):
         log.Logger.__init__(self, client)
         self._client = client
         self._sink = ISink(sink)
+        # publishes the messages instead of the client if specified
+        self._publisher = publisher or client
 
         self._bindings = []
         self._queue = None
@@ -193,7 +195,7 @@ class Connection(log.Logger):
         defers = []
         for recip in recipients:
             self.log('Sending message to %r', recip)
-            d = self._client.publish(recip.key, recip.route, message)
+            d = self._publisher.publish(recip.key, recip.route, message)
             defers.append(d)
         return defer.DeferredList(defers)
 
@@ -1,15 +1,28 @@
+
+import heapq
+import itertools
 import operator
+import sys
 
 from zope.interface import implements
 
 from feat.agents.base.message import BaseMessage
 
-from feat.common import log, container, time
+from feat.common import log, time
 
 from feat.agencies.messaging.interface import ISink
 from feat.interface.generic import ITimeProvider
 
 
+# limits of the messages kept for the routes appended later
+DEFAULT_MAX_MESSAGES = 10000
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+# estimated memory taken by a stored message without its payload
+MESSAGE_OVERHEAD = 1024
+# removed entries kept in the heap before it gets compacted
+HEAP_SLACK = 100
+
+
 class Route(object):
 
     def __init__(self, owner, key=None, priority=0, final=True):
@@ -51,15 +64,18 @@ class Table(log.Logger):
 
     implements(ITimeProvider)
 
-    def __init__(self, logger, time_provider=None):
+    def __init__(self, logger, time_provider=None,
+                 max_messages=DEFAULT_MAX_MESSAGES,
+                 max_bytes=DEFAULT_MAX_BYTES):
         log.Logger.__init__(self, logger)
 
-        self._routes = list()
+        # {(RECIPIENT_KEY, RECIPIENT_ROUTE): [Route]} ordered by priority
+        self._routes = dict()
         self._outgoing_sink = None
 
         self._time_provider = time_provider and ITimeProvider(time_provider)
 
-        self._message_store = MessageStore(self)
+        self._message_store = MessageStore(self, max_messages, max_bytes)
 
     ### ITimeProvider ###
 
@@ -89,30 +105,42 @@ class Table(log.Logger):
         for message in to_deliver:
                 self._send_to_route(message, route)
 
-        self._routes.append(route)
-        self._fix_order()
+        routes = self._routes.setdefault(route.key, [])
+        # after the routes with the same priority
+        index = len(routes)
+        while index > 0 and routes[index - 1].priority > route.priority:
+            index -= 1
+        routes.insert(index, route)
 
     def remove_route(self, route):
+        routes = self._routes.get(route.key)
         try:
-            self._routes.remove(route)
-        except ValueError:
+            routes.remove(route)
+        except (AttributeError, ValueError):
             self.warning("Trying to remove nonexisting route: %r", route)
+            return
+        if not routes:
+            del self._routes[route.key]
 
     def remove_sink(self, sink):
-        for route in self._routes:
-            if route.owner == sink:
-                self.remove_route(route)
+        for route in [r for routes in self._routes.values()
+                      for r in routes if r.owner == sink]:
+            self.remove_route(route)
 
         if self._outgoing_sink == sink:
             self.info("Outgoing sink removed, setting to None.")
             self._outgoing_sink = None
 
     def dispatch(self, message, outgoing=True):
+        if not isinstance(message, BaseMessage):
+            raise AttributeError("Expected BaseMessage got %r" % (message, ))
 
-        for route in self._routes:
-            self.log("Analizing route %r, matching=%r", route,
-                     route.match(message))
-            if route.match(message):
+        recipient = message.recipient
+        routes = self._routes.get((recipient.key, recipient.route))
+        if routes:
+            # the routes can change while delivering the message
+            for route in tuple(routes):
+                self.log("Matching route %r", route)
                 self._send_to_route(message, route)
                 if route.final:
                     return
@@ -126,10 +154,6 @@ class Table(log.Logger):
 
     ### private ###
 
-    def _fix_order(self):
-        self._routes = sorted(self._routes,
-                              key=operator.attrgetter('priority'))
-
     def _send_to_route(self, message, route):
         message = message.clone()
         route.owner.on_message(message)
@@ -138,32 +162,123 @@ class Table(log.Logger):
 class MessageStore(object):
     """
     I'm a class responsible for holding the message until they expiration
-    time and match them to correct routes.
+    time and match them to correct routes. The messages are indexed by the
+    key of their recipient and their expiration times are kept in a heap.
+    When there are more than max_messages messages or their estimated
+    size exceeds max_bytes, the ones closest to expiration are dropped.
     """
 
-    def __init__(self, time_provider):
-        self._store = container.ExpDict(time_provider)
+    def __init__(self, time_provider, max_messages=DEFAULT_MAX_MESSAGES,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self._time = ITimeProvider(time_provider)
+        self._max_messages = max_messages
+        self._max_bytes = max_bytes
+
+        # {MESSAGE_ID: [EXPIRATION_TIME, SEQUENCE, MESSAGE, SIZE]}
+        self._entries = dict()
+        # {(RECIPIENT_KEY, RECIPIENT_ROUTE): {MESSAGE_ID: ENTRY}}
+        self._index = dict()
+        # [ENTRY] ordered by expiration time, may contain removed entries
+        self._heap = list()
+        self._sequence = itertools.count()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._bytes
 
     def insert(self, message):
         if not isinstance(message, BaseMessage):
             raise TypeError('Expected BaseMessage got %r' % (message, ))
 
         # ignore messages without expiration time (would leak)
-        if message.expiration_time is not None:
-            self._store.set(message.message_id, message,
-                            message.expiration_time)
+        if message.expiration_time is None:
+            return
+        self._expire()
+        if message.expiration_time <= self._time.get_time():
+            return
+
+        self.remove(message)
+        size = _estimate_size(message.payload) + MESSAGE_OVERHEAD
+        entry = [message.expiration_time, self._sequence.next(),
+                 message, size]
+        self._entries[message.message_id] = entry
+        key = (message.recipient.key, message.recipient.route)
+        self._index.setdefault(key, {})[message.message_id] = entry
+        heapq.heappush(self._heap, entry)
+        self._bytes += size
+        self._enforce_limits()
 
     def remove(self, message):
         if not isinstance(message, BaseMessage):
             raise TypeError('Expected BaseMessage got %r' % (message, ))
 
-        self._store.pop(message.message_id, None)
+        entry = self._entries.get(message.message_id)
+        if entry is not None:
+            self._discard(entry)
 
     def match_to_route(self, route):
         if not isinstance(route, Route):
             raise TypeError('Expected Route got %r' % (route, ))
 
-        matching = [x for x in self._store.itervalues() if route.match(x)]
+        self._expire()
+        bucket = self._index.get(route.key)
+        if not bucket:
+            return []
+        entries = sorted(bucket.itervalues(), key=operator.itemgetter(1))
+        matching = [x[2] for x in entries]
         if route.final:
-            [self.remove(x) for x in matching]
+            for entry in entries:
+                self._discard(entry)
         return matching
+
+    ### private ###
+
+    def _discard(self, entry):
+        message = entry[2]
+        del self._entries[message.message_id]
+        key = (message.recipient.key, message.recipient.route)
+        bucket = self._index[key]
+        del bucket[message.message_id]
+        if not bucket:
+            del self._index[key]
+        self._bytes -= entry[3]
+        # the entry stays in the heap until it gets to the top
+        entry[2] = None
+        if len(self._heap) > 2 * len(self._entries) + HEAP_SLACK:
+            self._heap = [x for x in self._heap if x[2] is not None]
+            heapq.heapify(self._heap)
+
+    def _pop(self):
+        entry = heapq.heappop(self._heap)
+        if entry[2] is not None:
+            self._discard(entry)
+
+    def _expire(self):
+        now = self._time.get_time()
+        # discarding an entry might compact the heap, it is not kept
+        while self._heap and (self._heap[0][0] <= now or
+                              self._heap[0][2] is None):
+            self._pop()
+
+    def _enforce_limits(self):
+        while self._heap and (
+            (self._max_messages is not None
+             and len(self._entries) > self._max_messages) or
+            (self._max_bytes is not None
+             and self._bytes > self._max_bytes)):
+            self._pop()
+
+
+def _estimate_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.iteritems():
+            size += _estimate_size(k) + _estimate_size(v)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            size += _estimate_size(v)
+    return size
@@ -1,15 +1,34 @@
+import collections
 import functools
+import os
+import struct
+import uuid
 
 from zope.interface import implements
+from twisted.internet import reactor, protocol
+from twisted.internet.error import CannotListenError
+from twisted.protocols import basic
+from twisted.python import failure
 from twisted.spread import pb
 
-from feat.common import log, defer, first
+from feat.common import log, defer, first, error, time
+from feat.common.serialization import banana
 
 from feat.agencies.messaging import routing
 from feat.agencies import common
 
 from feat.agencies.messaging.interface import ISink, IBackend
 
+# Messages sent through a stream before the other side grants more
+DEFAULT_WINDOW = 1000
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Seconds the slave waits for the stream to be attached by the master
+STREAM_TIMEOUT = 5
+
+FRAME_HELLO = "H"
+FRAME_CREDIT = "C"
+FRAME_MESSAGE = "M"
+
 
 class Master(log.Logger, log.LogProxy, common.ConnectionManager,
              pb.Referenceable):
@@ -18,7 +37,7 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
 
     channel_type = 'unix'
 
-    def __init__(self, broker):
+    def __init__(self, broker, window=None):
         common.ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, broker)
         log.Logger.__init__(self, self)
@@ -28,10 +47,18 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
         # routing key -> SlaveReference
         self._slaves = dict()
 
+        self._window = window
+        self._listener = None
+        # stream id -> Stream
+        self._streams = dict()
+        # pb.RemoteReference to Slave -> Stream
+        self._slave_streams = dict()
+
     ### IBackend ###
 
     def initiate(self, messaging):
         self._messaging = messaging
+        self._listen_streams()
         self._on_connected()
 
     def binding_created(self, binding):
@@ -47,7 +74,12 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
         pass
 
     def disconnect(self):
-        return defer.succeed(None)
+        for stream in self._streams.values():
+            stream.transport.loseConnection()
+        if self._listener is None:
+            return defer.succeed(None)
+        listener, self._listener = self._listener, None
+        return defer.maybeDeferred(listener.stopListening)
 
     # is_disconnected() from common.ConnectionManager
 
@@ -67,7 +99,13 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
                          "is %r, slaves we know: %r",
                          key, self._slaves.keys())
         else:
-            d = [s.dispatch(message) for s in self._slaves[key]]
+            d = []
+            for s in self._slaves[key]:
+                stream = self._slave_streams.get(s.slave)
+                if stream is not None:
+                    stream.send(message)
+                else:
+                    d.append(s.dispatch(message))
             return defer.DeferredList(d, consumeErrors=True)
 
     ### Methods called by Slave ###
@@ -86,14 +124,69 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
     def remote_dispatch(self, message):
         self._messaging.dispatch(message, outgoing=True)
 
+    def remote_attach_stream(self, slave, stream_id):
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            return False
+        self._slave_streams[slave] = stream
+        slave.notifyOnDisconnect(self._detach_stream)
+        return True
+
     def remote_create_external_route(self, backend_id, **kwargs):
         return self._messaging.create_external_route(backend_id, **kwargs)
 
     def remote_remove_external_route(self, backend_id, **kwargs):
         return self._messaging.remove_external_route(backend_id, **kwargs)
 
+    ### protected, called by Stream ###
+
+    def _stream_opened(self, stream):
+        self._streams[stream.stream_id] = stream
+        stream.hello(stream.stream_id)
+
+    def _stream_received(self, message):
+        self._messaging.dispatch(message, outgoing=True)
+
+    def _stream_closed(self, stream, queued):
+        self._streams.pop(stream.stream_id, None)
+        slave = None
+        for slave_reference, slave_stream in self._slave_streams.items():
+            if slave_stream is stream:
+                slave = slave_reference
+                del self._slave_streams[slave_reference]
+        if not queued:
+            return
+        if slave is None:
+            self.warning("Message stream %s lost with %d messages queued "
+                         "for a slave we don't know anymore",
+                         stream.stream_id, len(queued))
+            return
+        # the messages not sent yet go through PB
+        for message in queued:
+            d = slave.callRemote('dispatch', message)
+            d.addErrback(_dispatch_failed, self, message)
+
     ### private ###
 
+    def _listen_streams(self):
+        path = _stream_path(self._broker.socket_path)
+        try:
+            # we are the master, nobody else is using it
+            os.unlink(path)
+        except OSError:
+            pass
+        factory = protocol.ServerFactory()
+        factory.protocol = functools.partial(Stream, self, self._window)
+        try:
+            self._listener = reactor.listenUNIX( #@UndefinedVariable
+                path, factory, mode=self._broker.socket_mode)
+        except CannotListenError as e:
+            self.warning("Cannot listen for message streams on %s, the "
+                         "slaves will dispatch through PB: %r", path, e)
+
+    def _detach_stream(self, slave):
+        self._slave_streams.pop(slave, None)
+
     def _append(self, key, slave):
         if key not in self._slaves:
             self._slaves[key] = list()
@@ -155,7 +248,7 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
 
     channel_type = 'unix'
 
-    def __init__(self, broker):
+    def __init__(self, broker, window=None):
         common.ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, broker)
         log.Logger.__init__(self, self)
@@ -165,6 +258,13 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
         # PBReference to Master
         self._master = None
 
+        self._window = window
+        # Stream to the Master, until then the messages go through PB
+        self._stream = None
+        # fired once the stream is attached or failed
+        self._stream_ready = None
+        self._stream_timeout = None
+
     ### IBackend ###
 
     def initiate(self, messaging):
@@ -176,6 +276,7 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
         self._messaging = messaging
         d = self._broker.get_broker_backend()
         d.addCallback(setter)
+        d.addCallback(defer.drop_param, self._open_stream)
         d.addCallback(defer.drop_param, self._on_connected)
         return d
 
@@ -196,6 +297,8 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
                                        backend_id, **kwargs)
 
     def disconnect(self):
+        if self._stream is not None:
+            self._stream.transport.loseConnection()
         return defer.succeed(None)
 
     # is_disconnected() from common.ConnectionManager
@@ -209,9 +312,182 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
     ### ISink ###
 
     def on_message(self, message):
+        if self._stream is not None:
+            self._stream.send(message)
+            return
         return self._master.callRemote('dispatch', message)
 
     ### Called by Master ###
 
     def remote_dispatch(self, message):
         self._messaging.dispatch(message, outgoing=False)
+
+    ### protected, called by Stream ###
+
+    def _stream_opened(self, stream):
+        # the master knows the stream, it can be attached to us
+        d = self._master.callRemote('attach_stream', self, stream.stream_id)
+        d.addCallback(self._stream_attached, stream)
+        d.addBoth(self._stream_settled)
+
+    def _stream_received(self, message):
+        self._messaging.dispatch(message, outgoing=False)
+
+    def _stream_closed(self, stream, queued):
+        if self._stream is stream:
+            self._stream = None
+            # the messages not sent yet go through PB
+            for message in queued:
+                d = self._master.callRemote('dispatch', message)
+                d.addErrback(_dispatch_failed, self, message)
+        elif self._stream_ready is not None:
+            # closed before being attached, the messages go through PB
+            self._stream_settled(failure.Failure(error.FeatError(
+                "Message stream closed before being attached")))
+
+    ### private ###
+
+    def _open_stream(self):
+        ready = defer.Deferred()
+        self._stream_ready = ready
+        path = _stream_path(self._broker.socket_path)
+        creator = protocol.ClientCreator(reactor, Stream, self, self._window)
+        d = creator.connectUNIX(path, timeout=1)
+        d.addCallbacks(self._stream_connected, self._stream_settled)
+        ready.addErrback(self._stream_failed)
+        return ready
+
+    def _stream_connected(self, stream):
+        stream.hello(str(uuid.uuid1()))
+        # the master might never answer
+        self._stream_timeout = time.call_later(
+            STREAM_TIMEOUT, stream.transport.loseConnection)
+
+    def _stream_settled(self, result):
+        if self._stream_timeout is not None:
+            if self._stream_timeout.active():
+                self._stream_timeout.cancel()
+            self._stream_timeout = None
+        ready, self._stream_ready = self._stream_ready, None
+        if ready is not None:
+            ready.callback(result)
+
+    def _stream_attached(self, attached, stream):
+        if not attached:
+            stream.transport.loseConnection()
+            raise error.FeatError("Master does not know the stream %s"
+                                  % (stream.stream_id, ))
+        if self._stream_ready is None:
+            # closed while waiting for the master
+            raise error.FeatError("Message stream %s closed before being "
+                                  "attached" % (stream.stream_id, ))
+        self._stream = stream
+
+    def _stream_failed(self, failure):
+        self.info("Cannot open the message stream to the master, "
+                  "dispatching through PB: %s",
+                  error.get_failure_message(failure))
+
+
+class Stream(basic.Int32StringReceiver, log.Logger):
+    '''
+    Framed stream carrying the serialized messages between the master
+    and a slave agency over a unix socket. The slave opens it with a
+    hello frame the master answers. Each side grants credit for the
+    messages the other one may send, the messages without credit are
+    queued. The queued messages are written at once on the next
+    reactor iteration. The ones still queued when the stream is lost
+    are given back to its owner, which dispatches them through PB.
+    '''
+
+    MAX_LENGTH = MAX_FRAME_SIZE
+
+    def __init__(self, owner, window=None):
+        log.Logger.__init__(self, owner)
+        self.stream_id = None
+        self._owner = owner
+        self._window = window or DEFAULT_WINDOW
+        self._credit = 0 # messages we are allowed to send
+        self._received = 0 # messages received since the last credit
+        # [(MESSAGE, SERIALIZED MESSAGE)]
+        self._queue = collections.deque()
+        self._flushing = False
+        self._serializer = banana.Serializer()
+        self._unserializer = banana.Unserializer()
+
+    ### public ###
+
+    def hello(self, stream_id):
+        self.stream_id = stream_id
+        self.sendString(FRAME_HELLO + stream_id)
+
+    def send(self, message):
+        self._queue.append((message, message.serialize(self._serializer)))
+        self._schedule_flush()
+
+    ### overridden ###
+
+    def connectionMade(self):
+        self._grant(self._window)
+
+    def connectionLost(self, reason):
+        # the owner dispatches the messages not sent yet another way
+        queued = [message for message, _body in self._queue]
+        self._queue.clear()
+        self._owner._stream_closed(self, queued)
+
+    def stringReceived(self, frame):
+        kind, data = frame[:1], frame[1:]
+        if kind == FRAME_MESSAGE:
+            self._received += 1
+            if self._received * 2 >= self._window:
+                self._grant(self._received)
+                self._received = 0
+            try:
+                message = self._unserializer.convert(data)
+            except Exception as e:
+                error.handle_exception(self, e, "Failed unserializing "
+                                       "a message received from the stream")
+                return
+            self._owner._stream_received(message)
+        elif kind == FRAME_CREDIT:
+            self._credit += int(data)
+            self._schedule_flush()
+        elif kind == FRAME_HELLO:
+            self.stream_id = data
+            self._owner._stream_opened(self)
+        else:
+            self.warning("Unknown frame type %r, closing the stream", kind)
+            self.transport.loseConnection()
+
+    ### private ###
+
+    def _grant(self, count):
+        self.sendString(FRAME_CREDIT + str(count))
+
+    def _schedule_flush(self):
+        if not self._flushing and self._credit and self._queue:
+            self._flushing = True
+            time.call_next(self._flush)
+
+    def _flush(self):
+        self._flushing = False
+        frames = []
+        while self._credit and self._queue:
+            _message, body = self._queue.popleft()
+            frames.append(struct.pack(self.structFormat, len(body) + 1))
+            frames.append(FRAME_MESSAGE)
+            frames.append(body)
+            self._credit -= 1
+        if frames and self.transport is not None:
+            self.transport.writeSequence(frames)
+
+
+def _dispatch_failed(fail, logger, message):
+    error.handle_failure(logger, fail, "Failed dispatching through PB the "
+                         "message %s queued in a lost stream",
+                         message.message_id)
+
+
+def _stream_path(socket_path):
+    return socket_path + ".messages"
@@ -65,9 +65,15 @@ class Startup(agency.Startup):
             os.chdir(self.c['agency']['rundir'])
 
         dbc = self.c['db']
-        self._db = database.Database(dbc['host'],
-                                     int(dbc['port']), dbc['name'])
-        self._journaler = journaler.Journaler(self)
+        connections = dbc.get('connections')
+        connections = int(connections) if connections is not None else None
+        cache_size = dbc.get('cache_size')
+        cache_size = int(cache_size) if cache_size is not None else None
+        self._db = database.Database(dbc['host'], int(dbc['port']),
+                                     dbc['name'], connections, cache_size)
+        self._journaler = journaler.Journaler(
+            self, high_water_mark=self.friend._get_journal_high_water_mark(),
+            spill_dir=self.c['agency']['rundir'])
 
     def stage_private(self):
         reactor.addSystemEventTrigger('before', 'shutdown',
@@ -153,14 +159,27 @@ class Agency(agency.Agency):
                  msg_port=options.DEFAULT_MSG_PORT,
                  msg_user=options.DEFAULT_MSG_USER,
                  msg_password=options.DEFAULT_MSG_PASSWORD,
+                 msg_batch_size=options.DEFAULT_BATCH_SIZE,
+                 msg_batch_window=options.DEFAULT_BATCH_WINDOW,
+                 msg_prefetch_count=options.DEFAULT_PREFETCH_COUNT,
+                 msg_ack_interval=options.DEFAULT_ACK_INTERVAL,
+                 msg_pool_connections=options.DEFAULT_POOL_CONNECTIONS,
+                 msg_pool_channels=options.DEFAULT_POOL_CHANNELS,
                  db_host=options.DEFAULT_DB_HOST,
                  db_port=options.DEFAULT_DB_PORT,
                  db_name=options.DEFAULT_DB_NAME,
+                 db_connections=options.DEFAULT_DB_CONNECTIONS,
+                 db_cache_size=options.DEFAULT_CACHE_SIZE,
                  public_key=options.DEFAULT_MH_PUBKEY,
                  private_key=options.DEFAULT_MH_PRIVKEY,
                  authorized_keys=options.DEFAULT_MH_AUTH,
                  manhole_port=options.DEFAULT_MH_PORT,
                  agency_journal=options.DEFAULT_JOURFILE,
+                 journal_backend=options.DEFAULT_JOURNAL_BACKEND,
+                 journal_flush_size=options.DEFAULT_FLUSH_SIZE,
+                 journal_flush_interval=options.DEFAULT_FLUSH_INTERVAL,
+                 journal_synchronous=options.DEFAULT_SYNCHRONOUS,
+                 journal_high_water_mark=options.DEFAULT_HIGH_WATER_MARK,
                  socket_path=options.DEFAULT_SOCKET_PATH,
                  lock_path=options.DEFAULT_LOCK_PATH,
                  gateway_port=options.DEFAULT_GW_PORT,
@@ -187,14 +206,27 @@ class Agency(agency.Agency):
                           msg_port=msg_port,
                           msg_password=msg_password,
                           msg_user=msg_user,
+                          msg_batch_size=msg_batch_size,
+                          msg_batch_window=msg_batch_window,
+                          msg_prefetch_count=msg_prefetch_count,
+                          msg_ack_interval=msg_ack_interval,
+                          msg_pool_connections=msg_pool_connections,
+                          msg_pool_channels=msg_pool_channels,
                           db_host=db_host,
                           db_port=db_port,
                           db_name=db_name,
+                          db_connections=db_connections,
+                          db_cache_size=db_cache_size,
                           public_key=public_key,
                           private_key=private_key,
                           authorized_keys=authorized_keys,
                           manhole_port=manhole_port,
                           agency_journal=agency_journal,
+                          journal_backend=journal_backend,
+                          journal_flush_size=journal_flush_size,
+                          journal_flush_interval=journal_flush_interval,
+                          journal_synchronous=journal_synchronous,
+                          journal_high_water_mark=journal_high_water_mark,
                           socket_path=socket_path,
                           lock_path=lock_path,
                           gateway_port=gateway_port,
@@ -266,11 +298,24 @@ class Agency(agency.Agency):
 
     def on_become_master(self):
         self._ssh.start_listening()
-        filename = os.path.join(self.config['agency']['logdir'],
-                                self.config['agency']['journal'])
-        self._journal_writer = journaler.SqliteWriter(
-            self, filename=filename, encoding='zip',
-            on_rotate=self._force_snapshot_agents)
+        agency_conf = self.config['agency']
+        filename = os.path.join(agency_conf['logdir'],
+                                agency_conf['journal'])
+        if agency_conf['journal_backend'] == 'segments':
+            self._journal_writer = journaler.SegmentWriter(
+                self, filename, encoding='zip',
+                flush_size=int(agency_conf['journal_flush_size']),
+                high_water_mark=self._get_journal_high_water_mark(),
+                spill_dir=agency_conf['rundir'])
+        else:
+            self._journal_writer = journaler.SqliteWriter(
+                self, filename=filename, encoding='zip',
+                on_rotate=self._force_snapshot_agents,
+                flush_size=int(agency_conf['journal_flush_size']),
+                flush_interval=float(agency_conf['journal_flush_interval']),
+                synchronous=agency_conf['journal_synchronous'],
+                high_water_mark=self._get_journal_high_water_mark(),
+                spill_dir=agency_conf['rundir'])
         self._journaler.configure_with(self._journal_writer)
         self._journal_writer.initiate()
         self._start_master_gateway()
@@ -313,7 +358,10 @@ class Agency(agency.Agency):
     def on_become_slave(self):
         self.start_host_agent = False
         self._ssh.stop_listening()
-        self._journal_writer = journaler.BrokerProxyWriter(self._broker)
+        self._journal_writer = journaler.BrokerProxyWriter(
+            self._broker,
+            high_water_mark=self._get_journal_high_water_mark(),
+            spill_dir=self.config['agency']['rundir'])
         self._journaler.configure_with(self._journal_writer)
         self._journal_writer.initiate()
         self._redirect_text_log()
@@ -571,14 +619,27 @@ class Agency(agency.Agency):
                      msg_port=None,
                      msg_user=None,
                      msg_password=None,
+                     msg_batch_size=None,
+                     msg_batch_window=None,
+                     msg_prefetch_count=None,
+                     msg_ack_interval=None,
+                     msg_pool_connections=None,
+                     msg_pool_channels=None,
                      db_host=None,
                      db_port=None,
                      db_name=None,
+                     db_connections=None,
+                     db_cache_size=None,
                      public_key=None,
                      private_key=None,
                      authorized_keys=None,
                      manhole_port=None,
                      agency_journal=None,
+                     journal_backend=None,
+                     journal_flush_size=None,
+                     journal_flush_interval=None,
+                     journal_synchronous=None,
+                     journal_high_water_mark=None,
                      socket_path=None,
                      lock_path=None,
                      gateway_port=None,
@@ -596,11 +657,19 @@ class Agency(agency.Agency):
         msg_conf = dict(host=msg_host,
                         port=msg_port,
                         user=msg_user,
-                        password=msg_password)
+                        password=msg_password,
+                        batch_size=msg_batch_size,
+                        batch_window=msg_batch_window,
+                        prefetch_count=msg_prefetch_count,
+                        ack_interval=msg_ack_interval,
+                        pool_connections=msg_pool_connections,
+                        pool_channels=msg_pool_channels)
 
         db_conf = dict(host=db_host,
                        port=db_port,
-                       name=db_name)
+                       name=db_name,
+                       connections=db_connections,
+                       cache_size=db_cache_size)
 
         manhole_conf = dict(public_key=public_key,
                             private_key=private_key,
@@ -612,6 +681,11 @@ class Agency(agency.Agency):
                 path = os.path.join(rundir, path)
 
         agency_conf = dict(journal=agency_journal,
+                           journal_backend=journal_backend,
+                           journal_flush_size=journal_flush_size,
+                           journal_flush_interval=journal_flush_interval,
+                           journal_synchronous=journal_synchronous,
+                           journal_high_water_mark=journal_high_water_mark,
                            socket_path=socket_path,
                            lock_path=lock_path,
                            rundir=rundir,
@@ -693,11 +767,34 @@ class Agency(agency.Agency):
             port = int(config['port'])
             username = config['user']
             password = config['password']
+            batch_size = config.get('batch_size')
+            batch_size = int(batch_size) if batch_size is not None else None
+            batch_window = config.get('batch_window')
+            batch_window = (float(batch_window)
+                            if batch_window is not None else None)
+            prefetch_count = config.get('prefetch_count')
+            prefetch_count = (int(prefetch_count)
+                              if prefetch_count is not None else None)
+            ack_interval = config.get('ack_interval')
+            ack_interval = (float(ack_interval)
+                            if ack_interval is not None else None)
+            pool_connections = config.get('pool_connections')
+            pool_connections = (int(pool_connections)
+                                if pool_connections is not None else None)
+            pool_channels = config.get('pool_channels')
+            pool_channels = (int(pool_channels)
+                             if pool_channels is not None else None)
 
             self.info("Setting up messaging using %s@%s:%d", username,
                       host, port)
 
-            backend = net.RabbitMQ(host, port, username, password)
+            backend = net.RabbitMQ(host, port, username, password,
+                                   batch_size=batch_size,
+                                   batch_window=batch_window,
+                                   prefetch_count=prefetch_count,
+                                   ack_interval=ack_interval,
+                                   pool_connections=pool_connections,
+                                   pool_channels=pool_channels)
             backend.redirect_log(self)
             client = rabbitmq.Client(backend, self.get_hostname())
             return client
@@ -749,6 +846,10 @@ class Agency(agency.Agency):
     def _on_host_started(self):
         self._broker.shared_state['enable_host_restart'] = True
 
+    def _get_journal_high_water_mark(self):
+        value = self.config['agency']['journal_high_water_mark']
+        return int(value) if value is not None else None
+
     @manhole.expose()
     def snapshot_agents(self, force=False):
         agency.Agency.snapshot_agents(self, force)
@@ -19,91 +19,263 @@
 # See "LICENSE.GPL" in the source distribution for more information.
 
 # Headers in this file shall remain intact.
-import sys
-import os
+import functools
+import json
+import operator
+import re
+import urllib
 
 from zope.interface import implements
 from twisted.web import error as web_error
 from twisted.internet import error
-from twisted.web._newclient import ResponseDone
 from twisted.python import failure
 
 from feat.agencies.database import Connection, ChangeListener
 from feat.common import log, defer, time
 from feat.agencies import common
+from feat.web import http, httpclient
 
 from feat.agencies.interface import *
 from feat.interface.view import *
 
 
-from feat import extern
-# Add feat/extern/paisley to the load path
-sys.path.insert(0, os.path.join(extern.__path__[0], 'paisley'))
-from paisley.changes import ChangeNotifier
-from paisley.client import CouchDB
-
-
 DEFAULT_DB_HOST = "localhost"
 DEFAULT_DB_PORT = 5984
 DEFAULT_DB_NAME = "feat"
-
-
-class Notifier(object):
-
-    def __init__(self, db, filter_):
+# Maximum number of requests done at the same time
+DEFAULT_DB_CONNECTIONS = 8
+# Seconds before restarting the changes feed after a failure
+FEED_RESTART_DELAY = 1
+# parameters of the view queries which are not json encoded
+VIEW_DOCID_OPTIONS = ('startkey_docid', 'endkey_docid')
+
+
+class ChangeFeed(log.Logger):
+    '''
+    Continuous _changes stream of the database shared by all the filters.
+    The stream is read from the sequence number of the last change
+    received, so it is resumed after a failure without losing or
+    repeating changes. The documents are only included in the stream
+    while a view filter has listeners, they are needed to match them.
+    '''
+
+    def __init__(self, db):
+        log.Logger.__init__(self, db)
         self._db = db
-        self._filter = filter_
-        self.name = self._filter.name
-        self._params = None
-
-        self.reconfigure()
-
-    def reconfigure(self):
-        # called after changing the database
-        self._changes = ChangeNotifier(self._db.paisley, self._db.db_name)
-        self._changes.addListener(self)
-
-    def setup(self):
-        new_params = self._filter.extract_params()
-        if self._params is not None and \
-           new_params == self._params and \
-           self._changes.isRunning():
+        # sequence number of the last change received
+        self.since = None
+        self._listening = False
+        self._include_docs = False
+        # httpclient.Connection of the running stream
+        self._connection = None
+        self._buffer = ""
+        self._restarter = None
+
+    def is_running(self):
+        return self._connection is not None
+
+    def setup(self, listening, include_docs):
+        '''
+        Starts, restarts or stops the stream for the filters.
+        The stream is only restarted when the documents are needed
+        or not needed anymore.
+        '''
+        changed = include_docs != self._include_docs
+        self._listening = listening
+        self._include_docs = include_docs
+        if not listening:
+            self.stop()
             return defer.succeed(None)
+        if self.is_running() and not changed:
+            return defer.succeed(None)
+        self.stop()
+        d = self._db.wait_connected()
+        d.addCallback(defer.drop_param, self._start)
+        return d
 
-        self._params = new_params
+    def stop(self):
+        if self._restarter is not None:
+            self._restarter.cancel()
+            self._restarter = None
+        if self._connection is not None:
+            self._db.log("Stopping the changes feed")
+            connection, self._connection = self._connection, None
+            connection.disconnect()
 
-        if self._changes.isRunning():
-            self._changes.stop()
-        d = defer.succeed(None)
-        if new_params is not None:
-            d.addCallback(defer.drop_param, self._db.wait_connected)
-            d.addCallback(defer.drop_param, self._changes.start,
-                           heartbeat=1000, **new_params)
-        else:
-            self._db.log("Stopping notifier: %r", self.name)
-        d.addErrback(self.connectionLost)
-        d.addErrback(failure.Failure.trap, NotConnectedError)
-        return d
+    def reset(self):
+        '''Forgets the sequence number, the database changed.'''
+        self.stop()
+        self.since = None
 
-    ### paisleys ChangeListener interface
+    ### private ###
 
-    def changed(self, change):
+    def _start(self):
+        if self.is_running() or not self._listening:
+            return
+        self._restarter = None
+        connection = httpclient.Connection(self._db.host, self._db.port,
+                                           logger=self._db)
+        self._connection = connection
+        self._buffer = ""
+        d = defer.succeed(self.since)
+        if self.since is None:
+            # the changes made before the first listener are not needed
+            d.addCallback(defer.drop_param, self._db.get_update_seq)
+        d.addCallback(self._request, connection)
+        d.addErrback(self._stream_finished, connection)
+        return d
+
+    def _request(self, since, connection):
+        if connection is not self._connection:
+            return
+        self.since = since
+        params = dict(feed="continuous", heartbeat=1000, since=since)
+        if self._include_docs:
+            params["include_docs"] = "true"
+        location = "/%s/_changes?%s" % (self._db.db_name,
+                                        urllib.urlencode(params))
+        self._db.log("Starting the changes feed since %s", since)
+        consumer = functools.partial(self._data_received, connection)
+        d = connection.request(http.Methods.GET, location,
+                               {"accept": "application/json"},
+                               consumer=consumer)
+        # fired when the stream ends, the feed is started already
+        d.addCallback(self._check_response)
+        d.addBoth(self._stream_finished, connection)
+
+    def _check_response(self, response):
+        status = int(response.status)
+        if status >= 400:
+            raise web_error.Error(status, self._buffer)
+
+    def _stream_finished(self, param, connection):
+        if connection is not self._connection:
+            # stopped on purpose
+            return
+        self._connection = None
+        delay = 0
+        if isinstance(param, failure.Failure):
+            self._db.connectionLost(param)
+            delay = FEED_RESTART_DELAY
+        d = defer.Deferred()
+        d.addCallback(defer.drop_param, self._db.wait_connected)
+        d.addCallback(defer.drop_param, self._start)
+        self._restarter = time.callLater(delay, d.callback, None)
+
+    def _data_received(self, connection, data):
+        if connection is not self._connection:
+            # stopped while connecting
+            connection.disconnect()
+            return
+        lines = (self._buffer + data).split("\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            # the empty lines are the heartbeats
+            if line.strip():
+                self._change_received(json.loads(line))
+
+    def _change_received(self, change):
         # The change parameter is just an ugly effect of json unserialization
         # of the couchdb output. It can be many different things, hence the
         # strange logic above.
         if "changes" in change:
             doc_id = change['id']
+            deleted = change.get('deleted', False)
+            doc = change.get('doc')
             for line in change['changes']:
-                # The changes are analized when there is not http request
-                # pending. Otherwise it can result in race condition problem.
-                deleted = line.get('deleted', False)
-                self._db.semaphore.run(self._filter.notified,
-                                       doc_id, line['rev'], deleted)
+                # The changes are analized when there is no http request
+                # pending for the document. Otherwise it can result in race
+                # condition problem.
+                self._db.run_for_document(doc_id, self._db.notify_change,
+                                          doc_id, line['rev'], deleted, doc)
+            self.since = change['seq']
+        elif "last_seq" in change:
+            self.since = change['last_seq']
         else:
             self.info('Bizare notification received from CouchDB: %r', change)
 
-    def connectionLost(self, reason):
-        self._db.connectionLost(reason)
+
+class ViewRowParser(object):
+    '''
+    Incremental parser of a view result. The body is scanned as it is
+    received, every row of the "rows" array is decoded and passed to the
+    callback as soon as it is complete, only the row being received is
+    buffered. The error raised by the callback is kept to be reported
+    by finish(), the data received afterward is ignored.
+    '''
+
+    # characters changing the nesting of the json body
+    _special = re.compile(r'[][{}"\\]')
+    # nesting of the rows: the result object and the rows array
+    _row_depth = 2
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._buffer = ""
+        # position up to which the buffer has been scanned
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._failure = None
+
+    def feed(self, data):
+        if self._failure is not None:
+            return
+        try:
+            self._buffer += data
+            self._scan()
+        except:
+            self._failure = failure.Failure()
+
+    def finish(self):
+        '''Gives the error raised while parsing the rows, if any.'''
+        if self._failure is not None:
+            return self._failure
+        if self._depth:
+            raise ValueError("View result ended in the middle of a row")
+
+    ### private ###
+
+    def _scan(self):
+        buf = self._buffer
+        search = self._special.search
+        position = self._position
+        while True:
+            match = search(buf, position)
+            if match is None:
+                position = len(buf)
+                break
+            char = match.group()
+            position = match.end()
+            if self._in_string:
+                if char == '\\':
+                    # the escaped character might not be received yet
+                    if position == len(buf):
+                        position -= 1
+                        break
+                    position += 1
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '{' and self._depth == self._row_depth:
+                # the rows are decoded at once, not scanned
+                try:
+                    row, position = self._decoder.raw_decode(buf,
+                                                             position - 1)
+                except ValueError:
+                    # not received completely, retried with more data
+                    position -= 1
+                    break
+                self._callback(row)
+            elif char in '[{':
+                self._depth += 1
+            else:
+                self._depth -= 1
+        # only the row being received is kept
+        self._buffer = buf[position:]
+        self._position = 0
 
 
 class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
@@ -112,18 +284,21 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
 
     log_category = "database"
 
-    def __init__(self, host, port, db_name):
+    def __init__(self, host, port, db_name, connections=None,
+                 cache_size=None):
         common.ConnectionManager.__init__(self)
         log.LogProxy.__init__(self, log.FluLogKeeper())
-        ChangeListener.__init__(self, self)
+        ChangeListener.__init__(self, self, cache_size)
 
-        self.semaphore = defer.DeferredSemaphore(1)
-        self.paisley = None
+        self.connections = connections or DEFAULT_DB_CONNECTIONS
+        # doc_id -> DeferredLock serializing the requests and the
+        # change notifications of the document
+        self._document_locks = dict()
+        self.pool = None
         self.db_name = None
         self.host = None
         self.port = None
-        # name -> Notifier
-        self.notifiers = dict()
+        self.feed = ChangeFeed(self)
 
         self.retry = 0
         self.reconnector = None
@@ -133,6 +308,9 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
     def reconfigure(self, host, port, name):
         self._configure(host, port, name)
 
+    def get_stats(self):
+        return self.pool.get_stats() + self.cache.get_stats()
+
     def show_connection_status(self):
         eta = self.reconnector and self.reconnector.active() and \
               time.left(self.reconnector.getTime())
@@ -146,33 +324,108 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
     ### IDatabaseDriver
 
     def open_doc(self, doc_id):
-        return self._paisley_call(self.paisley.openDoc, self.db_name, doc_id)
+        return self.run_for_document(doc_id, self._couchdb_call,
+                                     http.Methods.GET,
+                                     self._doc_location(doc_id))
 
     def save_doc(self, doc, doc_id=None):
-        return self._paisley_call(self.paisley.saveDoc,
-                                  self.db_name, doc, doc_id)
+        if doc_id is None:
+            return self._couchdb_call(http.Methods.POST,
+                                      "/%s/" % (self.db_name, ), doc)
+        return self.run_for_document(doc_id, self._couchdb_call,
+                                     http.Methods.PUT,
+                                     self._doc_location(doc_id), doc)
 
     def delete_doc(self, doc_id, revision):
-        return self._paisley_call(self.paisley.deleteDoc,
-                                  self.db_name, doc_id, revision)
+        location = "%s?%s" % (self._doc_location(doc_id),
+                              urllib.urlencode({'rev': revision}))
+        return self.run_for_document(doc_id, self._couchdb_call,
+                                     http.Methods.DELETE, location)
+
+    def save_docs(self, docs, doc_ids):
+        body = '{"docs": [%s]}' % (", ".join(docs), )
+        return self.run_for_documents(filter(None, doc_ids),
+                                      self._couchdb_call, http.Methods.POST,
+                                      "/%s/_bulk_docs" % (self.db_name, ),
+                                      body)
+
+    def open_docs(self, doc_ids):
+        location = "/%s/_all_docs?include_docs=true" % (self.db_name, )
+        body = json.dumps({"keys": doc_ids})
+        d = self.run_for_documents(doc_ids, self._couchdb_call,
+                                   http.Methods.POST, location, body)
+        d.addCallback(self._parse_all_docs_result)
+        return d
+
+    def delete_docs(self, docs):
+        body = json.dumps({"docs": [{"_id": doc_id, "_rev": revision,
+                                     "_deleted": True}
+                                    for doc_id, revision in docs]})
+        return self.run_for_documents([doc_id for doc_id, _ in docs],
+                                      self._couchdb_call, http.Methods.POST,
+                                      "/%s/_bulk_docs" % (self.db_name, ),
+                                      body)
 
     def create_db(self):
-        return self._paisley_call(self.paisley.createDB,
-                                  self.db_name)
+        return self._couchdb_call(http.Methods.PUT, "/%s" % (self.db_name, ))
 
     def disconnect(self):
         self._cancel_reconnector()
+        self.feed.stop()
+        self.pool.disconnect()
 
     # listen_chagnes from ChangeListener
 
     # cancel_listener from ChangeListener
 
     def query_view(self, factory, **options):
+        rows = []
+        d = self.query_view_rows(
+            factory, lambda key, value, _: rows.append((key, value)),
+            **options)
+        d.addCallback(defer.override_result, rows)
+        return d
+
+    def query_view_rows(self, factory, callback, **options):
         factory = IViewFactory(factory)
-        d = self._paisley_call(self.paisley.openView,
-                               self.db_name, DESIGN_DOC_ID, factory.name,
-                               **options)
-        d.addCallback(self._parse_view_result)
+        location = "/%s/_design/%s/_view/%s" % (
+            self.db_name, urllib.quote(DESIGN_DOC_ID.encode("utf-8")),
+            factory.name)
+        options = dict((k, _encode_view_option(k, v))
+                       for k, v in options.iteritems())
+        body = None
+        if 'keys' in options:
+            # couchdb requires the keys to be passed in a post body
+            body = '{"keys": %s}' % (options.pop('keys'), )
+        if options:
+            location += "?%s" % (urllib.urlencode(options), )
+        method = http.Methods.GET if body is None else http.Methods.POST
+        parser = ViewRowParser(functools.partial(self._view_row_received,
+                                                 callback))
+        d = self._couchdb_call(method, location, body, parser.feed)
+        d.addCallback(defer.drop_param, parser.finish)
+        return d
+
+    def run_for_document(self, doc_id, method, *args, **kwargs):
+        '''
+        Runs the method after the ones run before for the same document
+        are finished. The requests and the change notifications of a
+        document are processed in order, the other documents are not
+        blocked meanwhile.
+        '''
+        return self.run_for_documents([doc_id], method, *args, **kwargs)
+
+    def run_for_documents(self, doc_ids, method, *args, **kwargs):
+        '''
+        Same as run_for_document() for all the documents at once.
+        '''
+        # always locked in the same order, not to wait for each other
+        doc_ids = sorted(set(doc_ids))
+        d = defer.succeed(None)
+        for doc_id in doc_ids:
+            d.addCallback(defer.drop_param, self._lock_document, doc_id)
+        d.addCallback(defer.drop_param, method, *args, **kwargs)
+        d.addBoth(defer.bridge_param, self._unlock_documents, doc_ids)
         return d
 
     def reconnect(self):
@@ -185,62 +438,69 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
                    self.retry, wait)
         if self.reconnector is None or not self.reconnector.active():
             d = defer.Deferred()
-            d.addCallback(defer.drop_param, self._paisley_call,
-                           self.paisley.listDB)
+            d.addCallback(defer.drop_param, self._couchdb_call,
+                           http.Methods.GET, "/_all_dbs")
             d.addErrback(failure.Failure.trap, NotConnectedError)
             self.reconnector = time.callLater(wait, d.callback, None)
             return d
         else:
             return self.wait_connected()
 
+    def get_update_seq(self):
+        '''Gives the sequence number of the last change of the database.'''
+        d = self._couchdb_call(http.Methods.GET, "/%s" % (self.db_name, ))
+        d.addCallback(operator.itemgetter("update_seq"))
+        return d
+
     def connectionLost(self, reason):
-        if reason.check(error.ConnectionDone):
-            # expected just pass
-            return
-        elif reason.check(ResponseDone):
-            self.debug("CouchDB closed the notification listener. This might "
-                       "indicate missconfiguration. Take look at it")
+        # the changes are not received until the feed is restarted
+        self.cache.clear()
+        if reason.check(NotConnectedError):
+            # already handled by the request
             return
         elif reason.check(error.ConnectionRefusedError):
             self.reconnect()
             return
+        elif reason.check(web_error.Error):
+            self.warning("CouchDB refused the changes feed: %s. This might "
+                         "indicate missconfiguration. Take look at it",
+                         reason.getErrorMessage())
+            return
         else:
             # FIXME handle disconnection when network is down
             self._on_disconnected()
             self.warning('Connection to db lost with reason: %r', reason)
             self.reconnect()
-            return self._setup_notifiers()
 
     ### private
 
     def _configure(self, host, port, name):
         self._cancel_reconnector()
         self.host, self.port = host, port
-        self.paisley = CouchDB(host, port)
+        if self.pool is not None:
+            self.pool.disconnect()
+        self.pool = httpclient.ConnectionPool(
+            host, port, logger=self, max_connections=self.connections)
         self.db_name = name
+        self.cache.clear()
 
-        [notifier.reconfigure() for notifier in self.notifiers.values()]
+        self.feed.reset()
         self.reconnect()
         self._setup_notifiers()
 
-    def _parse_view_result(self, resp):
-        assert "rows" in resp
+    def _parse_all_docs_result(self, resp):
+        return [row.get("doc") for row in resp["rows"]]
 
-        for row in resp["rows"]:
-            yield row["key"], row["value"]
+    def _view_row_received(self, callback, row):
+        callback(row["key"], row["value"], row.get("id"))
 
     def _setup_notifiers(self):
-        defers = list()
-        for notifier in self.notifiers.values():
-            defers.append(notifier.setup())
-        return defer.DeferredList(defers, consumeErrors=True)
+        return self.feed.setup(self._is_listening(), self._needs_documents())
 
     def _setup_notifier(self, filter_):
-        self.log('Setting up the notifier %s', filter_.name)
-        notifier = self.notifiers.get(filter_.name) or Notifier(self, filter_)
-        self.notifiers[filter_.name] = notifier
-
-        return notifier.setup()
+        # all the filters share the same feed
+        self.log('Setting up the changes feed for %s', filter_.name)
+        return self._setup_notifiers()
 
     def _on_connected(self):
         common.ConnectionManager._on_connected(self)
@@ -253,15 +513,43 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
             self.reconnector = None
             self.retry = 0
 
-    def _paisley_call(self, method, *args, **kwargs):
-        # It is necessarry to acquire the lock to perform the http request
-        # because we need to be sure that we are not in the middle of sth
-        # while analizing the change notification
-        d = self.semaphore.run(method, *args, **kwargs)
+    def _doc_location(self, doc_id):
+        # the request line is sent as is, it cannot be unicode
+        if isinstance(doc_id, unicode):
+            doc_id = doc_id.encode("utf-8")
+        return "/%s/%s" % (self.db_name, urllib.quote(doc_id))
+
+    def _lock_document(self, doc_id):
+        lock = self._document_locks.get(doc_id)
+        if lock is None:
+            lock = defer.DeferredLock()
+            self._document_locks[doc_id] = lock
+        return lock.acquire()
+
+    def _unlock_documents(self, doc_ids):
+        for doc_id in doc_ids:
+            lock = self._document_locks[doc_id]
+            lock.release()
+            # the waiting calls may have finished meanwhile
+            if not lock.locked and self._document_locks.get(doc_id) is lock:
+                del self._document_locks[doc_id]
+
+    def _couchdb_call(self, method, location, body=None, consumer=None):
+        headers = {"accept": "application/json",
+                   "content-type": "application/json"}
+        d = self.pool.request(method, location, headers, body, consumer)
+        d.addCallback(self._parse_response)
         d.addCallback(defer.bridge_param, self._on_connected)
         d.addErrback(self._error_handler)
         return d
 
+    def _parse_response(self, response):
+        status = int(response.status)
+        if status >= 400:
+            raise web_error.Error(status, response.body)
+        if response.body is not None:
+            return json.loads(response.body)
+
     def _error_handler(self, failure):
         exception = failure.value
         msg = failure.getErrorMessage()
@@ -280,5 +568,18 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
             self._on_disconnected()
             self.reconnect()
             raise NotConnectedError("Database connection refused.")
+        elif failure.check(httpclient.RequestError):
+            self._on_disconnected()
+            self.reconnect()
+            raise NotConnectedError("Database connection lost: %s" % (msg, ))
         else:
             failure.raiseException()
+
+
+def _encode_view_option(name, value):
+    # the document ids are passed as they are, the request is not unicode
+    if name not in VIEW_DOCID_OPTIONS:
+        return json.dumps(value)
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
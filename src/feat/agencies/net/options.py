@@ -25,9 +25,21 @@ import os
 
 from feat.common import reflect
 
+from feat.agencies.journaler import DEFAULT_FLUSH_SIZE
+from feat.agencies.journaler import DEFAULT_FLUSH_INTERVAL
+from feat.agencies.journaler import DEFAULT_SYNCHRONOUS
+from feat.agencies.journaler import DEFAULT_HIGH_WATER_MARK
+from feat.agencies.messaging.net import DEFAULT_BATCH_SIZE
+from feat.agencies.messaging.net import DEFAULT_BATCH_WINDOW
+from feat.agencies.messaging.net import DEFAULT_PREFETCH_COUNT
+from feat.agencies.messaging.net import DEFAULT_ACK_INTERVAL
+from feat.agencies.messaging.net import DEFAULT_POOL_CONNECTIONS
+from feat.agencies.messaging.net import DEFAULT_POOL_CHANNELS
 from feat.agencies.net.broker import DEFAULT_SOCKET_PATH
 from feat.agencies.net.database import DEFAULT_DB_HOST, DEFAULT_DB_PORT
 from feat.agencies.net.database import DEFAULT_DB_NAME
+from feat.agencies.net.database import DEFAULT_DB_CONNECTIONS
+from feat.agencies.database import DEFAULT_CACHE_SIZE
 
 DEFAULT_MSG_HOST = "localhost"
 DEFAULT_MSG_PORT = 5672
@@ -35,6 +47,7 @@ DEFAULT_MSG_USER = "guest"
 DEFAULT_MSG_PASSWORD = "guest"
 
 DEFAULT_JOURFILE = 'journal.sqlite3'
+DEFAULT_JOURNAL_BACKEND = 'sqlite'
 
 DEFAULT_GW_PORT = 5500
 DEFAULT_GW_P12_FILE = "/etc/feat/gateway.p12"
@@ -92,6 +105,31 @@ def add_agency_options(parser):
                      action="store", dest="agency_journal",
                      help=("journal filename (default: %s)"
                            % DEFAULT_JOURFILE))
+    group.add_option('--journal-backend', type="choice",
+                     choices=("sqlite", "segments"),
+                     action="store", dest="agency_journal_backend",
+                     help=("journal storage, either a sqlite database or "
+                           "a directory of per agent segment files "
+                           "(default: %s)" % DEFAULT_JOURNAL_BACKEND))
+    group.add_option('--journal-flush-size', type="int",
+                     action="store", dest="agency_journal_flush_size",
+                     help=("maximum number of journal entries written "
+                           "in one transaction (default: %s)"
+                           % DEFAULT_FLUSH_SIZE))
+    group.add_option('--journal-flush-interval', type="float",
+                     action="store", dest="agency_journal_flush_interval",
+                     help=("seconds to wait for more journal entries "
+                           "before writing them (default: %s)"
+                           % DEFAULT_FLUSH_INTERVAL))
+    group.add_option('--journal-synchronous',
+                     action="store", dest="agency_journal_synchronous",
+                     help=("sqlite synchronous mode used for the journal "
+                           "(default: %s)" % DEFAULT_SYNCHRONOUS))
+    group.add_option('--journal-high-water-mark', type="int",
+                     action="store", dest="agency_journal_high_water_mark",
+                     help=("number of journal entries waiting to be written "
+                           "kept in memory, the rest is spilled to the "
+                           "rundir (default: %s)" % DEFAULT_HIGH_WATER_MARK))
     group.add_option('-S', '--socket-path', dest="agency_socket_path",
                      help=("path to the unix socket used by the agency"
                            "(default: %s)" % DEFAULT_SOCKET_PATH),
@@ -152,6 +190,35 @@ def add_msg_options(parser):
                      help=("password to messaging server (default: %s)" %
                            DEFAULT_MSG_PASSWORD),
                      metavar="PASSWORD")
+    group.add_option('--msg-batch-size', type="int", dest="msg_batch_size",
+                     help=("maximum number of messages published or "
+                           "acknowledged in one transaction (default: %s)"
+                           % DEFAULT_BATCH_SIZE))
+    group.add_option('--msg-batch-window', type="float",
+                     dest="msg_batch_window",
+                     help=("seconds to wait for more messages before "
+                           "publishing them (default: %s)"
+                           % DEFAULT_BATCH_WINDOW))
+    group.add_option('--msg-prefetch-count', type="int",
+                     dest="msg_prefetch_count",
+                     help=("number of unacknowledged messages the server "
+                           "sends to a consumer, 0 for no limit "
+                           "(default: %s)" % DEFAULT_PREFETCH_COUNT))
+    group.add_option('--msg-ack-interval', type="float",
+                     dest="msg_ack_interval",
+                     help=("maximum seconds to wait before acknowledging "
+                           "the delivered messages (default: %s)"
+                           % DEFAULT_ACK_INTERVAL))
+    group.add_option('--msg-pool-connections', type="int",
+                     dest="msg_pool_connections",
+                     help=("number of connections used to publish the "
+                           "messages (default: %s)"
+                           % DEFAULT_POOL_CONNECTIONS))
+    group.add_option('--msg-pool-channels', type="int",
+                     dest="msg_pool_channels",
+                     help=("number of channels of each connection used to "
+                           "publish the messages (default: %s)"
+                           % DEFAULT_POOL_CHANNELS))
     parser.add_option_group(group)
 
 
@@ -189,6 +256,16 @@ def add_db_options(parser):
                      help=("host of database server to connect to "
                            "(default: %s)" % DEFAULT_DB_NAME),
                      metavar="NAME")
+    group.add_option('--dbconnections', dest="db_connections",
+                     help=("maximum number of requests done at the same "
+                           "time to the database server (default: %s)"
+                           % DEFAULT_DB_CONNECTIONS),
+                     metavar="COUNT", type="int")
+    group.add_option('--dbcache-size', dest="db_cache_size",
+                     help=("maximum number of documents kept by the "
+                           "document cache of the agency, 0 disables it "
+                           "(default: %s)" % DEFAULT_CACHE_SIZE),
+                     metavar="COUNT", type="int")
     parser.add_option_group(group)
 
 
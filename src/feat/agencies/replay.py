@@ -43,6 +43,10 @@ from feat.interface.collector import IAgencyCollector
 from feat.interface.poster import IAgencyPoster
 
 
+# Number of entries between the calls to the progress callback
+DEFAULT_PROGRESS_STEP = 1000
+
+
 def side_effect_as_string(*args):
     '''
     side_effect_as_string() -> "ANY_FUNCTION(ANY_ARGS, ANY_KWARGS)"
@@ -278,17 +282,37 @@ class JournalReplayEntry(object):
 class Replay(log.FluLogKeeper, log.Logger):
     '''
     Class managing the replay of the single agent.
+
+    The journal is consumed one entry at a time, so it can be a cursor
+    streaming the entries from the journal file. Created with the cursor
+    starting from the latest snapshot, the replay begins with the state
+    restored from the snapshot.
     '''
 
     log_category = 'replay'
 
     implements(IExternalizer, IEffectHandler)
 
-    def __init__(self, journal, agent_id, inject_dummy_externals=False):
+    def __init__(self, journal, agent_id, inject_dummy_externals=False,
+                 on_progress=None, progress_step=DEFAULT_PROGRESS_STEP):
+        '''
+        @param journal: Iterator over the journal entries.
+        @param on_progress: Optional callable called with the number of
+                            entries read and the total number of entries
+                            (None if the journal doesn't know its length)
+                            every progress_step entries and at the end.
+        '''
         log.FluLogKeeper.__init__(self)
         log.Logger.__init__(self, self)
 
         self.journal = journal
+        self.position = 0
+        try:
+            self.total = len(journal)
+        except TypeError:
+            self.total = None
+        self._on_progress = on_progress
+        self._progress_step = progress_step
         self.unserializer = banana.Unserializer(externalizer=self)
         self.serializer = banana.Serializer(externalizer=self)
         self.inject_dummy_externals = inject_dummy_externals
@@ -339,6 +363,13 @@ class Replay(log.FluLogKeeper, log.Logger):
     def get_agent_type(self):
         return self.agent_type
 
+    def get_progress(self):
+        '''
+        Returns the tuple of (entries read, total entries), the total is
+        None if the journal doesn't know its length.
+        '''
+        return self.position, self.total
+
     ### endof public section ###
 
     def get_time(self):
@@ -370,9 +401,20 @@ class Replay(log.FluLogKeeper, log.Logger):
         return self
 
     def next(self):
-        record = self.journal.next()
+        try:
+            record = self.journal.next()
+        except StopIteration:
+            self._report_progress()
+            raise
+        self.position += 1
+        if self.position % self._progress_step == 0:
+            self._report_progress()
         return JournalReplayEntry(self, record)
 
+    def _report_progress(self):
+        if self._on_progress is not None:
+            self._on_progress(self.position, self.total)
+
     def _log_entry(self, entry):
         self.log("<----------------- Applying entry:\n%s",
                  entry.to_string("  "))
@@ -772,6 +814,18 @@ class AgencyAgent(BaseReplayDummy):
     def delete_document(self, document):
         raise RuntimeError('This should never be called!')
 
+    @serialization.freeze_tag('AgencyAgency.save_documents')
+    def save_documents(self, documents):
+        raise RuntimeError('This should never be called!')
+
+    @serialization.freeze_tag('AgencyAgency.get_documents')
+    def get_documents(self, document_ids):
+        raise RuntimeError('This should never be called!')
+
+    @serialization.freeze_tag('AgencyAgency.delete_documents')
+    def delete_documents(self, documents):
+        raise RuntimeError('This should never be called!')
+
     @serialization.freeze_tag('AgencyAgent.register_change_listener')
     @replay.named_side_effect('AgencyAgent.register_change_listener')
     def register_change_listener(self, filter_, callback):
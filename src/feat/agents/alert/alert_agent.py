@@ -68,6 +68,7 @@ class AlertNagiosConfiguration(AlertSenderConfiguration):
 class AlertAgentConfiguration(document.Document):
 
     document_type = 'alert_agent_conf'
+    cached = True
     document.field('doc_id', u'alert_agent_conf', '_id')
     document.field('mail_config', AlertMailConfiguration())
     document.field('nagios_config', AlertNagiosConfiguration())
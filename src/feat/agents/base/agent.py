@@ -438,6 +438,18 @@ class BaseAgent(mro.FiberMroMixin, log.Logger, log.LogProxy, replay.Replayable,
     def save_document(self, state, doc):
         return fiber.wrap_defer(state.medium.save_document, doc)
 
+    @replay.immutable
+    def get_documents(self, state, doc_ids):
+        return fiber.wrap_defer(state.medium.get_documents, doc_ids)
+
+    @replay.immutable
+    def save_documents(self, state, docs):
+        return fiber.wrap_defer(state.medium.save_documents, docs)
+
+    @replay.immutable
+    def delete_documents(self, state, docs):
+        return fiber.wrap_defer(state.medium.delete_documents, docs)
+
     @update_descriptor
     def update_descriptor(self, state, desc, method, *args, **kwargs):
         return method(desc, *args, **kwargs)
@@ -48,5 +48,9 @@ field = formatable.field
 @serialization.register
 class Document(formatable.Formatable):
 
+    # documents of the types setting it are kept by the document cache
+    # of the agency, until a change to them is received from the database
+    cached = False
+
     field('doc_id', None, '_id')
     field('rev', None, '_rev')
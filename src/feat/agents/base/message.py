@@ -41,6 +41,39 @@ class FirstMessageMixin(formatable.Formatable):
     formatable.field('traversal_id', None)
 
 
+# fields which differ between the envelopes of a message
+ENVELOPE_FIELDS = ('recipient', 'message_id')
+
+
+class Templates(object):
+    """Serialized forms of the fields shared by the envelopes of
+    a message, one for each serializer. Copying a message keeps
+    the reference to them."""
+
+    def __init__(self):
+        self._templates = {} # {SERIALIZER: TEMPLATE}
+
+    def get(self, message, serializer):
+        template = self._templates.get(serializer)
+        if template is None:
+            template = serializer.template(message, ENVELOPE_FIELDS)
+            self._templates[serializer] = template
+        return template
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        # the serialized forms are only valid in this process
+        return {}
+
+    def __setstate__(self, state):
+        self._templates = {}
+
+
 @serialization.register
 class BaseMessage(formatable.Formatable):
 
@@ -52,6 +85,9 @@ class BaseMessage(formatable.Formatable):
     formatable.field('expiration_time', None)
     formatable.field('payload', dict())
 
+    # set for the envelopes sharing their fields, not serialized
+    _templates = None
+
     def clone(self):
         """Returns an exact copy of the message.
         KNOW WAT YOU ARE DOING, some special fields
@@ -63,8 +99,28 @@ class BaseMessage(formatable.Formatable):
         and use for another message."""
         msg = self.clone()
         msg.message_id = None
+        msg._templates = None
         return msg
 
+    def envelope(self, recipient):
+        """Returns a copy of the message for the recipient sharing all
+        the other fields with it, they SHOULD NOT be modified anymore.
+        The envelopes of a message are serialized from the same
+        template, see serialize()."""
+        if self._templates is None:
+            self._templates = Templates()
+        msg = copy.copy(self)
+        msg.recipient = recipient
+        return msg
+
+    def serialize(self, serializer):
+        """Serializes the message, reusing the serialized form of the
+        fields it shares with the other envelopes if the serializer
+        supports templates."""
+        if self._templates is None or not hasattr(serializer, "template"):
+            return serializer.convert(self)
+        return self._templates.get(self, serializer).complete(self)
+
     def duplication_recipient(self):
         '''Returns a recipient to whom the duplication
         message should be send or None.'''
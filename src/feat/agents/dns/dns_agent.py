@@ -61,6 +61,7 @@ class NotifyConfiguration(formatable.Formatable):
 class DNSAgentConfiguration(document.Document):
 
     document_type = 'dns_agent_conf'
+    cached = True
     document.field('doc_id', u'dns_agent_conf', '_id')
     document.field('ns_ttl', DEFAULT_NS_TTL)
     document.field('aa_ttl', DEFAULT_AA_TTL)
@@ -88,6 +89,7 @@ class Descriptor(descriptor.Descriptor):
 class DnsName(document.Document):
 
     document_type = 'dns_name'
+    cached = True
 
     # dns zone this name belongs to
     document.field('zone', None)
@@ -851,6 +851,7 @@ class Migration(replay.Replayable):
 class ExportAgentConfiguration(document.Document):
 
     document_type = 'export_agent_conf'
+    cached = True
     document.field('doc_id', u'export_agent_conf', '_id')
     document.field('notification_period', 12)
     document.field('default_host_cmd', '/bin/true')
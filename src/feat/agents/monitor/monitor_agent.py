@@ -142,6 +142,7 @@ class Partners(agent.Partners):
 class MonitorAgentConfiguration(document.Document):
 
     document_type = 'monitor_agent_conf'
+    cached = True
     document.field('doc_id', u'monitor_agent_conf', '_id')
     document.field('heartbeat_period', DEFAULT_HEARTBEAT_PERIOD)
     document.field('heartbeat_death_skips', DEFAULT_DEATH_SKIPS)
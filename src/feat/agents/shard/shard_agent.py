@@ -158,6 +158,7 @@ class ShardAgentRole(enum.Enum):
 class ShardAgentConfiguration(document.Document):
 
     document_type = 'shard_agent_conf'
+    cached = True
     document.field('doc_id', u'shard_agent_conf', '_id')
     document.field('hosts_per_shard', 10)
     document.field('neighbours', 3)
@@ -28,7 +28,7 @@ from feat.interface.generic import ITimeProvider
 
 
 __all__ = ("MroDict", "MroList", "MroDictOfList",
-           "Empty", "ExpDict", "ExpQueue")
+           "Empty", "ExpDict", "ExpQueue", "ExpSet")
 
 PRECISION = 1e3
 MAX_LAZY_PACK_PER_SECOND = 1
@@ -709,6 +709,112 @@ class ExpQueue(ExpBase):
         self._last_pack = now
 
 
+class ExpSet(object):
+    """
+    Set of keys forgotten after their expiration time, meant for tracking
+    the identifiers already seen. The keys are grouped in generations
+    covering a period of time each, a generation is dropped at once when
+    all its keys expired. A key is not contained anymore once it expired,
+    even if its generation has not been dropped yet.
+    """
+
+    DEFAULT_PERIOD = 10
+
+    __slots__ = ("_time", "_period", "_index", "_generations", "_heap")
+
+    def __init__(self, time_provider, period=None):
+        '''Create an expiration set.
+        @param time_provider: who provide the time
+        @type time_provider: L{ITimeProvider}
+        @param period: seconds of expiration time covered by a generation
+        @type period: float'''
+        self._time = ITimeProvider(time_provider)
+        self._period = period or self.DEFAULT_PERIOD
+        self._index = {} # {KEY: EXPIRATION or None}
+        self._generations = {} # {GENERATION: [KEY]}
+        self._heap = [] # [GENERATION]
+
+    def clear(self):
+        '''Removes all the keys from the set.'''
+        self._index.clear()
+        self._generations.clear()
+        self._heap = []
+
+    def pack(self):
+        '''Packs the set by removing the expired generations.'''
+        self._pack(self._time.get_time())
+
+    def add(self, key, expiration=None, relative=False):
+        '''Adds a key to the set with specified expiration.
+        @param key: unique key to remember
+        @type key: any immutable
+        @param expiration: the time at which the key will expire.
+        @type expiration: float
+        @param relative: if the specified expiration time is relative
+                         to EPOC UTC or from now.
+        @type relative: bool
+        @return: nothing'''
+        now = self._time.get_time()
+        self._pack(now)
+        if expiration is not None:
+            if relative:
+                expiration = now + expiration
+            if expiration <= now:
+                return
+            generation = self._generation(expiration)
+            keys = self._generations.get(generation)
+            if keys is None:
+                keys = []
+                self._generations[generation] = keys
+                heapq.heappush(self._heap, generation)
+            keys.append(key)
+        # a key added again is only dropped with the generation
+        # of its last expiration time
+        self._index[key] = expiration
+
+    def size(self):
+        '''Returns the current size counting expired keys.'''
+        return len(self._index)
+
+    def __contains__(self, key):
+        now = self._time.get_time()
+        self._pack(now)
+        if key not in self._index:
+            return False
+        return not self._expired(self._index[key], now)
+
+    def __len__(self):
+        # Only the keys of the generation covering the current time
+        # can be expired, the other generations are not looked at
+        now = self._time.get_time()
+        self._pack(now)
+        index = self._index
+        keys = self._generations.get(self._generation(now), ())
+        expired = set(key for key in keys if self._expired(index[key], now))
+        return len(index) - len(expired)
+
+    ### Private Methods ###
+
+    def _generation(self, expiration):
+        # the generation G holds the keys expiring before G * period
+        return int(expiration // self._period) + 1
+
+    def _pack(self, now):
+        current = now // self._period
+        heap = self._heap
+        index = self._index
+        while heap and heap[0] <= current:
+            generation = heapq.heappop(heap)
+            for key in self._generations.pop(generation):
+                expiration = index.get(key)
+                if (expiration is not None
+                    and self._generation(expiration) == generation):
+                    del index[key]
+
+    def _expired(self, expiration, now):
+        return expiration is not None and expiration <= now
+
+
 ## Private Stuff ###
 
 
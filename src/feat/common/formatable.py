@@ -22,9 +22,16 @@
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
 import copy
+import itertools
+import operator
+import types
 
 from feat.common import serialization, annotate
 
+# Types of the default values that do not need to be copied
+IMMUTABLE_TYPES = (types.NoneType, bool, int, long, float,
+                   str, unicode, tuple, frozenset)
+
 
 class Field(object):
 
@@ -37,6 +44,28 @@ class Field(object):
         return "%r default %r" % (self.name, self.default, )
 
 
+class Layout(object):
+    """Fields of a formatable class in the form needed by snapshot()
+    and recover(), computed once instead of walking the fields every
+    time an instance is serialized."""
+
+    def __init__(self, fields):
+        self.names = frozenset(f.name for f in fields)
+        self.keys = tuple(f.serialize_as for f in fields)
+        # (NAME, SERIALIZE_AS, DEFAULT, MUTABLE)
+        self.fields = tuple((f.name, f.serialize_as, f.default,
+                             not isinstance(f.default, IMMUTABLE_TYPES))
+                            for f in fields)
+        names = [f.name for f in fields]
+        if len(names) > 1:
+            self.getter = operator.attrgetter(*names)
+        elif names:
+            getter = operator.attrgetter(names[0])
+            self.getter = lambda obj: (getter(obj), )
+        else:
+            self.getter = lambda obj: ()
+
+
 def field(name, default, serialize_as=None):
     f = Field(name, default, serialize_as)
     annotate.injectClassCallback("field", 3, "_register_field", f)
@@ -54,6 +83,7 @@ class Formatable(serialization.Serializable, annotate.Annotable):
     @classmethod
     def __class__init__(cls, name, bases, dct):
         cls._fields = list()
+        cls._layout = None
 
         for base in bases:
             if not issubclass(type(base), MetaFormatable):
@@ -65,6 +95,16 @@ class Formatable(serialization.Serializable, annotate.Annotable):
         # remove field with this name if already present (overriding defaults)
         [cls._fields.remove(x) for x in cls._fields if x.name == field.name]
         cls._fields.append(field)
+        cls._layout = None
+
+    @classmethod
+    def _get_layout(cls):
+        # Fields are registered after the class initialization,
+        # so the layout is built the first time it is needed
+        layout = cls._layout
+        if layout is None:
+            layout = cls._layout = Layout(cls._fields)
+        return layout
 
     def __init__(self, **fields):
         self._set_fields(fields)
@@ -73,20 +113,22 @@ class Formatable(serialization.Serializable, annotate.Annotable):
         return "<%s %r>" % (type(self).__name__, self.snapshot(), )
 
     def _set_fields(self, dictionary):
+        layout = self._layout or self._get_layout()
         for key in dictionary:
-            find = [x for x in self._fields if x.name == key]
-            if len(find) != 1:
+            if key not in layout.names:
                 raise AttributeError(
                     "Class %r doesn't have the %r attribute." %\
                     (type(self), key, ))
 
-        for field in self._fields:
+        for name, _key, default, mutable in layout.fields:
             # lazy coping of default value, don't touch!
-            if field.name in dictionary:
-                value = dictionary[field.name]
+            if name in dictionary:
+                value = dictionary[name]
+            elif mutable:
+                value = copy.copy(default)
             else:
-                value = copy.copy(field.default)
-            setattr(self, field.name, value)
+                value = default
+            setattr(self, name, value)
 
     def __eq__(self, other):
         if type(self) != type(other):
@@ -104,18 +146,21 @@ class Formatable(serialization.Serializable, annotate.Annotable):
     # ISerializable
 
     def snapshot(self):
+        layout = self._layout or self._get_layout()
         res = dict()
-        for field in self._fields:
-            value = getattr(self, field.name)
+        for key, value in itertools.izip(layout.keys, layout.getter(self)):
             if value is not None:
-                res[field.serialize_as] = value
+                res[key] = value
         return res
 
     def recover(self, snapshot):
-        for field in self._fields:
+        layout = self._layout or self._get_layout()
+        for name, key, default, mutable in layout.fields:
             # lazy coping of default value, don't touch!
-            if field.serialize_as in snapshot:
-                value = snapshot[field.serialize_as]
+            if key in snapshot:
+                value = snapshot[key]
+            elif mutable:
+                value = copy.copy(default)
             else:
-                value = copy.copy(field.default)
-            setattr(self, field.name, value)
+                value = default
+            setattr(self, name, value)
@@ -21,44 +21,94 @@
 # Headers in this file shall remain intact.
 from __future__ import absolute_import
 
-from cStringIO import StringIO
+import re
+import struct
 
 from twisted.spread import banana
 
 from feat.common.serialization import sexp
 from feat.interface.serialization import *
 
+# Limits of the values, the same than twisted's banana protocol
+PREFIX_LIMIT = 64
+SIZE_LIMIT = banana.SIZE_LIMIT
+SMALLEST_LONG_INT = -2 ** (PREFIX_LIMIT * 7) + 1
+SMALLEST_INT = -2 ** 31
+LARGEST_INT = 2 ** 31 - 1
+LARGEST_LONG_INT = 2 ** (PREFIX_LIMIT * 7) - 1
+
+LIST = banana.LIST
+INT = banana.INT
+STRING = banana.STRING
+NEG = banana.NEG
+FLOAT = banana.FLOAT
+LONGINT = banana.LONGINT
+LONGNEG = banana.LONGNEG
+VOCAB = banana.VOCAB
+
+# Strings sent as a symbol by the "pb" dialect
+OUTGOING_VOCABULARY = dict(banana.Banana.outgoingVocabulary)
+INCOMING_VOCABULARY = dict(banana.Banana.incomingVocabulary)
+
+BananaError = banana.BananaError
 
-class BananaCodec(object):
 
-    def __init__(self):
-        self._banana = banana.Banana()
-        self._banana.connectionMade()
-        self._banana._selectDialect("pb") # More compact
+class BananaCodec(object):
+    """Encodes and decodes the lists s-expressions to and from
+    the "pb" dialect of twisted's banana protocol, without the need
+    of a protocol instance. Kept for the code creating a codec,
+    the module functions can be used directly."""
 
     def encode(self, lst):
-        io = StringIO()
-        self._banana.transport = io
-        self._banana.sendEncoded(lst)
-        return io.getvalue()
+        return encode(lst)
 
     def decode(self, data):
-        heap = []
-        self._banana.expressionReceived = heap.append
-        try:
-            self._banana.dataReceived(data)
-        finally:
-            self._banana.buffer = ''
-            del self._banana.expressionReceived
-        return heap[0]
+        return decode(data)
+
+    def decode_many(self, data):
+        return decode_many(data)
+
+
+def encode(lst):
+    """Encodes a list s-expression in a single pass."""
+    parts = []
+    _encode(lst, parts.append)
+    return "".join(parts)
+
+
+def decode(data):
+    """Decodes the first s-expression of the data."""
+    value, _pos = _decode(data, 0)
+    return value
+
+
+def decode_many(data):
+    """Decodes all the s-expressions of concatenated encoded data."""
+    result = []
+    pos = 0
+    length = len(data)
+    while pos < length:
+        value, pos = _decode(data, pos)
+        result.append(value)
+    return result
 
 
 class Serializer(sexp.Serializer, BananaCodec):
 
-    def __init__(self, externalizer=None, source_ver=None, target_ver=None):
+    def __init__(self, externalizer=None, source_ver=None, target_ver=None,
+                 acyclic=False):
         sexp.Serializer.__init__(self, externalizer=externalizer,
-                                 source_ver=source_ver, target_ver=target_ver)
-        BananaCodec.__init__(self)
+                                 source_ver=source_ver, target_ver=target_ver,
+                                 acyclic=acyclic)
+
+    ### public ###
+
+    def template(self, instance, fields):
+        """Returns a L{Template} of the serializable instance with
+        all its fields but the specified ones."""
+        if self._source_ver is not None:
+            raise ValueError("Templates do not support version adaptation")
+        return Template(self, instance, fields)
 
     ### Overridden Methods ###
 
@@ -66,6 +116,46 @@ class Serializer(sexp.Serializer, BananaCodec):
         return self.encode(data)
 
 
+class Template(object):
+    """Serialized form of an instance missing some of its fields.
+    Completing it only serializes the missing fields of the given
+    instance, so instances sharing the other fields are serialized
+    without doing it again. The result is the same than serializing
+    the instance, but values shared between the missing fields and the
+    other ones are not referenced, they are serialized twice."""
+
+    def __init__(self, serializer, instance, fields):
+        self._serializer = serializer
+        self._fields = tuple(fields)
+        snapshot = instance.snapshot()
+        shared = dict((k, v) for k, v in snapshot.iteritems()
+                      if k not in self._fields)
+        self._type_name = encode(instance.type_name)
+        self._size = len(shared)
+        self._items = self._strip(serializer.convert(shared), self._size)
+
+    def complete(self, instance):
+        """Returns the serialized instance."""
+        snapshot = instance.snapshot()
+        missing = dict((k, snapshot[k]) for k in self._fields
+                       if k in snapshot)
+        items = self._strip(self._serializer.convert(missing), len(missing))
+        size = self._size + len(missing) + 1
+        return "".join([_list_of_two, self._type_name,
+                        _int2b128(size), LIST, _dict_atom,
+                        self._items, items])
+
+    ### private ###
+
+    def _strip(self, data, size):
+        # removes the dictionary header to keep the encoded items
+        header = _int2b128(size + 1) + LIST + _dict_atom
+        if not data.startswith(header):
+            raise ValueError("Unexpected serialized dictionary: %r"
+                             % (data[:len(header)], ))
+        return data[len(header):]
+
+
 class Unserializer(sexp.Unserializer, BananaCodec):
 
     def __init__(self, registry=None, externalizer=None,
@@ -74,7 +164,6 @@ class Unserializer(sexp.Unserializer, BananaCodec):
                                    externalizer=externalizer,
                                    source_ver=source_ver,
                                    target_ver=target_ver)
-        BananaCodec.__init__(self)
 
     ### Overridden Methods ###
 
@@ -99,5 +188,132 @@ def unserialize(data):
 
 ### Private Stuff ###
 
+_prefix = re.compile(r"[\x00-\x7f]*")
+_float = struct.Struct("!d")
+_small_prefixes = [chr(x) for x in xrange(128)]
+
+
+def _int2b128(integer):
+    if integer < 128:
+        return _small_prefixes[integer]
+    digits = []
+    while integer:
+        digits.append(_small_prefixes[integer & 0x7f])
+        integer >>= 7
+    return "".join(digits)
+
+
+def _b1282int(prefix):
+    result = 0
+    shift = 0
+    for char in prefix:
+        result |= ord(char) << shift
+        shift += 7
+    return result
+
+
+def _encode(obj, write):
+    if isinstance(obj, str):
+        symbol = OUTGOING_VOCABULARY.get(obj)
+        if symbol is not None:
+            write(_int2b128(symbol))
+            write(VOCAB)
+            return
+        if len(obj) > SIZE_LIMIT:
+            raise BananaError("string is too long to send (%d)" % (len(obj), ))
+        write(_int2b128(len(obj)))
+        write(STRING)
+        write(obj)
+    elif isinstance(obj, (list, tuple)):
+        if len(obj) > SIZE_LIMIT:
+            raise BananaError("list/tuple is too long to send (%d)"
+                              % (len(obj), ))
+        write(_int2b128(len(obj)))
+        write(LIST)
+        for elem in obj:
+            _encode(elem, write)
+    elif isinstance(obj, (int, long)):
+        if obj < 0:
+            if obj < SMALLEST_LONG_INT:
+                raise BananaError("int/long is too large to send (%d)"
+                                  % (obj, ))
+            write(_int2b128(-obj))
+            write(LONGNEG if obj < SMALLEST_INT else NEG)
+        else:
+            if obj > LARGEST_LONG_INT:
+                raise BananaError("int/long is too large to send (%d)"
+                                  % (obj, ))
+            write(_int2b128(obj))
+            write(INT if obj <= LARGEST_INT else LONGINT)
+    elif isinstance(obj, float):
+        write(FLOAT)
+        write(_float.pack(obj))
+    else:
+        raise BananaError("could not send object: %r" % (obj, ))
+
+
+def _decode(data, pos):
+    stack = [] # [[LENGTH, ITEMS]]
+    length = len(data)
+    while True:
+        end = _prefix.match(data, pos).end()
+        if end - pos > PREFIX_LIMIT:
+            raise BananaError("Security precaution: longer than %d bytes "
+                              "worth of prefix" % (PREFIX_LIMIT, ))
+        if end >= length:
+            raise BananaError("Incomplete banana data")
+        if end - pos == 1:
+            num = ord(data[pos])
+        else:
+            num = _b1282int(data[pos:end])
+        typebyte = data[end]
+        pos = end + 1
+
+        if typebyte == STRING:
+            if num > SIZE_LIMIT:
+                raise BananaError("Security precaution: String too long.")
+            end = pos + num
+            if end > length:
+                raise BananaError("Incomplete banana data")
+            item = data[pos:end]
+            pos = end
+        elif typebyte == LIST:
+            if num > SIZE_LIMIT:
+                raise BananaError("Security precaution: List too long.")
+            if num:
+                stack.append([num, []])
+                continue
+            item = []
+        elif typebyte == INT or typebyte == LONGINT:
+            item = num
+        elif typebyte == NEG or typebyte == LONGNEG:
+            item = -num
+        elif typebyte == VOCAB:
+            try:
+                item = INCOMING_VOCABULARY[num]
+            except KeyError:
+                raise BananaError("Unknown symbol %d" % (num, ))
+        elif typebyte == FLOAT:
+            end = pos + 8
+            if end > length:
+                raise BananaError("Incomplete banana data")
+            item, = _float.unpack_from(data, pos)
+            pos = end
+        else:
+            raise BananaError("Invalid type byte %r" % (typebyte, ))
+
+        while stack:
+            expected, items = stack[-1]
+            items.append(item)
+            if len(items) < expected:
+                break
+            stack.pop()
+            item = items
+        else:
+            return item, pos
+
+_list_of_two = _small_prefixes[2] + LIST
+_dict_atom = encode(sexp.DICT_ATOM)
+
 _serializer = Serializer()
 _unserializer = Unserializer()
@@ -25,6 +25,7 @@ import types
 
 from zope.interface import implements
 from zope.interface.interface import InterfaceClass
+from twisted.python import components
 
 from feat.common import decorator, enum, adapter, reflect
 from feat.interface.serialization import ISerializable, Capabilities
@@ -236,6 +237,34 @@ class Registry(object):
         return self._restorators.get(type_name)
 
 
+class ConverterPool(object):
+    """Reuses the converters created with the same parameters instead
+    of creating a new one for every conversion. The parameters are
+    given as keyword arguments and must be hashable. A converter is taken
+    out of the pool for the time of the conversion, so nested conversions
+    never share the same instance. It should only be used from
+    the reactor thread."""
+
+    implements(IConverter)
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._pools = {} # {PARAMETERS: [CONVERTER]}
+
+    ### IConverter ###
+
+    def convert(self, data, **params):
+        key = tuple(sorted(params.iteritems()))
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = []
+        converter = pool.pop() if pool else self._factory(**params)
+        try:
+            return converter.convert(data)
+        finally:
+            pool.append(converter)
+
+
 class Externalizer(object):
     """Simplistic implementation of L{IExternalizer}.
     WARNING, by default it uses id() for identifying instances,
@@ -280,6 +309,8 @@ def referenceable(method):
     this decorator with decorate flatten_str()."""
 
     def wrapper(self, value, *args):
+        if self._acyclic:
+            return method(self, value, *args)
         deref = self._prepare(value)
         if deref is not None:
             return deref
@@ -332,16 +363,20 @@ class Serializer(object):
       [pack_list, [[pack_reference, [1, [pack_list, [pack_int, 1]]]],
       [pack_dereference, 1]]]
 
+    If created with acyclic flag, the references are not tracked at all.
+    It is faster, but values referenced multiple times are serialized
+    multiple times and circular references are not supported. It should
+    only be used for data known to be a tree, like message payloads.
+    As nothing is mutated afterward, convert() and freeze() then pack
+    each value as soon as it is flattened, in a single pass.
+
     Sub classes can override the packing functions used for each types.
 
-    NOTE: because the flatten methods lookup table is done at class
-    declaration time, overriding most of flatten_* method will not work.
-    Only flatten_value, flatten_key, flatten_item, flatten_unknown,
-    flatten_instance and flatten_frozen_instance can be overridden
-    safely by subclasses. In case overriding other flatten_* method
-    would be needed in the future, the lookup table initialization
-    should be moved to the constructor and self should not be passed anymore
-    as the first parameter because the function would be then bound.
+    The flattener of the values is resolved once per type for each
+    serializer class, by name, so sub classes can override the
+    flatten_*_value methods. The keys are flattened through the
+    _key_lookup table done at class declaration time, overriding the
+    flatten_*_key methods will not work, flatten_key can be overridden.
 
     #FIXME: Add datetime types datetime, date, time and timedelta
 
@@ -376,7 +411,7 @@ class Serializer(object):
 
     def __init__(self, converter_caps=None, freezer_caps=None,
                  post_converter=None, externalizer=None, registry=None,
-                 source_ver=None, target_ver=None):
+                 source_ver=None, target_ver=None, acyclic=False):
         global _global_registry
         assert ((source_ver is None) and (target_ver is None)) \
                or ((source_ver is not None) and (target_ver is not None))
@@ -387,6 +422,15 @@ class Serializer(object):
         self._registry = IRegistry(registry) if registry else _global_registry
         self._source_ver = source_ver
         self._target_ver = target_ver
+        self._acyclic = acyclic
+        # If the values are packed as soon as they are flattened
+        self._packing = False
+        # {(TYPE, FREEZING): FLATTENER} shared by the instances of a class
+        flatteners = type(self).__dict__.get("_flatteners")
+        if flatteners is None:
+            flatteners = {}
+            setattr(type(self), "_flatteners", flatteners)
+        self._flatteners = flatteners
         self.reset()
 
     ### IFreezer ###
@@ -399,6 +443,21 @@ class Serializer(object):
     def convert(self, data):
         return self._convert(data, self.converter_capabilities, False)
 
+    ### public ###
+
+    def flatten(self, data, freezing=False):
+        """Does only the first pass of the serialization. The result
+        does not reference any mutable value of the original structure
+        and can be finished later with pack_value() and post_convertion().
+        Packing functions do not use the serializer state so packing
+        can be done from a different thread."""
+        caps = (self.freezer_capabilities if freezing
+                else self.converter_capabilities)
+        try:
+            return self.flatten_value(data, caps, freezing)
+        finally:
+            self.reset()
+
     ### protected ###
 
     def check_capabilities(self, cap, value, caps, freezing):
@@ -409,19 +468,25 @@ class Serializer(object):
                                 cap.name, value))
 
     def pack_value(self, data):
-        if not isinstance(data, (list, tuple)):
+        # The flattened structure is only made of lists and tuples
+        # created by the flatteners, no need to check for sub-classes
+        if data.__class__ is not list and data.__class__ is not tuple:
             return data
         packer, value = data
-        if isinstance(value, list):
-            value = [self.pack_value(d) for d in value]
+        if value.__class__ is list:
+            pack = self.pack_value
+            value = [pack(d) for d in value]
         if packer is not None:
             return packer(value)
         return value
 
     def flatten_value(self, value, caps, freezing):
-        vtype = type(value)
-        default = Serializer.flatten_unknown_value
-        flattener = self._value_lookup.get(vtype, default)
+        flattener = self._flatteners.get((type(value), freezing))
+        if flattener is None:
+            flattener = self._resolve_flattener(type(value), freezing)
+        if self._packing:
+            packer, data = flattener(self, value, caps, freezing)
+            return data if packer is None else packer(data)
         return flattener(self, value, caps, freezing)
 
     def flatten_key(self, key, caps, freezing):
@@ -444,6 +509,13 @@ class Serializer(object):
         self._refid = 0
 
     def flatten_unknown_value(self, value, caps, freezing):
+        vtype = type(value)
+        flattener = self._flatteners.get((vtype, freezing))
+        if flattener is None:
+            flattener = self._resolve_flattener(vtype, freezing)
+        return flattener(self, value, caps, freezing)
+
+    def flatten_adapted_value(self, value, caps, freezing):
         # Flatten enums
         if isinstance(value, enum.Enum):
             return self.flatten_enum_value(value, caps, freezing)
@@ -499,7 +571,11 @@ class Serializer(object):
 
     def flatten_item(self, value, caps, freezing):
         key, value = value
-        return self.pack_item, [self.flatten_key(key, caps, freezing),
+        key = self.flatten_key(key, caps, freezing)
+        if self._packing:
+            packer, data = key
+            key = data if packer is None else packer(data)
+        return self.pack_item, [key,
                                 self.flatten_value(value, caps, freezing)]
 
     def flatten_str_value(self, value, caps, freezing):
@@ -567,6 +643,8 @@ class Serializer(object):
         if freezing:
             if hasattr(value.__func__, FREEZING_TAG_ATTRIBUTE):
                 tag = getattr(value.__func__, FREEZING_TAG_ATTRIBUTE)
+                if self._packing:
+                    return None, self.flatten_value(tag, caps, freezing)
                 return self.flatten_value(tag, caps, freezing)
             return self.pack_frozen_method, value
         return self.pack_method, value
@@ -599,8 +677,12 @@ class Serializer(object):
         items = value.items()
         if freezing:
             items = sorted(items, key=operator.itemgetter(0))
-        return self.pack_dict, [self.flatten_item(i, caps, freezing)
-                                for i in items]
+        flatten_item = self.flatten_item
+        items = [flatten_item(i, caps, freezing) for i in items]
+        if self._packing:
+            items = [data if packer is None else packer(data)
+                     for packer, data in items]
+        return self.pack_dict, items
 
     def flatten_str_key(self, value, caps, freezing):
         self.check_capabilities(Capabilities.str_keys, value,
@@ -658,7 +740,8 @@ class Serializer(object):
         self.check_capabilities(Capabilities.instance_values, value,
                                 caps, freezing)
 
-        referenceable = getattr(value, "referenceable", True)
+        referenceable = (not self._acyclic
+                         and getattr(value, "referenceable", True))
 
         if referenceable:
             deref = self._prepare(value)
@@ -680,8 +763,12 @@ class Serializer(object):
         if freezing:
             packer, data = self.pack_frozen_instance, [dump]
         else:
-            packer, data = (self.pack_instance,
-                            [[self.pack_type_name, value.type_name], dump])
+            type_name = [self.pack_type_name, value.type_name]
+            if self._packing and self.pack_type_name is not None:
+                type_name = self.pack_type_name(value.type_name)
+            elif self._packing:
+                type_name = value.type_name
+            packer, data = self.pack_instance, [type_name, dump]
 
         if referenceable:
             return self._preserve(value, packer, data)
@@ -698,20 +785,21 @@ class Serializer(object):
 
     ### lookup tables ###
 
-    _value_lookup = {tuple: flatten_tuple_value,
-                     list: flatten_list_value,
-                     set: flatten_set_value,
-                     dict: flatten_dict_value,
-                     str: flatten_str_value,
-                     unicode: flatten_unicode_value,
-                     int: flatten_int_value,
-                     long: flatten_long_value,
-                     float: flatten_float_value,
-                     bool: flatten_bool_value,
-                     type(None): flatten_none_value,
-                     types.FunctionType: flatten_function_value,
-                     types.BuiltinFunctionType: flatten_builtin_value,
-                     types.MethodType: flatten_method_value}
+    # Name of the flattener method of the values of the builtin types
+    _value_lookup = {tuple: "flatten_tuple_value",
+                     list: "flatten_list_value",
+                     set: "flatten_set_value",
+                     dict: "flatten_dict_value",
+                     str: "flatten_str_value",
+                     unicode: "flatten_unicode_value",
+                     int: "flatten_int_value",
+                     long: "flatten_long_value",
+                     float: "flatten_float_value",
+                     bool: "flatten_bool_value",
+                     type(None): "flatten_none_value",
+                     types.FunctionType: "flatten_function_value",
+                     types.BuiltinFunctionType: "flatten_builtin_value",
+                     types.MethodType: "flatten_method_value"}
 
     _key_lookup = {tuple: flatten_tuple_key,
                    str: flatten_str_key,
@@ -724,16 +812,58 @@ class Serializer(object):
 
     ### private ###
 
+    def _resolve_flattener(self, vtype, freezing):
+        '''
+        Resolves the flattener of the values of the given type and
+        remembers it in the table of the class. The adapters are expected
+        to be registered at import time.
+        '''
+        cls = type(self)
+        if vtype in self._value_lookup:
+            flattener = getattr(cls, self._value_lookup[vtype]).im_func
+        elif issubclass(vtype, enum.Enum):
+            flattener = cls.flatten_enum_value.im_func
+        elif issubclass(vtype, (type, InterfaceClass)):
+            flattener = cls.flatten_type_value.im_func
+        elif vtype is types.InstanceType:
+            # All old-style instances have the same type
+            return cls.flatten_adapted_value.im_func
+        else:
+            iface = ISnapshotable if freezing else ISerializable
+            if iface.implementedBy(vtype):
+                flattener = cls._flatten_provider_value.im_func
+            else:
+                factory = components.getAdapterFactory(vtype, iface, None)
+                if factory is None:
+                    # Not remembered, the error is raised by the adaptation
+                    return cls.flatten_adapted_value.im_func
+                flattener = _adapted_flattener(factory)
+        self._flatteners[(vtype, freezing)] = flattener
+        return flattener
+
+    def _flatten_provider_value(self, value, caps, freezing):
+        if self._externalizer is not None:
+            extid = self._externalizer.identify(value)
+            if extid is not None:
+                return self.flatten_external(extid, caps, freezing)
+        return self.flatten_instance(value, caps, freezing)
+
     def _convert(self, data, caps, freezing):
         try:
-            # Flatten the value to the list-only format with packer function
-            flattened = self.flatten_value(data, caps, freezing)
-            # Pack all the value with there own packer functions
-            packed = self.pack_value(flattened)
+            if self._acyclic:
+                # Nothing is mutated afterward, pack the values right away
+                self._packing = True
+                packed = self.flatten_value(data, caps, freezing)
+            else:
+                # Flatten the value to the list-only format with packer
+                flattened = self.flatten_value(data, caps, freezing)
+                # Pack all the value with there own packer functions
+                packed = self.pack_value(flattened)
             # Post-convert the data if a convert was specified
             return self.post_convertion(packed)
         finally:
             # Reset the state to cleanup all references
+            self._packing = False
             self.reset()
 
     def _next_refid(self):
@@ -791,6 +921,18 @@ class Serializer(object):
         return container
 
 
+def _adapted_flattener(factory):
+
+    def flatten_adapted(self, value, caps, freezing):
+        if self._externalizer is not None:
+            extid = self._externalizer.identify(value)
+            if extid is not None:
+                return self.flatten_external(extid, caps, freezing)
+        return self.flatten_instance(factory(value), caps, freezing)
+
+    return flatten_adapted
+
+
 class DelayPacking(Exception):
     """Exception raised when unpacking a dereference to an unknown
     reference. This allows to delay unpacking of mutable object
@@ -1014,6 +1156,7 @@ class Unserializer(object):
 
         items = [(False, k, v) for k, v in pairs]
         result = []
+        pass_through = self.pass_through_types
 
         # Try to unpack items more than one time to resolve cross references
         max_loop = 2
@@ -1022,6 +1165,9 @@ class Unserializer(object):
             for key_unpacked, key_data, value_data in items:
                 if key_unpacked:
                     key = key_data
+                elif type(key_data) in pass_through:
+                    # Cannot be a dereference, no need to protect it
+                    key = key_data
                 else:
                     blob = self._begin()
                     try:
@@ -1034,6 +1180,10 @@ class Unserializer(object):
                         next_items.append((False, key_data, value_data))
                         continue
 
+                if type(value_data) in pass_through:
+                    result.append((key, value_data))
+                    continue
+
                 blob = self._begin()
                 try:
                     # try unpacking the value
@@ -1098,6 +1248,8 @@ class Unserializer(object):
     def _unpack_data(self, data, refid, refdata):
         # Just return pass-through types,
         # support sub-classed base types and metaclasses
+        if type(data) in self.pass_through_types:
+            return data
         if set(type(data).__mro__) & self.pass_through_types:
             return data
 
@@ -44,6 +44,9 @@ INSTANCE_TYPE_ATOM = u".type"
 INSTANCE_STATE_ATOM = u".state"
 
 DEFAULT_ENCODING = "UTF8"
+# Same codec than DEFAULT_ENCODING, spelled the way unicode()
+# decodes it directly without going through the codec registry
+DEFAULT_DECODING = "utf-8"
 ALLOWED_CODECS = set(["UTF8", "UTF-8", "utf8"])
 
 JSON_CONVERTER_CAPS = set([Capabilities.int_values,
@@ -77,12 +80,13 @@ class PreSerializer(base.Serializer):
     pack_dict = dict
 
     def __init__(self, force_unicode=False, externalizer=None,
-                 source_ver=None, target_ver=None):
+                 source_ver=None, target_ver=None, acyclic=False):
         base.Serializer.__init__(self, converter_caps=JSON_CONVERTER_CAPS,
                                  freezer_caps=JSON_FREEZER_CAPS,
                                  externalizer=externalizer,
                                  source_ver=source_ver,
-                                 target_ver=target_ver)
+                                 target_ver=target_ver,
+                                 acyclic=acyclic)
         self._force_unicode = force_unicode
 
     ### Overridden Methods ###
@@ -93,7 +97,7 @@ class PreSerializer(base.Serializer):
                             "non-string dictionary keys: %r"
                             % (reflect.canonical_name(self), key))
         # Flatten it as unicode by using the selected encoding
-        return self.pack_unicode, key.decode(DEFAULT_ENCODING)
+        return self.pack_unicode, unicode(key, DEFAULT_DECODING)
 
     def pack_tuple(self, data):
         # JSON do not support tuple so we just fake it
@@ -102,7 +106,7 @@ class PreSerializer(base.Serializer):
     def pack_str(self, data):
         # we try to decode the string from default encoding
         try:
-            value = data.decode(DEFAULT_ENCODING)
+            value = unicode(data, DEFAULT_DECODING)
             if self._force_unicode:
                 return value
             return [ENCODED_ATOM, DEFAULT_ENCODING, value]
@@ -161,11 +165,13 @@ class Serializer(PreSerializer):
 
     def __init__(self, indent=None, separators=None,
                  force_unicode=False, encoding=None,
-                 externalizer=None, source_ver=None, target_ver=None):
+                 externalizer=None, source_ver=None, target_ver=None,
+                 acyclic=False):
         PreSerializer.__init__(self, force_unicode=force_unicode,
                                  externalizer=externalizer,
                                  source_ver=source_ver,
-                                 target_ver=target_ver)
+                                 target_ver=target_ver,
+                                 acyclic=acyclic)
         self._indent = indent
         self._separators = separators
         self._encoding = encoding
@@ -296,6 +302,12 @@ class PaisleyUnserializer(Unserializer):
         return data
 
 
+# Shared converters, keyed by the constructor parameters
+serializer_pool = base.ConverterPool(Serializer)
+unserializer_pool = base.ConverterPool(Unserializer)
+paisley_unserializer_pool = base.ConverterPool(PaisleyUnserializer)
+
+
 def serialize(value):
     global _serializer
     return _serializer.convert(value)
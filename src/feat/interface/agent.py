@@ -259,6 +259,41 @@ class IAgencyAgent(Interface):
         @returns: Deferred called with the updated document (latest revision).
         '''
 
+    def save_documents(documents):
+        '''
+        Save the documents into the database with a single request.
+        See L{feat.agencies.interface.IDatabaseClient.save_documents}.
+
+        @param documents: Documents to be saved.
+        @type documents: list of L{feat.agents.document.Document}
+        @returns: Deferred called with the list of the updated documents,
+                  with a ConflictError instance in place of the documents
+                  which could not be saved.
+        '''
+
+    def get_documents(document_ids):
+        '''
+        Download the documents from the database with a single request.
+        See L{feat.agencies.interface.IDatabaseClient.get_documents}.
+
+        @param document_ids: The ids of the documents in the database.
+        @returns: Deferred called with the list of the documents, with a
+                  NotFoundError instance in place of the missing ones.
+        '''
+
+    def delete_documents(documents):
+        '''
+        Marks the documents in the database as deleted with a single
+        request.
+        See L{feat.agencies.interface.IDatabaseClient.delete_documents}.
+
+        @param documents: Documents to be deleted.
+        @type documents: list of L{feat.agents.document.Document}
+        @returns: Deferred called with the list of the updated documents,
+                  with an error instance in place of the documents which
+                  could not be deleted.
+        '''
+
     def register_change_listener(filter, callback, **kwargs):
         '''
         Registers for receiving notifications about the document changes.
@@ -237,6 +237,19 @@ class ConverterTest(common.TestCase):
         self.checkConvertion(table, self.serializer.freeze,
                              capabilities=capabilities)
 
+    def testFlattening(self):
+        if self.serializer is None:
+            raise SkipTest("No serializer, cannot test convertion")
+
+        def convert(value):
+            flattened = self.serializer.flatten(value)
+            packed = self.serializer.pack_value(flattened)
+            return self.serializer.post_convertion(packed)
+
+        capabilities = self.serializer.converter_capabilities
+        table = self.convertion_table(capabilities, False)
+        self.checkConvertion(table, convert, capabilities=capabilities)
+
     def testSymmetry(self):
         if self.unserializer is None:
             raise SkipTest("No unserializer, cannot test for symmetry")
@@ -131,6 +131,15 @@ class DummyAgent(DummyBase):
     def delete_document(self, document):
         return fiber.wrap_defer(self._db.delete_document, document)
 
+    def get_documents(self, doc_ids):
+        return fiber.wrap_defer(self._db.get_documents, doc_ids)
+
+    def save_documents(self, documents):
+        return fiber.wrap_defer(self._db.save_documents, documents)
+
+    def delete_documents(self, documents):
+        return fiber.wrap_defer(self._db.delete_documents, documents)
+
     def query_view(self, factory, **kwargs):
         return fiber.wrap_defer(self._db.query_view, factory, **kwargs)
 
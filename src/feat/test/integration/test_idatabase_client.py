@@ -101,8 +101,51 @@ class CountingView(view.BaseView):
     reduce = "_count"
 
 
+class FieldView(view.BaseView):
+
+    name = 'field_view'
+
+    def map(doc):
+        if doc['.type'] == 'dummy':
+            yield doc['field'], doc['value']
+
+
 class TestCase(object):
 
+    @defer.inlineCallbacks
+    def testPagingView(self):
+        views = (FieldView, CountingView, )
+        design_doc = view.DesignDocument.generate_from_views(views)
+        yield self.connection.save_document(design_doc)
+        fields = [u'b', u'a', u'c', u'a', u'a']
+        for index, field in enumerate(fields):
+            yield self.connection.save_document(DummyDocument(
+                doc_id=u'doc%d' % (index, ), field=field, value=index))
+
+        # the rows with the same key are split between the pages
+        cursor = self.connection.iter_view(FieldView, page_size=2)
+        pages = []
+        while not cursor.finished:
+            page = yield cursor.next_page()
+            pages.append(page)
+        self.assertEqual([[1, 3], [4, 0], [2]], pages)
+        page = yield cursor.next_page()
+        self.assertEqual([], page)
+
+        cursor = self.connection.iter_view(FieldView, page_size=3,
+                                           startkey=u'b')
+        page = yield cursor.next_page()
+        self.assertEqual([0, 2], page)
+        self.assertTrue(cursor.finished)
+
+        # the rows of the reducing views are paged without reducing them
+        cursor = self.connection.iter_view(CountingView, page_size=4)
+        page = yield cursor.next_page()
+        self.assertEqual([1, 1, 1, 1], page)
+        page = yield cursor.next_page()
+        self.assertEqual([1], page)
+        self.assertTrue(cursor.finished)
+
     @defer.inlineCallbacks
     def testQueryingViews(self):
         # create design document
@@ -269,6 +312,46 @@ class TestCase(object):
         rev3 = doc.rev
         self.assertNotEqual(rev3, rev2)
 
+    @defer.inlineCallbacks
+    def testBulkDocuments(self):
+        docs = [DummyDocument(value=i) for i in range(3)]
+        docs[0].doc_id = u"bulk_doc"
+        saved = yield self.connection.save_documents(docs)
+        self.assertEqual(docs, saved)
+        self.assertEqual(u"bulk_doc", docs[0].doc_id)
+        for doc in docs:
+            self.assertTrue(doc.doc_id is not None)
+            self.assertTrue(doc.rev is not None)
+
+        ids = [doc.doc_id for doc in docs] + [u"missing"]
+        fetched = yield self.connection.get_documents(ids)
+        self.assertEqual(4, len(fetched))
+        for doc, fetched_doc in zip(docs, fetched):
+            self.assertIsInstance(fetched_doc, DummyDocument)
+            self.assertEqual(doc.value, fetched_doc.value)
+            self.assertEqual(doc.rev, fetched_doc.rev)
+        self.assertIsInstance(fetched[3], NotFoundError)
+
+        # one of them gets outdated
+        fetched[1].value = 10
+        yield self.connection.save_document(fetched[1])
+        for doc in docs:
+            doc.value += 1
+        saved = yield self.connection.save_documents(docs)
+        self.assertIs(docs[0], saved[0])
+        self.assertIsInstance(saved[1], ConflictError)
+        self.assertIs(docs[2], saved[2])
+
+        deleted = yield self.connection.delete_documents(docs)
+        self.assertIs(docs[0], deleted[0])
+        self.assertIsInstance(deleted[1], ConflictError)
+        self.assertIs(docs[2], deleted[2])
+
+        fetched = yield self.connection.get_documents(ids[:3])
+        self.assertIsInstance(fetched[0], NotFoundError)
+        self.assertEqual(10, fetched[1].value)
+        self.assertIsInstance(fetched[2], NotFoundError)
+
     @defer.inlineCallbacks
     def testOtherSession(self):
         self.changes = list()
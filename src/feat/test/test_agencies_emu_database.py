@@ -25,10 +25,27 @@ from twisted.internet import defer
 
 from feat.agencies.emu import database
 from feat.agencies.interface import ConflictError, NotFoundError
+from feat.agents.base import document
+from feat.common.serialization import json as feat_json
 
 from . import common
 
 
+@document.register
+class CachedDocument(document.Document):
+
+    document_type = 'cached-test_document'
+    cached = True
+    document.field('field', 0)
+
+
+@document.register
+class UncachedDocument(document.Document):
+
+    document_type = 'uncached-test_document'
+    document.field('field', 0)
+
+
 class TestDatabase(common.TestCase):
 
     def setUp(self):
@@ -203,3 +220,78 @@ class TestDatabaseIntegration(common.TestCase):
 
     def _gen_doc(self, doc_id):
         return json.dumps({'_id': doc_id})
+
+
+class TestDocumentCache(common.TestCase):
+
+    def setUp(self):
+        self.database = database.Database(cache_size=4)
+        self.connection = self.database.get_connection()
+
+    @defer.inlineCallbacks
+    def testGettingCachedDocument(self):
+        yield self.connection.save_document(CachedDocument(doc_id=u'doc'))
+        doc = yield self.connection.get_document(u'doc')
+        doc.field = 1
+        doc2 = yield self.connection.get_document(u'doc')
+        self.assertEqual(0, doc2.field)
+        self.assertEqual(doc.rev, doc2.rev)
+        self.assertFalse('open_doc' in self._stats())
+        self.assertEqual(2, self._stats()['cache hits'])
+
+        # the connection asks for the revision it knows
+        yield self.connection.reload_document(doc)
+        self.assertEqual(1, self._stats()['open_doc'])
+
+        doc = yield self.connection.save_document(doc)
+        doc2 = yield self.connection.get_document(u'doc')
+        self.assertEqual(1, doc2.field)
+        self.assertEqual(doc.rev, doc2.rev)
+
+        yield self.connection.delete_document(doc2)
+        d = self.connection.get_document(u'doc')
+        self.assertFailure(d, NotFoundError)
+        yield d
+
+    @defer.inlineCallbacks
+    def testChangesDropDocuments(self):
+        yield self.connection.save_document(CachedDocument(doc_id=u'doc'))
+        doc = yield self.connection.get_document(u'doc')
+
+        # saved without the cache, like an other agency would
+        doc.field = 2
+        yield self.database.save_doc(feat_json.serializer_pool.convert(doc))
+        self.assertEqual(1, self._stats()['cache invalidations'])
+        doc2 = yield self.connection.get_document(u'doc')
+        self.assertEqual(2, doc2.field)
+        self.assertEqual(1, self._stats()['open_doc'])
+
+    @defer.inlineCallbacks
+    def testUncachedTypes(self):
+        yield self.connection.save_document(UncachedDocument(doc_id=u'doc'))
+        yield self.connection.get_document(u'doc')
+        yield self.connection.get_document(u'doc')
+        self.assertEqual(2, self._stats()['open_doc'])
+        self.assertEqual(0, self._stats()['cache documents'])
+
+    @defer.inlineCallbacks
+    def testBoundedSize(self):
+        docs = [CachedDocument(doc_id=u'doc%d' % (i, )) for i in range(6)]
+        yield self.connection.save_documents(docs)
+        self.assertEqual(4, self._stats()['cache evictions'])
+        self.assertTrue(len(self.database.cache) <= 4)
+
+        # the least recently used document is dropped first
+        yield self.connection.get_document(u'doc4')
+        yield self.connection.get_document(u'doc0')
+        self.assertTrue(u'doc4' in self.database.cache)
+        self.assertFalse(u'doc5' in self.database.cache)
+
+        fetched = yield self.connection.get_documents(
+            [u'doc%d' % (i, ) for i in range(6)] + [u'missing'])
+        self.assertEqual([doc.doc_id for doc in docs],
+                         [doc.doc_id for doc in fetched[:6]])
+        self.assertIsInstance(fetched[6], NotFoundError)
+
+    def _stats(self):
+        return dict(self.database.get_stats())
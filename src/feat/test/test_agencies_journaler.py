@@ -20,13 +20,18 @@
 
 # Headers in this file shall remain intact.
 import signal
+import shutil
+import sqlite3
 import tempfile
+import threading
 import os
 
+from twisted.trial.unittest import SkipTest
+
 from feat.test import common
 from feat.common import defer, time
-from feat.agencies import journaler
-from feat.common.serialization import banana
+from feat.agencies import journaler, replay
+from feat.common.serialization import banana, base
 
 
 class SqliteWriter(journaler.SqliteWriter, common.Mock):
@@ -115,6 +120,357 @@ class DBTests(common.TestCase):
         self.assertEqual('some.canonical.name', first['fun_id'])
         self.assertEqual('other', second['fun_id'])
 
+    @defer.inlineCallbacks
+    def testBatchedInserts(self):
+        writer = journaler.SqliteWriter(self, encoding='zip', flush_size=3)
+        yield writer.initiate()
+
+        entries = [self._generate_data(function_id=str(x)) for x in range(7)]
+        entries.insert(2, self._generate_log())
+        yield writer.insert_entries(entries)
+        self.assertTrue(writer.is_idle())
+
+        histories = yield writer.get_histories()
+        entries = yield writer.get_entries(histories[0])
+        self.assertEqual([str(x) for x in range(7)],
+                         [self._unpack(row)['fun_id'] for row in entries])
+        logs = yield writer.get_log_entries(filters=[dict(level=5)])
+        self.assertEqual(1, len(logs))
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testFlushInterval(self):
+        writer = journaler.SqliteWriter(self, flush_size=3,
+                                        flush_interval=0.1)
+        yield writer.initiate()
+
+        d = writer.insert_entries([self._generate_data()])
+        self.assertFalse(writer.is_idle())
+        yield d
+        self.assertTrue(writer.is_idle())
+
+        # enough entries for a batch are flushed without waiting
+        yield writer.insert_entries([self._generate_data()] * 3)
+        self.assertTrue(writer.is_idle())
+
+        d = writer.insert_entries([self._generate_data()])
+        yield writer.close()
+        self.assertTrue(d.called)
+        self.assertTrue(writer.is_idle())
+
+    @defer.inlineCallbacks
+    def testCloseWithoutFlush(self):
+        writer = journaler.SqliteWriter(self, flush_interval=0.5)
+        yield writer.initiate()
+        d = writer.insert_entries([self._generate_data()])
+        yield writer.close(flush=False)
+        self.assertTrue(d.called)
+        self.assertFailure(d, journaler.FlushCancelled)
+        yield d
+
+        # the journaler keeps the entries for the next writer
+        jour = journaler.Journaler(self)
+        writer = journaler.SqliteWriter(self, flush_interval=0.5)
+        yield writer.initiate()
+        jour.configure_with(writer)
+        jour.insert_entry(**self._generate_data(function_id='lost'))
+        yield self.wait_for(lambda: jour._cache.is_locked(), 1, freq=0.01)
+        yield jour.close(flush_writer=False)
+        self.assertTrue(jour._flush_task is None)
+        self.assertFalse(jour._cache.is_locked())
+        self.assertEqual(1, len(jour._cache))
+
+        writer = journaler.SqliteWriter(self)
+        yield writer.initiate()
+        jour.configure_with(writer)
+        yield self.wait_for(jour.is_idle, 1, freq=0.05)
+        histories = yield jour.get_histories()
+        entries = yield jour.get_entries(histories[0])
+        self.assertEqual(['lost'],
+                         [self._unpack(row)['fun_id'] for row in entries])
+        yield jour.close()
+
+    @defer.inlineCallbacks
+    def testJournalMode(self):
+        filename = self._get_tmp_file()
+        writer = journaler.SqliteWriter(self, filename=filename,
+                                        synchronous='off')
+        yield writer.initiate()
+        res = yield writer._db.runQuery('PRAGMA journal_mode')
+        self.assertEqual('wal', res[0][0])
+        res = yield writer._db.runQuery('PRAGMA synchronous')
+        self.assertEqual(0, res[0][0])
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testSerializingInThread(self):
+        jour = journaler.Journaler(self)
+        writer = journaler.SqliteWriter(self)
+        yield writer.initiate()
+        yield jour.configure_with(writer)
+        connection = jour.get_connection(base.Externalizer())
+
+        state = dict(values=[1, 2])
+        for x in range(3):
+            entry = connection.new_entry('some id', 1, ('some_id', 1, x),
+                                         'some.canonical.name', state, x)
+            entry.set_fiber_context('some fiber id', 0)
+            entry.set_result(x)
+            entry.commit()
+            # changes after the commit should not get journaled
+            state['values'].append(x)
+
+        yield self.wait_for(jour.is_idle, 1, freq=0.05)
+
+        histories = yield jour.get_histories()
+        entries = yield jour.get_entries(histories[0])
+        self.assertEqual(3, len(entries))
+        for x, row in enumerate(entries):
+            unpacked = self._unpack(row)
+            args = self.unserializer.convert(unpacked['args'])
+            self.assertEqual((dict(values=[1, 2] + range(x)), x), args)
+            self.assertEqual(x, self.unserializer.convert(unpacked['res']))
+        yield jour.close()
+
+    @defer.inlineCallbacks
+    def testSpillingEntries(self):
+        writer = journaler.SqliteWriter(self, flush_size=2,
+                                        high_water_mark=3)
+        entries = [self._generate_data(function_id=str(x))
+                   for x in range(10)]
+        d = writer.insert_entries(entries)
+        self.assertEqual(10, len(writer._cache))
+        stats = dict(writer.get_stats())
+        self.assertEqual(10, stats['cache depth'])
+        self.assertEqual(7, stats['cache spilled entries'])
+        self.assertTrue(stats['cache spill bytes'] > 0)
+
+        yield writer.initiate()
+        yield d
+        self.assertTrue(writer.is_idle())
+        stats = dict(writer.get_stats())
+        self.assertEqual(0, stats['cache depth'])
+        self.assertEqual(0, stats['cache spill bytes'])
+        self.assertTrue(stats['flush latency'] >= 0)
+
+        histories = yield writer.get_histories()
+        entries = yield writer.get_entries(histories[0])
+        self.assertEqual([str(x) for x in range(10)],
+                         [self._unpack(row)['fun_id'] for row in entries])
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testSpillingWhileInserting(self):
+        writer = journaler.SqliteWriter(self, flush_size=2,
+                                        high_water_mark=3)
+        yield writer.initiate()
+        yield self._assert_spilling_while_inserting(writer)
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testSegmentSpillingWhileInserting(self):
+        writer = journaler.SegmentWriter(self, self._get_tmp_dir(),
+                                         flush_size=2, high_water_mark=3)
+        yield writer.initiate()
+        yield self._assert_spilling_while_inserting(writer)
+        yield writer.close()
+
+    def testEntriesCacheSpilling(self):
+        cache = journaler.EntriesCache(high_water_mark=2)
+        for x in range(5):
+            cache.append(dict(index=x))
+        self.assertEqual(5, len(cache))
+
+        fetched = cache.fetch()
+        self.assertEqual([0, 1], [x['index'] for x in fetched])
+        cache.rollback()
+        self.assertEqual(fetched, cache.fetch(limit=3))
+        cache.commit()
+        # new entries keep the order after the spilled ones
+        cache.append(dict(index=5))
+        self.assertEqual([2], [x['index'] for x in cache.fetch(limit=1)])
+        cache.commit()
+        self.assertEqual([3, 4], [x['index'] for x in cache.fetch()])
+        cache.commit()
+        self.assertEqual([5], [x['index'] for x in cache.fetch()])
+        cache.commit()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, dict(cache.get_stats())['cache spill bytes'])
+
+    @defer.inlineCallbacks
+    def testSegmentWriter(self):
+        dirname = self._get_tmp_dir()
+        jour = journaler.Journaler(self)
+        writer = journaler.SegmentWriter(self, dirname, encoding='zip')
+        yield writer.initiate()
+        yield jour.configure_with(writer)
+        self.assertEqual(dirname, (yield jour.get_filename()))
+
+        yield jour.insert_entry(**self._generate_data(timestamp=10))
+        yield jour.insert_entry(**self._generate_data(
+            agent_id='other id', function_id='other', timestamp=20))
+        yield jour.insert_entry(**self._generate_data(
+            function_id='other', timestamp=30))
+        yield jour.insert_entry(**self._generate_log(timestamp=40))
+        yield jour.insert_entry(**self._generate_log(
+            level=5, category='other', timestamp=50))
+
+        histories = yield jour.get_histories()
+        self.assertEqual(['some id', 'other id'],
+                         [x.agent_id for x in histories])
+        self.assertIsInstance(histories[0], journaler.History)
+        entries = yield jour.get_entries(histories[0])
+        self.assertEqual(2, len(entries))
+        first = self._unpack(entries[0])
+        self.assertEqual('some id', first['a_id'])
+        self.assertEqual(1, first['i_id'])
+        self.assertEqual('some.canonical.name', first['fun_id'])
+        self.assertEqual('some fiber id', first['f_id'])
+        self.assertEqual(1, first['f_dep'])
+        self.assertEqual(('some_id', 1, 0, ),
+                         self.unserializer.convert(first['j_id']))
+        self.assertEqual(None, self.unserializer.convert(first['res']))
+        self.assertEqual(10, first['time'])
+
+        entries = yield writer.get_entries(histories[0], start_date=20)
+        self.assertEqual(['other'],
+                         [self._unpack(x)['fun_id'] for x in entries])
+        entries = yield writer.get_entries(histories[0], limit=1)
+        self.assertEqual(['some.canonical.name'],
+                         [self._unpack(x)['fun_id'] for x in entries])
+
+        logs = yield writer.get_log_entries(filters=[dict(level=1)])
+        self.assertEqual(1, len(logs))
+        self.assertEqual('some message', logs[0][0])
+        logs = yield writer.get_log_entries(start_date=45)
+        self.assertEqual(1, len(logs))
+        categories = yield writer.get_log_categories()
+        self.assertEqual(['some category', 'other'], categories)
+        names = yield writer.get_log_names('other')
+        self.assertEqual(['some name'], names)
+        boundaries = yield writer.get_log_time_boundaries()
+        self.assertEqual((40, 50), boundaries)
+        yield jour.close()
+
+        # the histories are loaded back when reopening the directory
+        writer = journaler.SegmentWriter(self, dirname, encoding='sth else')
+        yield writer.initiate()
+        self.assertEqual('zip', writer._encoding)
+        yield writer.insert_entries([self._generate_data(function_id='new')])
+        histories = yield writer.get_histories()
+        self.assertEqual(2, len(histories))
+        entries = yield writer.get_entries(histories[0])
+        self.assertEqual(['some.canonical.name', 'other', 'new'],
+                         [self._unpack(x)['fun_id'] for x in entries])
+        yield writer.close()
+
+    @defer.inlineCallbacks
+    def testMissingValues(self):
+        # both writers read back the missing values the same way
+        results = []
+        for writer in (journaler.SqliteWriter(self, encoding='zip'),
+                       journaler.SegmentWriter(self, self._get_tmp_dir(),
+                                               encoding='zip')):
+            yield writer.initiate()
+            yield writer.insert_entries([
+                self._generate_data(fiber_id=None, fiber_depth=None,
+                                    timestamp=10),
+                self._generate_log(category=None, log_name=None,
+                                   file_path=None, line_num=None,
+                                   timestamp=20)])
+            history = (yield writer.get_histories())[0]
+            entries = yield writer.get_entries(history)
+            logs = yield writer.get_log_entries()
+            results.append(([list(x) for x in entries],
+                            [list(x) for x in logs]))
+            yield writer.close()
+
+        self.assertEqual(results[0], results[1])
+        entries, logs = results[1]
+        entry = self._unpack(entries[0])
+        self.assertEqual(u'', entry['f_id'])
+        self.assertEqual(None, entry['f_dep'])
+        self.assertEqual([None, None, u'', None, 20], logs[0][2:])
+
+    @defer.inlineCallbacks
+    def testSqliteCursor(self):
+        writer = journaler.SqliteWriter(self, filename=self._get_tmp_file(),
+                                        encoding='zip')
+        yield writer.initiate()
+        yield self._assert_cursor(writer)
+        history = (yield writer.get_histories())[0]
+        cursor = writer.get_cursor(history)
+        # the readers cannot change the journal
+        self.assertRaises(sqlite3.OperationalError, cursor._connection.execute,
+                          "DELETE FROM entries")
+        cursor.close()
+        yield writer.close()
+
+    def testReadOnlyUri(self):
+        if not journaler._sqlite_uri_enabled():
+            raise SkipTest("sqlite does not accept URI filenames")
+        filename = os.path.join(self._get_tmp_dir(), 'journal.sqlite')
+        # opened for reading only, the missing journal is not created
+        self.assertRaises(sqlite3.OperationalError,
+                          journaler.read_histories, filename)
+        self.assertFalse(os.path.exists(filename))
+
+    @defer.inlineCallbacks
+    def testSegmentCursor(self):
+        writer = journaler.SegmentWriter(self, self._get_tmp_dir(),
+                                         encoding='zip')
+        yield writer.initiate()
+        yield self._assert_cursor(writer)
+        yield writer.close()
+
+    def testReplayProgress(self):
+        calls = []
+        r = replay.Replay(iter(self._generate_rows(5)), 'some id',
+                          on_progress=lambda *args: calls.append(args),
+                          progress_step=2)
+        self.assertEqual((0, None), r.get_progress())
+        self.assertEqual(5, len(list(r)))
+        self.assertEqual((5, None), r.get_progress())
+        self.assertEqual([(2, None), (4, None), (5, None)], calls)
+
+    @defer.inlineCallbacks
+    def _assert_cursor(self, writer):
+        fun_ids = ['1', '2', 'snapshot', '3', '4']
+        yield writer.insert_entries(
+            [self._generate_data(function_id=x) for x in fun_ids]
+            + [self._generate_data(agent_id='other id')])
+        history = (yield writer.get_histories())[0]
+
+        cursor = writer.get_cursor(history, page_size=2)
+        self.assertEqual(5, len(cursor))
+        rows = list(cursor)
+        self.assertEqual(5, cursor.position)
+        self.assertEqual(fun_ids, [self._unpack(x)['fun_id'] for x in rows])
+        self.assertEqual((yield writer.get_entries(history)), rows)
+        self.assertEqual('some id', self._unpack(rows[0])['a_id'])
+        self.assertEqual(('some_id', 1, 0, ),
+                         self.unserializer.convert(rows[0][2]))
+
+        # entries inserted later are not given
+        cursor = writer.get_cursor(history, page_size=2, from_snapshot=True)
+        yield writer.insert_entries([self._generate_data(function_id='5')])
+        self.assertEqual(3, len(cursor))
+        self.assertEqual(['snapshot', '3', '4'],
+                         [self._unpack(x)['fun_id'] for x in cursor])
+
+        # the replay knows the total number of entries of the cursor
+        r = replay.Replay(writer.get_cursor(history), 'some id')
+        self.assertEqual((0, 6), r.get_progress())
+        self.assertEqual(6, len(list(r)))
+        self.assertEqual((6, 6), r.get_progress())
+
+    def _generate_rows(self, num):
+        keys = ('agent_id', 'instance_id', 'journal_id', 'function_id',
+                'fiber_id', 'fiber_depth', 'args', 'kwargs', 'side_effects',
+                'result', 'timestamp')
+        data = self._generate_data()
+        return [[data[key] for key in keys] for _ in range(num)]
+
     def _unpack(self, row):
         keys = ('a_id', 'i_id', 'j_id', 'fun_id', 'f_id',
                 'f_dep', 'args', 'kwargs', 'sfx', 'res', 'time', )
@@ -193,6 +549,42 @@ class DBTests(common.TestCase):
         self.assertEqual(3, self._rotate_called)
         yield jour.close()
 
+    @defer.inlineCallbacks
+    def _assert_spilling_while_inserting(self, writer):
+        used_from = set()
+
+        def record(method):
+
+            def wrapper(*args, **kwargs):
+                used_from.add(threading.current_thread())
+                return method(*args, **kwargs)
+
+            return wrapper
+
+        cache = writer._cache
+        for name in ('fetch', 'commit', 'rollback'):
+            setattr(cache, name, record(getattr(cache, name)))
+
+        first = writer.insert_entries(
+            [self._generate_data(function_id=str(x)) for x in range(5)])
+        # spilled while the first entries are written in the thread
+        second = writer.insert_entries(
+            [self._generate_data(function_id=str(x)) for x in range(5, 10)])
+        yield first
+        yield second
+        yield writer.insert_entries([])
+        self.assertEqual(set([threading.current_thread()]), used_from)
+
+        histories = yield writer.get_histories()
+        entries = yield writer.get_entries(histories[0])
+        self.assertEqual([str(x) for x in range(10)],
+                         [self._unpack(row)['fun_id'] for row in entries])
+
+    def _get_tmp_dir(self):
+        name = tempfile.mkdtemp(suffix='_journal')
+        self.addCleanup(shutil.rmtree, name)
+        return name
+
     def _get_tmp_file(self):
         fd, name = tempfile.mkstemp(suffix='_journal.sqlite')
         self.addCleanup(os.remove, name)
@@ -216,6 +608,20 @@ class DBTests(common.TestCase):
         defaults.update(opts)
         return defaults
 
+    def _generate_log(self, **opts):
+        defaults = {
+            'entry_type': 'log',
+            'level': 1,
+            'log_name': 'some name',
+            'category': 'some category',
+            'file_path': 'some/file.py',
+            'line_num': 42,
+            'message': 'some message',
+            'timestamp': int(time.time())}
+
+        defaults.update(opts)
+        return defaults
+
     @defer.inlineCallbacks
     def _assert_entries(self, jour, num):
         histories = yield jour.get_histories()
@@ -0,0 +1,393 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+from feat.test import common
+from feat.agencies.messaging import net
+from feat.agents.base import message, recipient
+from feat.common import defer
+from feat.extern.txamqp.content import Content
+from feat.extern.txamqp.queue import TimeoutDeferredQueue
+
+
+class DummyAMQPChannel(object):
+
+    id = 1
+
+    def __init__(self):
+        self.calls = []
+        self.published = []
+        self.fail_commit = False
+
+    def channel_open(self):
+        return defer.succeed(None)
+
+    def channel_flow_ok(self, active):
+        self.calls.append(('flow', active))
+        return defer.succeed(None)
+
+    def tx_select(self):
+        self.calls.append('select')
+        return defer.succeed(None)
+
+    def tx_commit(self):
+        if self.fail_commit:
+            return defer.fail(RuntimeError("commit failed"))
+        self.calls.append('commit')
+        return defer.succeed(None)
+
+    def tx_rollback(self):
+        self.calls.append('rollback')
+        return defer.succeed(None)
+
+    def basic_publish(self, exchange, content, routing_key, immediate):
+        self.calls.append(('publish', routing_key))
+        self.published.append(content.body)
+        return defer.succeed(None)
+
+    def exchange_declare(self, exchange, type, durable, nowait, auto_delete):
+        self.calls.append(('exchange', exchange, nowait))
+        return defer.succeed(None)
+
+    def queue_bind(self, exchange, routing_key, queue, nowait):
+        self.calls.append(('bind', exchange, routing_key, nowait))
+        return defer.succeed(None)
+
+    def queue_declare(self, queue, durable, auto_delete):
+        self.calls.append(('declare', queue))
+        return defer.succeed(None)
+
+    def basic_qos(self, prefetch_size, prefetch_count, global_):
+        self.calls.append(('qos', prefetch_count))
+        return defer.succeed(None)
+
+    def basic_consume(self, queue, no_ack):
+        self.calls.append(('consume', queue))
+        return defer.succeed(DummyConsumer(queue))
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        if multiple:
+            self.calls.append(('ack', delivery_tag, 'multiple'))
+        else:
+            self.calls.append(('ack', delivery_tag))
+        return defer.succeed(None)
+
+
+class DummyConsumer(object):
+
+    def __init__(self, consumer_tag):
+        self.consumer_tag = consumer_tag
+
+
+class DummyClient(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+        self._flow_cbs = dict()
+
+    def get_free_channel(self):
+        return defer.succeed(self.channel)
+
+    # called by the broker to stop or restart the flow of a channel
+    add_flow_cb = net.MessagingClient.add_flow_cb.im_func
+    channel_flow = net.MessagingClient.channel_flow.im_func
+
+    def queue(self, consumer_tag):
+        return defer.succeed(TimeoutDeferredQueue())
+
+
+class DummyFactory(object):
+
+    def add_connection_lost_cb(self, cb):
+        pass
+
+
+class DummyDelivery(object):
+
+    def __init__(self, delivery_tag, body=None):
+        self.delivery_tag = delivery_tag
+        self.content = Content(body)
+
+
+class TestChannelBatching(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.amqp = DummyAMQPChannel()
+
+    def create_channel(self, **kwargs):
+        client = DummyClient(self.amqp)
+        channel = net.Channel(self, defer.succeed(client), DummyFactory(),
+                              **kwargs)
+        self.assertTrue(channel._cmp_state(net.ChannelState.performing))
+        return channel
+
+    def publish(self, channel, count):
+        return [channel.publish('key%d' % i, 'shard', message.BaseMessage())
+                for i in range(count)]
+
+    @defer.inlineCallbacks
+    def testPublishInOneTransaction(self):
+        channel = self.create_channel()
+        defers = self.publish(channel, 5)
+        defers.append(channel.ack(DummyDelivery(42)))
+        results = yield defer.DeferredList(defers, fireOnOneErrback=True)
+
+        expected = (['select']
+                    + [('publish', 'key%d' % i) for i in range(5)]
+                    + [('ack', 42), 'commit'])
+        self.assertEqual(expected, self.amqp.calls)
+        for _, msg in results[:5]:
+            self.assertIsInstance(msg, message.BaseMessage)
+
+    @defer.inlineCallbacks
+    def testBatchSize(self):
+        channel = self.create_channel(batch_size=2)
+        yield defer.DeferredList(self.publish(channel, 5),
+                                 fireOnOneErrback=True)
+
+        commits = [i for i, call in enumerate(self.amqp.calls)
+                   if call == 'commit']
+        self.assertEqual([3, 6, 8], commits)
+
+    @defer.inlineCallbacks
+    def testPipelinedDeclarations(self):
+        channel = self.create_channel()
+        defers = [channel.define_exchange('shard'),
+                  channel.create_binding('shard', 'queue', 'key'),
+                  channel.publish('key', 'shard', message.BaseMessage())]
+        self.assertEqual(3, dict(channel.get_stats())['queue depth'])
+        yield defer.DeferredList(defers, fireOnOneErrback=True)
+
+        expected = ['select',
+                    ('exchange', 'shard', True),
+                    ('exchange', 'shard', True),
+                    ('bind', 'shard', 'key', True),
+                    ('publish', 'key'),
+                    'commit']
+        self.assertEqual(expected, self.amqp.calls)
+        stats = dict(channel.get_stats())
+        self.assertEqual(0, stats['queue depth'])
+        self.assertEqual(3, stats['queue max depth'])
+        self.assertEqual(3, stats['performed calls'])
+        self.assertEqual(1, stats['committed batches'])
+
+    @defer.inlineCallbacks
+    def testCommitFailure(self):
+        channel = self.create_channel()
+        self.amqp.fail_commit = True
+        defers = self.publish(channel, 3)
+
+        def recording():
+            return channel._cmp_state(net.ChannelState.recording)
+
+        yield self.wait_for(recording, 1, freq=0.01)
+        self.assertEqual('rollback', self.amqp.calls[-1])
+        self.assertEqual(3, len(channel._processing_chain))
+        self.assertFalse([d for d in defers if d.called])
+
+    @defer.inlineCallbacks
+    def testPublishEnvelopes(self):
+        channel = self.create_channel()
+        body = message.BaseMessage(message_id='id', payload={'a': [1, 2]})
+        envelopes = [body.envelope(recipient.Agent('agent%d' % i, 'shard'))
+                     for i in range(3)]
+        yield defer.DeferredList([channel.publish(m.recipient.key, 'shard', m)
+                                  for m in envelopes], fireOnOneErrback=True)
+
+        self.assertEqual(3, len(self.amqp.published))
+        self.assertEqual(1, len(body._templates._templates))
+        for msg, data in zip(envelopes, self.amqp.published):
+            self.assertEqual(msg, channel.unserializer.convert(data))
+
+
+class TestWrappedQueue(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.amqp = DummyAMQPChannel()
+        client = DummyClient(self.amqp)
+        self.channel = net.Channel(self, defer.succeed(client),
+                                   DummyFactory())
+        self.queue = net.WrappedQueue(self.channel, 'queue',
+                                      ack_size=2, ack_interval=0.1)
+        self.bare_queue = TimeoutDeferredQueue()
+        self.queue.configure(self.bare_queue)
+        self.tag = 0
+
+    def receive(self, msg=None):
+        if msg is None:
+            msg = message.BaseMessage(message_id=str(self.tag))
+        self.tag += 1
+        body = self.channel.serializer.convert(msg)
+        self.bare_queue.put(DummyDelivery(self.tag, body))
+        return msg
+
+    def acks(self):
+        return [x for x in self.amqp.calls if x[0] == 'ack']
+
+    @defer.inlineCallbacks
+    def testAckAfterDelivery(self):
+        messages = [self.receive() for _ in range(3)]
+        yield common.delay(None, 0.01)
+        # received without waiting, not acknowledged before delivery
+        self.assertEqual(3, len(self.queue._messages))
+        self.assertEqual([], self.acks())
+
+        delivered = yield self.queue.get()
+        self.assertEqual(messages[0], delivered)
+        yield common.delay(None, 0.01)
+        self.assertEqual([], self.acks())
+
+        yield self.queue.get()
+        yield common.delay(None, 0.01)
+        self.assertEqual([('ack', 2, 'multiple')], self.acks())
+
+        yield self.queue.get()
+        yield common.delay(None, 0.2)
+        self.assertEqual([('ack', 2, 'multiple'), ('ack', 3, 'multiple')],
+                         self.acks())
+
+    @defer.inlineCallbacks
+    def testDuplicatedMessage(self):
+        msg = self.receive()
+        self.receive(msg)
+        yield common.delay(None, 0.01)
+        # the duplicate can not be acknowledged before the first message
+        self.assertEqual([], self.acks())
+
+        yield self.queue.get()
+        yield common.delay(None, 0.01)
+        self.assertEqual([('ack', 2, 'multiple')], self.acks())
+        self.assertEqual(0, len(self.queue._messages))
+
+    @defer.inlineCallbacks
+    def testPrefetch(self):
+        self.amqp.calls = []
+        yield self.channel.define_queue('other')
+        self.assertEqual([('declare', 'other'), ('qos', 100),
+                          ('consume', 'other')], self.amqp.calls)
+
+        client = DummyClient(self.amqp)
+        channel = net.Channel(self, defer.succeed(client), DummyFactory(),
+                              prefetch_count=0)
+        self.amqp.calls = []
+        yield channel.define_queue('other')
+        self.assertEqual([('declare', 'other'), ('consume', 'other')],
+                         self.amqp.calls)
+
+
+class TestChannelPool(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.amqps = [DummyAMQPChannel() for _ in range(3)]
+        self.clients = [defer.succeed(DummyClient(x)) for x in self.amqps]
+        # the connection of the last channel is not established
+        self.clients[-1] = defer.Deferred()
+        self.channels = [net.Channel(self, x, DummyFactory())
+                         for x in self.clients]
+        self.pool = net.ChannelPool(self, self.channels)
+
+    def published(self, amqp):
+        return [x[1] for x in amqp.calls if x[0] == 'publish']
+
+    @defer.inlineCallbacks
+    def testPublishByKey(self):
+        keys = ['key%d' % i for i in range(20)]
+        defers = [self.pool.publish(key, 'shard', message.BaseMessage())
+                  for key in keys * 2]
+        stats = dict(self.pool.get_stats())
+        self.assertEqual(3, stats['pool channels'])
+        self.assertEqual(2, stats['pool connected channels'])
+
+        # the disconnected channel does not delay the other ones
+        yield common.delay(None, 0.05)
+        waiting = [key for key, d in zip(keys * 2, defers) if not d.called]
+        self.assertTrue(waiting)
+        for amqp in self.amqps[:2]:
+            published = self.published(amqp)
+            self.assertTrue(published)
+            self.assertEqual(published[:len(published) / 2],
+                             published[len(published) / 2:])
+            self.assertFalse(set(published) & set(waiting))
+        self.assertEqual(len(waiting),
+                         dict(self.pool.get_stats())['pool queue depth'])
+
+        # the recorded publications are performed once it connects
+        self.clients[-1].callback(DummyClient(self.amqps[-1]))
+        yield defer.DeferredList(defers, fireOnOneErrback=True)
+        self.assertEqual(waiting, self.published(self.amqps[-1]))
+        self.assertEqual(3, dict(self.pool.get_stats())[
+            'pool connected channels'])
+
+    @defer.inlineCallbacks
+    def testFlowControl(self):
+        client = self.channels[0].client
+        amqp = self.amqps[0]
+        keys = ['key%d' % i for i in range(20)]
+        mine = [key for key in keys
+                if self.pool._channels[hash(('shard', key)) % 3]
+                is self.channels[0]]
+        self.assertTrue(mine)
+
+        client.channel_flow(amqp, False)
+        self.assertEqual(('flow', False), amqp.calls[-1])
+        self.assertEqual(1, dict(self.pool.get_stats())[
+            'pool paused channels'])
+        defers = [self.pool.publish(key, 'shard', message.BaseMessage())
+                  for key in keys]
+        acked = self.channels[0].ack(DummyDelivery(1))
+        yield common.delay(None, 0.05)
+
+        # the paused channel keeps its messages, the other ones publish
+        self.assertEqual([], self.published(amqp))
+        self.assertTrue(self.published(self.amqps[1]))
+        waiting = [d for key, d in zip(keys, defers) if key in mine]
+        self.assertFalse([d for d in waiting if d.called])
+        self.assertEqual(len(mine), dict(self.pool.get_stats())[
+            'pool paused publications'])
+        # the acknowledgment queued after them does not wait
+        self.assertTrue(acked.called)
+        self.assertEqual([('flow', False), ('ack', 1), 'commit'],
+                         amqp.calls[-3:])
+
+        client.channel_flow(amqp, True)
+        self.assertEqual(0, dict(self.pool.get_stats())[
+            'pool paused channels'])
+        yield defer.DeferredList(waiting, fireOnOneErrback=True)
+        self.assertEqual(mine, self.published(amqp))
+        self.assertEqual('commit', amqp.calls[-1])
+        self.assertEqual(0, dict(self.pool.get_stats())[
+            'pool paused publications'])
+
+        # the publications queued after the restart are sent after them
+        client.channel_flow(amqp, False)
+        first = self.pool.publish(mine[0], 'shard', message.BaseMessage())
+        yield common.delay(None, 0.05)
+        self.channels[0].create_binding('exchange', 'queue', 'binding')
+        yield common.delay(None, 0.05)
+        self.assertEqual(('bind', 'exchange', 'binding', True),
+                         amqp.calls[-2])
+        self.assertFalse(first.called)
+        client.channel_flow(amqp, True)
+        second = self.pool.publish(mine[1], 'shard', message.BaseMessage())
+        yield defer.DeferredList([first, second], fireOnOneErrback=True)
+        self.assertEqual([mine[0], mine[1]], self.published(amqp)[-2:])
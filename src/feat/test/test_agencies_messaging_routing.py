@@ -426,3 +426,146 @@ class TestRouting(common.TestCase):
         m_id = msg.message_id
         m_ids = [msg.message_id for msg in sink.messages]
         self.assertFalse(m_id in m_ids, "Messages are: %r" % (sink.messages, ))
+
+
+class Recorder(BaseDummySink):
+
+    def init(self):
+        self.delivered = self.table.delivered
+
+    def on_message(self, message):
+        self.delivered.append(self)
+
+
+class TestTable(common.TestCase):
+
+    def setUp(self):
+        self.table = routing.Table(self)
+        self.table.delivered = []
+
+    def sink(self, priority, final, key=('agent', 'shard')):
+        sink = Recorder(self, self.table, key=key)
+        route = sink.create_route(priority=priority, final=final)
+        self.table.append_route(route)
+        return sink, route
+
+    def testPriorityOrder(self):
+        first, _ = self.sink(10, False)
+        second, _ = self.sink(0, False)
+        third, _ = self.sink(10, True)
+        fourth, _ = self.sink(20, True)
+        other, _ = self.sink(0, True, key=('other', 'shard'))
+
+        self.table.dispatch(direct(('agent', 'shard')), outgoing=False)
+        self.assertEqual([second, first, third], self.table.delivered)
+
+    def testRemoveRoute(self):
+        first, first_route = self.sink(0, True)
+        second, second_route = self.sink(10, True)
+
+        self.table.remove_route(first_route)
+        self.table.dispatch(direct(('agent', 'shard')), outgoing=False)
+        self.assertEqual([second], self.table.delivered)
+
+        self.table.remove_route(first_route)
+        self.table.remove_sink(second)
+        self.table.dispatch(direct(('agent', 'shard')), outgoing=False)
+        self.assertEqual([second], self.table.delivered)
+        self.assertEqual({}, self.table._routes)
+
+
+class TestMessageStore(common.TestCase):
+
+    implements(ITimeProvider)
+
+    def get_time(self):
+        return self._time
+
+    def setUp(self):
+        self._time = time.time()
+        self.store = routing.MessageStore(self)
+        self.sink = BaseDummySink(self)
+
+    def route(self, key, final=True):
+        return routing.Route(self.sink, key, final=final)
+
+    def message(self, key, expiration=10, payload=None):
+        m = direct(key, expiration_time=self._time + expiration)
+        if payload is not None:
+            m.payload = payload
+        self.store.insert(m)
+        return m
+
+    def assertMatch(self, expected, route):
+        matched = self.store.match_to_route(route)
+        self.assertEqual([x.message_id for x in expected],
+                         [x.message_id for x in matched])
+
+    def testMatchByKey(self):
+        key = ('agent', 'shard')
+        m1 = self.message(key)
+        m2 = self.message(('other', 'shard'))
+        m3 = self.message(key, expiration=5)
+        self.store.insert(direct(key))
+        self.assertEqual(3, len(self.store))
+
+        self.assertMatch([m1, m3], self.route(key, final=False))
+        self.assertMatch([m1, m3], self.route(key))
+        self.assertMatch([], self.route(key))
+        self.assertEqual(1, len(self.store))
+
+        self.store.remove(m2)
+        self.assertMatch([], self.route(('other', 'shard')))
+        self.assertEqual(0, len(self.store))
+        self.assertEqual(0, self.store.size)
+        self.assertEqual({}, self.store._index)
+
+    def testExpiration(self):
+        key = ('agent', 'shard')
+        m1 = self.message(key, expiration=1)
+        m2 = self.message(key, expiration=3)
+        self.message(key, expiration=-1)
+        self.assertEqual(2, len(self.store))
+
+        self._time += 2
+        self.assertMatch([m2], self.route(key, final=False))
+        self.assertEqual(1, len(self.store))
+        self._time += 2
+        self.assertMatch([], self.route(key))
+        self.assertEqual(0, len(self.store))
+        self.assertEqual([], self.store._heap)
+
+    def testExpirationCompactingHeap(self):
+        key = ('agent', 'shard')
+        self.message(key, expiration=1)
+        removed = ('removed', 'shard')
+        for _ in range(200):
+            self.message(removed)
+        live = [self.message(key) for _ in range(99)]
+        self.assertEqual(200, len(self.store.match_to_route(
+            self.route(removed))))
+
+        # expiring the message compacts the heap of the removed entries
+        self._time += 2
+        m = self.message(key)
+        self.assertEqual(100, len(self.store))
+        self.assertMatch(live + [m], self.route(key))
+
+    def testLimits(self):
+        key = ('agent', 'shard')
+        self.store = routing.MessageStore(self, max_messages=2)
+        m1 = self.message(key, expiration=3)
+        m2 = self.message(key, expiration=1)
+        m3 = self.message(key, expiration=2)
+        self.assertEqual(2, len(self.store))
+        # the message the closest to expiration is dropped
+        self.assertMatch([m1, m3], self.route(key))
+
+        self.store = routing.MessageStore(self, max_messages=None,
+                                          max_bytes=10000)
+        m1 = self.message(key, expiration=1, payload={'data': 'x' * 6000})
+        m2 = self.message(key, expiration=2)
+        m3 = self.message(key, expiration=3, payload={'data': 'x' * 6000})
+        self.assertTrue(self.store.size <= 10000)
+        self.assertMatch([m2, m3], self.route(key))
+        self.assertEqual(0, self.store.size)
@@ -40,6 +40,7 @@ class DummyAgency(pb.Referenceable, log.Logger, log.LogProxy):
         log.Logger.__init__(self, self)
 
         self.agency_id = str(uuid.uuid1())
+        self.window = None
 
         self.broker = broker.Broker(
             self,
@@ -56,11 +57,11 @@ class DummyAgency(pb.Referenceable, log.Logger, log.LogProxy):
         return self.broker.disconnect()
 
     def on_become_master(self):
-        backend = unix.Master(self.broker)
+        backend = unix.Master(self.broker, window=self.window)
         return self.messaging.add_backend(backend, can_become_outgoing=False)
 
     def on_become_slave(self):
-        backend = unix.Slave(self.broker)
+        backend = unix.Slave(self.broker, window=self.window)
         return self.messaging.add_backend(backend)
 
     def on_broker_disconnect(self, pre_state):
@@ -132,6 +133,102 @@ class UnixSocketMessagingTest(common.TestCase):
         yield self.wait_for(connections[1].has_messages(3), 1, 0.02)
         yield self.wait_for(connections[2].has_messages(3), 1, 0.02)
 
+    @defer.inlineCallbacks
+    def testStreams(self):
+        connections = list()
+        for agency in self.agencies:
+            agency.window = 4
+            yield agency.initiate()
+            con = yield agency.get_connection()
+            connections.append(con)
+
+        for agency in self.agencies[1:]:
+            backend = agency.messaging._backends['unix']
+            self.assertTrue(backend._stream is not None)
+
+        recp = recipient.Agent('agent_id', 'shard')
+        connections[2].create_binding(recp)
+        yield common.delay(None, 0.05)
+
+        # more messages than the window, they wait for the credit
+        for _ in range(20):
+            connections[0].post(recp, msg())
+            connections[1].post(recp, msg())
+        yield self.wait_for(connections[2].has_messages(40), 1, 0.02)
+
+    @defer.inlineCallbacks
+    def testStreamLostWithQueuedMessages(self):
+        connections = list()
+        for agency in self.agencies:
+            yield agency.initiate()
+            con = yield agency.get_connection()
+            connections.append(con)
+
+        recp = recipient.Agent('agent_id', 'shard')
+        connections[2].create_binding(recp)
+        yield common.delay(None, 0.05)
+
+        # the window of the slave is exhausted, its messages are queued
+        slave = self.agencies[1].messaging._backends['unix']
+        stream = slave._stream
+        stream._credit = 0
+        for _ in range(10):
+            connections[1].post(recp, msg())
+        yield common.delay(None, 0.05)
+        self.assertEqual(10, len(stream._queue))
+        self.assertEqual(0, len(connections[2].messages))
+
+        # they go through PB once the stream is lost
+        stream.transport.loseConnection()
+        yield self.wait_for(connections[2].has_messages(10), 1, 0.02)
+        self.assertTrue(slave._stream is None)
+
+        # same for the messages the master queued for a slave
+        master = self.agencies[0].get_broker_backend()
+        stream = self.agencies[2].messaging._backends['unix']._stream
+        master_stream = master._streams[stream.stream_id]
+        master_stream._credit = 0
+        for _ in range(10):
+            connections[1].post(recp, msg())
+        yield self.wait_for(lambda: len(master_stream._queue) == 10, 1, 0.02)
+        master_stream.transport.loseConnection()
+        yield self.wait_for(connections[2].has_messages(20), 1, 0.02)
+
+    @defer.inlineCallbacks
+    def testStreamDroppedBeforeHello(self):
+        yield self._assert_stream_failed(
+            lambda stream: stream.transport.loseConnection())
+
+    @defer.inlineCallbacks
+    def testStreamNeverAnswered(self):
+        self.patch(unix, 'STREAM_TIMEOUT', 0.1)
+        yield self._assert_stream_failed(lambda stream: None)
+
+    @defer.inlineCallbacks
+    def _assert_stream_failed(self, stream_opened):
+        yield self.agencies[0].initiate()
+        master = self.agencies[0].get_broker_backend()
+        # the master does not answer the hello of the slave
+        master._stream_opened = stream_opened
+
+        yield self.agencies[1].initiate()
+        backend = self.agencies[1].messaging._backends['unix']
+        self.assertTrue(backend._stream is None)
+        self.assertTrue(backend._stream_ready is None)
+
+        connections = list()
+        for agency in self.agencies[:2]:
+            con = yield agency.get_connection()
+            connections.append(con)
+
+        # the messages go through PB
+        recp = recipient.Agent('agent_id', 'shard')
+        connections[0].create_binding(recp)
+        yield common.delay(None, 0.05)
+        for _ in range(5):
+            connections[1].post(recp, msg())
+        yield self.wait_for(connections[0].has_messages(5), 1, 0.02)
+
     def _delete_socket_file(self):
         try:
             os.unlink(self.agencies[0].broker.socket_path)
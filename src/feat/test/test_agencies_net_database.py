@@ -0,0 +1,378 @@
+import json
+import urlparse
+
+from twisted.internet import reactor
+from twisted.trial.unittest import SkipTest
+from twisted.web import resource, server
+
+try:
+    from feat.agencies.net import database
+except ImportError as e:
+    database = None
+    import_error = e
+
+from feat.test import common
+
+from feat.common import defer, time
+
+from feat.agencies.interface import ConflictError, NotFoundError
+from feat.agents.base import document, view
+
+
+@document.register
+class CachedDocument(document.Document):
+
+    document_type = 'cached-net-test_document'
+    cached = True
+    document.field('field', 0)
+
+
+class CouchDBStandIn(resource.Resource):
+    '''
+    Answers the document requests of a single database like CouchDB
+    does, after a delay.
+    '''
+
+    isLeaf = True
+
+    def __init__(self, delay):
+        resource.Resource.__init__(self)
+        self.delay = delay
+        self.documents = dict()
+        self.active = 0
+        self.max_active = 0
+        self.finished = 0
+        # [(seq, doc_id, rev, deleted)]
+        self.changes = []
+        # requests of the continuous _changes feeds
+        self.feeds = []
+
+    def render(self, request):
+        if request.path.endswith("/_changes"):
+            return self._feed(request)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        status, result = self._process(request)
+        time.call_later(self.delay, self._finish, request, status, result)
+        return server.NOT_DONE_YET
+
+    def _process(self, request):
+        parts = request.path.strip("/").split("/")
+        if len(parts) == 1:
+            if request.method == "GET":
+                return 200, {"update_seq": len(self.changes)}
+            return 201, {"ok": True}
+        doc_id = parts[1]
+        if doc_id == "_design":
+            return 200, self._view(request)
+        if doc_id == "_bulk_docs":
+            body = json.loads(request.content.read())
+            results = []
+            for doc in body["docs"]:
+                status, result = self._save(doc["_id"], doc)
+                result.setdefault("id", doc["_id"])
+                results.append(result)
+            return 201, results
+        if doc_id == "_all_docs":
+            keys = json.loads(request.content.read())["keys"]
+            rows = [dict(key=key, doc=self.documents[key])
+                    if key in self.documents
+                    else dict(key=key, error="not_found")
+                    for key in keys]
+            return 200, {"rows": rows}
+        doc = self.documents.get(doc_id)
+        if request.method == "GET":
+            if doc is None:
+                return 404, {"error": "not_found"}
+            return 200, doc
+        if request.method == "DELETE":
+            rev = urlparse.parse_qs(urlparse.urlparse(request.uri).query)
+            if doc is None or doc["_rev"] != rev["rev"][0]:
+                return 409, {"error": "conflict"}
+            del self.documents[doc_id]
+            self.change(doc_id, "0-deleted", True)
+            return 200, {"ok": True, "id": doc_id}
+        return self._save(doc_id, json.loads(request.content.read()))
+
+    def _view(self, request):
+        # the documents by id, with their field as value
+        args = dict((k, json.loads(v[0])) for k, v in request.args.items()
+                    if k != "startkey_docid")
+        rows = [{"id": doc_id, "key": doc_id, "value": doc.get("field")}
+                for doc_id, doc in sorted(self.documents.items())
+                if doc_id >= args.get("startkey", "")]
+        return {"total_rows": len(self.documents), "offset": 0,
+                "rows": rows[:args.get("limit")]}
+
+    def _save(self, doc_id, body):
+        doc = self.documents.get(doc_id)
+        if doc is not None and doc["_rev"] != body.get("_rev"):
+            return 409, {"error": "conflict", "reason": "Document conflict"}
+        if body.get("_deleted"):
+            del self.documents[doc_id]
+            self.change(doc_id, "0-deleted", True)
+            return 200, {"ok": True, "id": doc_id, "rev": "0-deleted"}
+        revision = int(doc["_rev"].split("-")[0]) + 1 if doc else 1
+        body["_id"] = doc_id
+        body["_rev"] = "%d-%s" % (revision, doc_id)
+        self.documents[doc_id] = body
+        self.change(doc_id, body["_rev"])
+        return 201, {"ok": True, "id": doc_id, "rev": body["_rev"]}
+
+    def change(self, doc_id, rev, deleted=False):
+        self.changes.append((len(self.changes) + 1, doc_id, rev, deleted))
+        for request in self.feeds:
+            self._write_change(request, self.changes[-1])
+
+    def close_feeds(self):
+        for request in list(self.feeds):
+            request.transport.loseConnection()
+
+    def _feed(self, request):
+        since = int(request.args["since"][0])
+        self.feeds.append(request)
+        request.notifyFinish().addBoth(lambda _: self.feeds.remove(request))
+        for change in self.changes[since:]:
+            self._write_change(request, change)
+        # the heartbeat
+        request.write("\n")
+        return server.NOT_DONE_YET
+
+    def _write_change(self, request, change):
+        seq, doc_id, rev, deleted = change
+        line = {"seq": seq, "id": doc_id, "changes": [{"rev": rev}]}
+        if deleted:
+            line["deleted"] = True
+        if request.args.get("include_docs") == ["true"]:
+            line["doc"] = self.documents.get(doc_id, {"_id": doc_id})
+        request.write(json.dumps(line) + "\n")
+
+    def _finish(self, request, status, result):
+        self.active -= 1
+        self.finished += 1
+        request.setResponseCode(status)
+        request.write(json.dumps(result))
+        request.finish()
+
+
+class TestDatabase(common.TestCase):
+
+    timeout = 10
+
+    def setUp(self):
+        if database is None:
+            raise SkipTest('Skipping the test because of missing '
+                           'dependecies: %r' % import_error)
+        self.couchdb = CouchDBStandIn(0.05)
+        self.listener = reactor.listenTCP(0, server.Site(self.couchdb),
+                                          interface="127.0.0.1")
+        self.port = self.listener.getHost().port
+        self.database = database.Database("127.0.0.1", self.port, "test",
+                                          connections=4)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.database.disconnect()
+        # the changes feeds are closed
+        yield self.wait_for(lambda: not self.couchdb.feeds, 5, 0.01)
+        yield self.listener.stopListening()
+        yield common.TestCase.tearDown(self)
+
+    @defer.inlineCallbacks
+    def testDocuments(self):
+        resp = yield self.database.save_doc('{"field": 1}', "doc")
+        self.assertEqual("1-doc", resp["rev"])
+        doc = yield self.database.open_doc("doc")
+        self.assertEqual(1, doc["field"])
+
+        d = self.database.save_doc('{"field": 2}', "doc")
+        self.assertFailure(d, ConflictError)
+        yield d
+
+        yield self.database.delete_doc("doc", "1-doc")
+        d = self.database.open_doc("doc")
+        self.assertFailure(d, NotFoundError)
+        yield d
+
+    @defer.inlineCallbacks
+    def testBulkDocuments(self):
+        docs = ['{"_id": "doc%d", "field": %d}' % (i, i) for i in range(3)]
+        ids = ["doc%d" % (i, ) for i in range(3)]
+        results = yield self.database.save_docs(docs, ids)
+        self.assertEqual(["1-doc0", "1-doc1", "1-doc2"],
+                         [r["rev"] for r in results])
+        self.assertEqual(1, self.couchdb.finished)
+
+        fetched = yield self.database.open_docs(ids + ["missing"])
+        self.assertEqual([0, 1, 2], [doc["field"] for doc in fetched[:3]])
+        self.assertEqual(None, fetched[3])
+
+        results = yield self.database.delete_docs(
+            [("doc0", "1-doc0"), ("doc1", "2-doc1")])
+        self.assertFalse("error" in results[0])
+        self.assertEqual("conflict", results[1]["error"])
+        self.assertEqual(["doc1", "doc2"], sorted(self.couchdb.documents))
+        self.assertEqual({}, self.database._document_locks)
+
+    @defer.inlineCallbacks
+    def testConcurrentRequests(self):
+        for i in range(10):
+            self.couchdb.documents["doc%d" % (i, )] = {"_rev": "1-x"}
+        docs = yield defer.join(*[self.database.open_doc("doc%d" % (i, ))
+                                  for i in range(10)])
+        self.assertEqual(10, len(docs))
+        self.assertEqual(4, self.couchdb.max_active)
+
+    @defer.inlineCallbacks
+    def testDocumentOrdering(self):
+        order = []
+
+        def notified(name):
+            order.append((name, self.couchdb.finished))
+
+        d = self.database.save_doc('{"field": 1}', "doc")
+        # the notification of the change waits for the request in flight
+        # for the same document, not the ones for the other documents
+        self.database.run_for_document("doc", notified, "doc")
+        self.database.run_for_document("other", notified, "other")
+        yield d
+        self.assertEqual([("other", 0), ("doc", 1)], order)
+        self.assertEqual({}, self.database._document_locks)
+
+    @defer.inlineCallbacks
+    def testDocumentCache(self):
+        self.database.disconnect()
+        self.database = database.Database("127.0.0.1", self.port, "test",
+                                          connections=4, cache_size=4)
+        connection = self.database.get_connection()
+        yield connection.save_document(CachedDocument(doc_id=u'doc'))
+        # the cache listens to the changes
+        yield self._wait_feed()
+        yield connection.get_document(u'doc')
+        self.assertEqual(2, self.couchdb.finished)
+
+        # changed by an other agency
+        self.couchdb.documents['doc']['field'] = 1
+        self.couchdb.documents['doc']['_rev'] = '2-doc'
+        self.couchdb.change('doc', '2-doc')
+        yield common.delay(None, 0.01)
+        self.assertFalse(u'doc' in self.database.cache)
+
+        doc = yield connection.get_document(u'doc')
+        self.assertEqual(1, doc.field)
+        stats = dict(self.database.get_stats())
+        self.assertEqual(1, stats['cache hits'])
+        self.assertEqual(1, stats['cache invalidations'])
+
+    @defer.inlineCallbacks
+    def testDocumentChangedWhileFetched(self):
+        self.database.disconnect()
+        self.database = database.Database("127.0.0.1", self.port, "test",
+                                          connections=4, cache_size=4)
+        connection = self.database.get_connection()
+        yield connection.save_document(CachedDocument(doc_id=u'doc'))
+        yield self._wait_feed()
+        self.database.cache.clear()
+
+        d = connection.get_document(u'doc')
+        # the change is notified once the request in flight is finished
+        self.database.run_for_document(
+            u'doc', self.database.notify_change, u'doc', '2-doc', False)
+        yield self.wait_for(lambda: self.couchdb.active, 5, 0.01)
+        self.couchdb.documents['doc'] = dict(self.couchdb.documents['doc'],
+                                             field=1, _rev='2-doc')
+        doc = yield d
+        self.assertEqual('1-doc', doc.rev)
+        self.assertFalse(u'doc' in self.database.cache)
+
+        doc = yield connection.get_document(u'doc')
+        self.assertEqual('2-doc', doc.rev)
+        self.assertEqual(1, doc.field)
+        self.assertEqual({}, self.database.cache._requests)
+
+    @defer.inlineCallbacks
+    def testChangesFeed(self):
+        yield self.database.save_doc('{"field": 0}', "old")
+        calls = []
+        yield self.database.listen_changes(
+            ["doc", "old"], lambda *args: calls.append(("doc", ) + args))
+        view_listener = yield self.database.listen_changes(
+            FieldView, lambda *args: calls.append(("view", ) + args))
+        yield self._wait_feed(include_docs=["true"])
+        # one stream for all the filters, from the current sequence
+        yield self.wait_for(lambda: len(self.couchdb.feeds) == 1, 5, 0.01)
+        self.assertEqual(["1"], self.couchdb.feeds[0].args["since"])
+        yield self.database.save_doc('{"field": 1}', "doc")
+        yield self.database.save_doc('{"field": 1}', "other")
+        yield common.delay(None, 0.01)
+        self.assertEqual([("doc", "doc", "1-doc", False),
+                          ("view", "doc", "1-doc", False),
+                          ("view", "other", "1-other", False)],
+                         sorted(calls))
+
+        # the changes made while the feed is down are not lost
+        del calls[:]
+        self.couchdb.close_feeds()
+        yield self.database.save_doc('{"field": 1, "_rev": "1-doc"}', "doc")
+        yield self.database.delete_doc("old", "1-old")
+        yield self._wait_feed(include_docs=["true"])
+        yield common.delay(None, 0.01)
+        self.assertEqual([("doc", "doc", "2-doc", False),
+                          ("doc", "old", "0-deleted", True),
+                          ("view", "doc", "2-doc", False)],
+                         sorted(calls))
+
+        # the documents are only read for the view filters
+        self.assertEqual(["true"], self.couchdb.feeds[0].args["include_docs"])
+        yield self.database.cancel_listener(view_listener)
+        yield self._wait_feed(include_docs=None)
+
+    @defer.inlineCallbacks
+    def testViewCursor(self):
+        for i in range(5):
+            yield self.database.save_doc('{"field": %d}' % (i, ), "doc%d" % i)
+        connection = self.database.get_connection()
+        cursor = connection.iter_view(FieldView, page_size=2)
+        pages = []
+        while not cursor.finished:
+            page = yield cursor.next_page()
+            pages.append(page)
+        self.assertEqual([[0, 1], [2, 3], [4]], pages)
+
+        rows = yield self.database.query_view(FieldView, startkey="doc3")
+        self.assertEqual([("doc3", 3), ("doc4", 4)], rows)
+
+    def testViewRowParser(self):
+        rows = []
+        parser = database.ViewRowParser(rows.append)
+        body = json.dumps({"total_rows": 2, "offset": 0, "rows": [
+            {"id": "a", "key": ["a", "]}"], "value": {"v": [1, {}]}},
+            {"id": "b", "key": "\\\"{", "value": None}]})
+        # the rows are parsed as they are received
+        for char in body:
+            parser.feed(char)
+        self.assertEqual(None, parser.finish())
+        self.assertEqual(["a", "b"], [row["id"] for row in rows])
+        self.assertEqual(["a", "]}"], rows[0]["key"])
+        self.assertEqual({"v": [1, {}]}, rows[0]["value"])
+        self.assertEqual("\\\"{", rows[1]["key"])
+
+        parser = database.ViewRowParser(lambda row: 1 / 0)
+        parser.feed(body)
+        self.assertTrue(parser.finish().check(ZeroDivisionError))
+
+    def _wait_feed(self, include_docs=None):
+
+        def check():
+            return any(request.args.get("include_docs") == include_docs
+                       for request in self.couchdb.feeds)
+
+        return self.wait_for(check, 5, 0.01)
+
+
+class FieldView(view.BaseView):
+
+    name = 'field'
+
+    def filter(doc, request):
+        return doc.get('field') == 1
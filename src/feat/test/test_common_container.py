@@ -584,6 +584,103 @@ class TestExpQueue(common.TestCase):
                                          (None, 1)])))
 
 
+class TestExpSet(common.TestCase):
+
+    def testBasicOperations(self):
+        s = ExpSet(self)
+        s.add("spam")
+        s.add("bacon")
+        self.assertTrue("spam" in s)
+        self.assertTrue("bacon" in s)
+        self.assertFalse("eggs" in s)
+        self.assertEqual(len(s), 2)
+        s.clear()
+        self.assertFalse("spam" in s)
+        self.assertEqual(len(s), 0)
+
+    def testExpiration(self):
+        t = DummyTimeProvider(0)
+        s = ExpSet(t, period=10)
+        s.add("spam", 0) # Expire right away
+        self.assertEqual(s.size(), 0)
+        s.add("spam", t.time + 5)
+        s.add("bacon", t.time + 15)
+        s.add("eggs", t.time + 25)
+        s.add("beans")
+        self.assertEqual(len(s), 4)
+
+        # the keys expire on time, before their generation is dropped
+        t.time += 4
+        self.assertTrue("spam" in s)
+        t.time += 1
+        self.assertFalse("spam" in s)
+        self.assertEqual(len(s), 3)
+        self.assertEqual(s.size(), 4)
+        t.time += 5
+        s.pack()
+        self.assertEqual(s.size(), 3)
+
+        # adding a key again keeps it until its last expiration
+        s.add("bacon", t.time + 25)
+        t.time += 20
+        self.assertEqual(len(s), 2)
+        self.assertTrue("bacon" in s)
+        self.assertFalse("eggs" in s)
+
+        t.time += 100
+        self.assertEqual(len(s), 1)
+        self.assertTrue("beans" in s)
+
+    def testRelativeExpiration(self):
+        t = DummyTimeProvider(0)
+        s = ExpSet(t, period=1)
+        s.add("spam", 5, relative=True)
+        t.time += 4
+        self.assertTrue("spam" in s)
+        t.time += 2
+        self.assertFalse("spam" in s)
+
+    def testExpiredKeyAddedAgain(self):
+        t = DummyTimeProvider(0)
+        s = ExpSet(t, period=10)
+        s.add("spam", 1)
+        t.time += 1
+        self.assertFalse("spam" in s)
+        s.add("spam", t.time + 1)
+        self.assertTrue("spam" in s)
+        t.time += 1
+        self.assertFalse("spam" in s)
+
+    def testKeyAddedManyTimes(self):
+        t = DummyTimeProvider(0)
+        s = ExpSet(t, period=10)
+        for _ in range(3):
+            s.add("beans")
+            s.add("spam", 2)
+            s.add("spam", 3)
+        self.assertEqual(s.size(), 2)
+        self.assertEqual(len(s), 2)
+        # nothing is remembered per addition of a permanent key
+        self.assertEqual({1: ["spam"] * 6}, s._generations)
+
+        # a permanent key expiring later is not permanent anymore
+        s.add("beans", 5)
+        t.time += 3
+        self.assertEqual(len(s), 1)
+        self.assertFalse("spam" in s)
+        t.time += 2
+        self.assertEqual(len(s), 0)
+        self.assertEqual(s.size(), 2)
+
+        # an expiring key made permanent is kept with its generation
+        s.add("eggs", 8)
+        s.add("eggs")
+        t.time += 10
+        s.pack()
+        self.assertEqual(s.size(), 1)
+        self.assertTrue("eggs" in s)
+
+
 class TestReplayability(common.TestCase):
 
     def setUp(self):
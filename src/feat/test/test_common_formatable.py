@@ -37,6 +37,12 @@ class Child(Base):
     formatable.field('field3', None)
 
 
+@serialization.register
+class Single(formatable.Formatable):
+
+    formatable.field('values', [])
+
+
 class TestFormatable(common.TestCase):
 
     def setUp(self):
@@ -87,3 +93,23 @@ class TestFormatable(common.TestCase):
         base = Base(field1=0, field2=[])
         self.assertEqual(0, base.field1)
         self.assertEqual([], base.field2)
+
+    def testLayout(self):
+        self.assertEqual(set(['field1', 'field2']),
+                         Base._get_layout().names)
+        self.assertEqual(set(['field1', 'field2', 'field3']),
+                         Child._get_layout().names)
+        self.assertEqual({'field1': 'overwritten default',
+                          'custom_serializable': 5}, Child().snapshot())
+        self.assertEqual({'values': []}, Single().snapshot())
+
+    def testMutableDefaults(self):
+        a = Single()
+        b = Single()
+        a.values.append(1)
+        self.assertEqual([], b.values)
+
+        instance = Single.__new__(Single)
+        instance.recover({})
+        self.assertEqual([], instance.values)
+        self.assertFalse(instance.values is a.values)
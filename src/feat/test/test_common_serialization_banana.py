@@ -26,12 +26,14 @@
 import itertools
 import types
 
-from twisted.spread import jelly
+from cStringIO import StringIO
+
+from twisted.spread import banana as twisted_banana, jelly
 
 from feat.common.serialization import banana
 from feat.interface.serialization import *
 
-from . import common_serialization
+from . import common, common_serialization
 
 
 class BananaConvertersTest(common_serialization.ConverterTest):
@@ -42,5 +44,88 @@ class BananaConvertersTest(common_serialization.ConverterTest):
         self.serializer = banana.Serializer(externalizer = ext)
         self.unserializer = banana.Unserializer(externalizer = ext)
 
+    def testAcyclic(self):
+        serializer = banana.Serializer(externalizer=self.externalizer,
+                                       acyclic=True)
+        value = [common_serialization.SerializableDummy(),
+                 {1: (2, 3), "a": [u"b", 4.5]}, set([6])]
+        self.assertEqual(self.serializer.convert(value),
+                         serializer.convert(value))
+
+        shared = [1, 2]
+        result = self.unserializer.convert(serializer.convert([shared,
+                                                               shared]))
+        self.assertEqual([[1, 2], [1, 2]], result)
+        self.assertFalse(result[0] is result[1])
+
+    def testTemplate(self):
+        value = common_serialization.SerializableDummy()
+        value.str = "shared"
+        value.list = [1, 2]
+        template = self.serializer.template(value, ("str", "int"))
+
+        for str_value in ("foo", "bar", None):
+            value.str = str_value
+            result = self.unserializer.convert(template.complete(value))
+            self.assertEqual(value, result)
+
+        serializer = banana.Serializer(source_ver=1, target_ver=2)
+        self.assertRaises(ValueError, serializer.template, value, ("str", ))
+
     def testHelperFunctions(self):
         self.checkSymmetry(banana.serialize, banana.unserialize)
+
+
+class BananaCodecTest(common.TestCase):
+
+    def setUp(self):
+        self.protocol = twisted_banana.Banana()
+        self.protocol.connectionMade()
+        self.protocol._selectDialect("pb")
+
+    def testWireCompatibility(self):
+        values = [[], [[]], [1, [2, [3, []]]], ("a", "b"),
+                  0, 1, 127, 128, 2**14, 2**31 - 1, 2**31, 2**100,
+                  -1, -128, -2**31, -2**31 - 1, -2**100,
+                  True, False, 0.0, 3.141, -1e-20,
+                  "", "dummy", "\x00\xFF" * 100, "x" * 200,
+                  "None", "list", "tuple", "dictionary", "reference",
+                  ["instance", "dummy", ["dictionary", ["a", 1]]]]
+
+        for value in values:
+            data = banana.encode([value])
+            self.assertEqual(self.twisted_encode([value]), data)
+            self.assertEqual(self.twisted_decode(data), banana.decode(data))
+
+    def testDecodeMany(self):
+        values = [[1, "a"], ["None", [2.5]], []]
+        data = "".join([banana.encode(v) for v in values])
+        self.assertEqual(values, banana.decode_many(data))
+        self.assertEqual([1, "a"], banana.decode(data))
+        self.assertEqual([], banana.decode_many(""))
+
+    def testErrors(self):
+        self.assertRaises(banana.BananaError, banana.encode, [u"unicode"])
+        self.assertRaises(banana.BananaError, banana.encode, [2**500])
+        self.assertRaises(banana.BananaError, banana.encode, [-2**500])
+        self.assertRaises(banana.BananaError, banana.encode, [None])
+
+        data = banana.encode([1, "dummy", 2.5])
+        for index in range(len(data)):
+            self.assertRaises(banana.BananaError,
+                              banana.decode, data[:index])
+        self.assertRaises(banana.BananaError, banana.decode, "\x7f" * 65)
+        self.assertRaises(banana.BananaError, banana.decode, "\x7f\x88")
+        self.assertRaises(banana.BananaError, banana.decode, "\x01\xFF")
+
+    def twisted_encode(self, value):
+        io = StringIO()
+        self.protocol.transport = io
+        self.protocol.sendEncoded(value)
+        return io.getvalue()
+
+    def twisted_decode(self, data):
+        heap = []
+        self.protocol.expressionReceived = heap.append
+        self.protocol.dataReceived(data)
+        return heap[0]
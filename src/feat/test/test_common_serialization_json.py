@@ -51,6 +51,16 @@ class DummyInterface(Interface):
     pass
 
 
+class NestedDummy(serialization.Serializable):
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def snapshot(self):
+        # converted while the pool converter is converting the instance
+        return self._pool.convert([1])
+
+
 class JSONConvertersTest(common_serialization.ConverterTest):
 
     def setUp(self):
@@ -59,6 +69,83 @@ class JSONConvertersTest(common_serialization.ConverterTest):
         self.serializer = json.Serializer(externalizer=ext)
         self.unserializer = json.Unserializer(externalizer=ext)
 
+    def testAcyclic(self):
+        serializer = json.Serializer(externalizer=self.externalizer,
+                                     acyclic=True)
+        value = [DummyClass(), {"a": (1, 2), "b": [u"c", 3.5]}, set([4])]
+        self.assertEqual(self.serializer.convert(value),
+                         serializer.convert(value))
+        self.assertEqual(self.serializer.freeze(value),
+                         serializer.freeze(value))
+
+        shared = [1, 2]
+        data = serializer.convert([shared, shared])
+        self.assertEqual('[[1, 2], [1, 2]]', data)
+        result = self.unserializer.convert(data)
+        self.assertEqual([[1, 2], [1, 2]], result)
+        self.assertFalse(result[0] is result[1])
+
+    def testConverterPool(self):
+        converters = []
+
+        def factory(**params):
+            converter = json.Serializer(**params)
+            converters.append(converter)
+            return converter
+
+        pool = base.ConverterPool(factory)
+        self.assertEqual('[1, 2]', pool.convert([1, 2]))
+        self.assertEqual('[1, 2]', pool.convert([1, 2]))
+        self.assertEqual(1, len(converters))
+        self.assertEqual('[\n  1\n]', pool.convert([1], indent=2))
+        self.assertEqual(2, len(converters))
+
+        nested = NestedDummy(pool)
+        for _ in range(2):
+            data = pool.convert(nested)
+            self.assertTrue('"[1]"' in data)
+            self.assertEqual(3, len(converters))
+
+    def testUnknownValueLookup(self):
+        snapshotable = common_serialization.SnapshotableDummy(42)
+        value = [snapshotable, snapshotable]
+        # first conversion resolve the flattener, second one use it
+        self.assertEqual(self.serializer.freeze(value),
+                         self.serializer.freeze(value))
+        self.assertEqual('[[".ref", 1, 42], [".deref", 1]]',
+                         self.serializer.freeze(value))
+        key = (common_serialization.SnapshotableDummy, True)
+        self.assertTrue(key in json.Serializer._flatteners)
+        self.assertFalse(key in base.Serializer.__dict__)
+
+        class OldStyle:
+            pass
+
+        for _ in range(2):
+            self.assertRaises(TypeError, self.serializer.convert, OldStyle())
+
+    def testFlattenerOverride(self):
+
+        class Serializer(json.Serializer):
+
+            def flatten_type_value(self, value, caps, freezing):
+                return self.pack_unicode, u"overridden"
+
+            def flatten_int_value(self, value, caps, freezing):
+                return self.pack_int, value + 1
+
+        value = [DummyClass, 42]
+        expected = reflect.canonical_name(DummyClass)
+        # resolved by the base serializer first
+        self.assertEqual('[[".type", "%s"], 42]' % expected,
+                         self.serializer.convert(value))
+        serializer = Serializer()
+        self.assertEqual('["overridden", 43]', serializer.convert(value))
+        serializer = Serializer(acyclic=True)
+        self.assertEqual('["overridden", 43]', serializer.convert(value))
+        self.assertEqual('[[".type", "%s"], 42]' % expected,
+                         self.serializer.convert(value))
+
     def convertion_table(self, capabilities, freezing):
         ### Basic immutable types ###
 
@@ -0,0 +1,87 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+import os
+import tempfile
+
+from feat.test import common
+from feat.agencies import journaler
+from feat.utils import replay
+from feat.common import defer, time
+from feat.common.serialization import banana
+
+
+class TestReplayingJournal(common.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield common.TestCase.setUp(self)
+        fd, self.filename = tempfile.mkstemp(suffix='_journal.sqlite')
+        os.close(fd)
+        self.addCleanup(os.remove, self.filename)
+
+        serializer = banana.Serializer()
+        writer = journaler.SqliteWriter(self, filename=self.filename)
+        yield writer.initiate()
+        entries = []
+        for agent_id in ('agent1', 'agent2'):
+            for function_id in ('some.function', 'snapshot'):
+                entries.append(dict(
+                    entry_type='journal',
+                    agent_id=agent_id,
+                    instance_id=1,
+                    journal_id=serializer.convert('agency'),
+                    function_id=function_id,
+                    args=serializer.convert(tuple()),
+                    kwargs=serializer.convert(dict()),
+                    fiber_id='some fiber id',
+                    fiber_depth=1,
+                    result=serializer.convert(None),
+                    side_effects=serializer.convert(list()),
+                    timestamp=int(time.time())))
+        yield writer.insert_entries(entries)
+        yield writer.close()
+
+    def testReadingHistories(self):
+        histories = journaler.read_histories(self.filename)
+        self.assertEqual(['agent1', 'agent2'],
+                         [x.agent_id for x in histories])
+
+    def testReplayingHistories(self):
+        histories = journaler.read_histories(self.filename)
+        # the pool of processes is not used here, forking the process
+        # running the test reactor is not safe
+        results = list(replay.replay_histories(self.filename, histories,
+                                               jobs=1))
+        self.assertEqual(2, len(results))
+        self.assertEqual(['agent1', 'agent2'],
+                         sorted(x[0].agent_id for x in results))
+        for history, entries, elapsed, message in results:
+            # the first entry calls unknown effect
+            self.assertEqual(1, entries)
+            self.assertIn('some.function', message)
+
+    def testReplayingFromSnapshot(self):
+        history = journaler.read_histories(self.filename)[0]
+        entries, _elapsed, message = replay.replay_history(
+            self.filename, history, from_snapshot=True)
+        self.assertEqual(1, entries)
+        self.assertIn('Malformed agent snapshot', message)
@@ -23,11 +23,28 @@
 # See "LICENSE.GPL" in the source distribution for more information.
 # Headers in this file shall remain intact.
 
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
 from feat.test import common
 
 from feat.web import http
 
 
+class RecordingProtocol(http.BaseProtocol):
+
+    def __init__(self, log_keeper):
+        http.BaseProtocol.__init__(self, log_keeper)
+        self.requests = []
+
+    def process_request_line(self, line):
+        self.requests.append([line, ""])
+
+    def process_body_data(self, data):
+        self.requests[-1][1] += data
+
+
 class TestHTTP(common.TestCase):
 
     def testjoinLocations(self):
@@ -275,3 +292,19 @@ class TestHTTP(common.TestCase):
         check((u"パス名", "pim", "\"'<>", ""), "big5")
 
         check(("", )*10)
+
+    def testPipelinedRequests(self):
+        protocol = RecordingProtocol(self)
+        protocol.makeConnection(StringTransport())
+        request = ("POST /%d HTTP/1.1\r\n"
+                   "Content-Length: 4\r\n"
+                   "\r\n"
+                   "%04d")
+        # all the requests received at once are parsed without recursion
+        data = "".join([request % (i, i) for i in range(2000)])
+        protocol.dataReceived(data)
+        expected = [["POST /%d HTTP/1.1" % i, "%04d" % i]
+                    for i in range(2000)]
+        self.assertEqual(expected, protocol.requests)
+        self.assertTrue(protocol.is_idle())
+        protocol.connectionLost(Failure(ConnectionDone()))
@@ -0,0 +1,94 @@
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+from feat.test import common
+
+from feat.common import defer, time
+from feat.web import http, httpclient
+
+
+class DelayedResource(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, delay):
+        resource.Resource.__init__(self)
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self.ports = set()
+
+    def render_GET(self, request):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        self.ports.add(request.transport.getPeer().port)
+        call = time.call_later(self.delay, self._finish, request)
+        request.notifyFinish().addErrback(self._lost, call)
+        return server.NOT_DONE_YET
+
+    def _finish(self, request):
+        self.active -= 1
+        request.write(request.path)
+        request.finish()
+
+    def _lost(self, _, call):
+        self.active -= 1
+        call.cancel()
+
+
+class TestConnectionPool(common.TestCase):
+
+    timeout = 10
+
+    def setUp(self):
+        self.resource = DelayedResource(0.05)
+        self.listener = reactor.listenTCP(0, server.Site(self.resource),
+                                          interface="127.0.0.1")
+        port = self.listener.getHost().port
+        self.pool = httpclient.ConnectionPool("127.0.0.1", port,
+                                              max_connections=3)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.pool.disconnect()
+        yield self.listener.stopListening()
+        yield common.TestCase.tearDown(self)
+
+    @defer.inlineCallbacks
+    def testConcurrentRequests(self):
+        self.assertTrue(self.pool.is_idle())
+        defers = [self.pool.request(http.Methods.GET, "/%d" % (i, ))
+                  for i in range(10)]
+        self.assertFalse(self.pool.is_idle())
+        self.assertEqual(7, dict(self.pool.get_stats())['waiting requests'])
+
+        responses = yield defer.DeferredList(defers, consumeErrors=True)
+        bodies = [r.body for ok, r in responses if ok]
+        self.assertEqual(["/%d" % (i, ) for i in range(10)], bodies)
+        self.assertEqual(3, self.resource.max_active)
+        self.assertTrue(self.pool.is_idle())
+
+        # the connections are kept open for the next requests
+        ports = set(self.resource.ports)
+        yield self.pool.request(http.Methods.GET, "/again")
+        self.assertEqual(ports, self.resource.ports)
+        self.assertEqual(3, dict(self.pool.get_stats())['connections'])
+
+    @defer.inlineCallbacks
+    def testConsumer(self):
+        received = []
+        response = yield self.pool.request(http.Methods.GET, "/streamed",
+                                           consumer=received.append)
+        self.assertEqual("/streamed", "".join(received))
+        self.assertEqual(None, response.body)
+
+    @defer.inlineCallbacks
+    def testDisconnect(self):
+        defers = [self.pool.request(http.Methods.GET, "/%d" % (i, ))
+                  for i in range(4)]
+        # the first requests are sent, the last one is waiting
+        yield common.delay(None, 0.02)
+        self.pool.disconnect()
+        for d in defers:
+            self.assertFailure(d, httpclient.RequestError)
+        yield defer.DeferredList(defers)
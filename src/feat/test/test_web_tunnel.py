@@ -58,6 +58,26 @@ class Av2(Av1):
         return snapshot
 
 
+class OldRequest(tunnel.Request):
+
+    def set_header(self, name, value):
+        # peers not supporting the batches do not announce them
+        if name != "accept-post":
+            tunnel.Request.set_header(self, name, value)
+
+
+class OldRequestFactory(tunnel.RequestFactory):
+    request_class = OldRequest
+
+
+class OldTunnel(tunnel.Tunnel):
+
+    def _create_factory(self):
+        factory = tunnel.Tunnel._create_factory(self)
+        factory.request_factory_class = OldRequestFactory
+        return factory
+
+
 @common.attr(timescale=0.1)
 class TestHTTPTunnel(common.TestCase):
 
@@ -310,6 +330,67 @@ class TestHTTPTunnel(common.TestCase):
         self.assertEqual(self.d1.messages, [(url1, 2)])
         self.assertEqual(self.d2.messages, [(url2, 1)])
 
+    @defer.inlineCallbacks
+    def testBatching(self):
+        yield self.t1.start_listening()
+        yield self.t2.start_listening()
+
+        url = http.append_location(self.t2.uri, "spam")
+        yield self.t1.post(url, 0)
+        peer = self.t1._peers.values()[0]
+        self.assertTrue(peer._batching)
+
+        requests = []
+        request = peer.request
+
+        def count_request(method, location, headers=None, body=None):
+            requests.append(headers.get("content-encoding"))
+            return request(method, location, headers, body)
+
+        peer.request = count_request
+
+        self.d2.reset()
+        urls = [http.append_location(self.t2.uri, "spam%d" % i)
+                for i in range(150)]
+        results = yield defer.DeferredList([self.t1.post(u, i)
+                                            for i, u in enumerate(urls)])
+        self.assertEqual([(True, True)] * 150, results)
+        self.assertEqual(zip(urls, range(150)), self.d2.messages)
+        self.assertEqual([None, None], requests)
+
+        # big bodies are compressed
+        del requests[:]
+        self.d2.reset()
+        data = ["x" * 1000] * 10
+        result = yield self.t1.post(url, data)
+        self.assertTrue(result)
+        self.assertEqual([(url, data)], self.d2.messages)
+        self.assertEqual([["deflate"]], requests)
+
+        yield self.wait_for_idle(20)
+
+    @defer.inlineCallbacks
+    def testOldPeer(self):
+        d3 = DummyDispatcher()
+        t3 = OldTunnel(self, range(4100, 4200), d3, "localhost", version=2)
+        yield self.t2.start_listening()
+        yield t3.start_listening()
+        try:
+            url3 = http.append_location(t3.uri, "spam")
+            url2 = http.append_location(self.t2.uri, "beans")
+            results = yield defer.DeferredList([self.t2.post(url3, i)
+                                                for i in range(3)])
+            self.assertEqual([(True, True)] * 3, results)
+            self.assertEqual([(url3, i) for i in range(3)], d3.messages)
+            self.assertFalse(self.t2._peers.values()[0]._batching)
+
+            # the old peer can still post to the new one
+            yield t3.post(url2, 4)
+            self.assertEqual([(url2, 4)], self.d2.messages)
+        finally:
+            yield t3.stop_listening()
+            yield t3.disconnect()
+
     def wait_for_idle(self, timeout):
 
         def check():
@@ -0,0 +1,147 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+import itertools
+import multiprocessing
+import optparse
+import sys
+
+from feat.agencies import journaler, replay
+from feat.agencies.net import options
+from feat.common import log, time, error
+
+from feat.interface.journal import ReplayError
+
+
+def replay_history(filename, history, from_snapshot=False,
+                   page_size=journaler.DEFAULT_PAGE_SIZE):
+    '''
+    Replays the history stored in the journal file.
+    Returns the tuple of (number of entries replayed, seconds it took,
+    error message or None).
+    '''
+    started = time.time()
+    cursor = journaler.open_cursor(filename, history, page_size,
+                                   from_snapshot)
+    r = replay.Replay(cursor, history.agent_id)
+    message = None
+    try:
+        try:
+            for entry in r:
+                entry.apply()
+        except (Exception, ReplayError) as e:
+            # for the snapshot mismatches the message contains the
+            # difference between the states
+            message = error.get_exception_message(e)
+    finally:
+        cursor.close()
+    return r.position, time.time() - started, message
+
+
+def replay_histories(filename, histories, jobs=1, from_snapshot=False,
+                     page_size=journaler.DEFAULT_PAGE_SIZE):
+    '''
+    Generator giving the history followed by the result of
+    replay_history() in the order in which the histories are finished.
+    The histories are replayed in a pool of jobs processes, each of them
+    opening the journal file.
+    '''
+    histories = dict((x.history_id, x) for x in histories)
+    tasks = [(filename, x.history_id, x.agent_id, x.instance_id,
+              from_snapshot, page_size) for x in histories.itervalues()]
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(_replay_task, tasks)
+    else:
+        results = itertools.imap(_replay_task, tasks)
+    try:
+        for history_id, entries, elapsed, message in results:
+            yield histories[history_id], entries, elapsed, message
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def script():
+    parser = optparse.OptionParser(
+        usage="%prog [options] JOURNAL",
+        description="Replays the histories of the agents stored in the "
+                    "journal file or in the segments directory.")
+    options.add_general_options(parser)
+    parser.add_option('-j', '--jobs', type="int", dest="jobs",
+                      default=multiprocessing.cpu_count(),
+                      help=("number of processes replaying the histories "
+                            "(default: %s)" % multiprocessing.cpu_count()))
+    parser.add_option('-a', '--agent-id', action="append", dest="agent_ids",
+                      metavar="AGENT_ID", default=[],
+                      help="only replay the histories of the agent")
+    parser.add_option('-s', '--from-snapshot', action="store_true",
+                      dest="from_snapshot", default=False,
+                      help="start from the latest snapshot of each history")
+    parser.add_option('-p', '--page-size', type="int", dest="page_size",
+                      default=journaler.DEFAULT_PAGE_SIZE,
+                      help=("number of entries read at once (default: %s)"
+                            % journaler.DEFAULT_PAGE_SIZE))
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("expecting the journal file")
+    filename = args[0]
+
+    log.FluLogKeeper.init()
+    if opts.debug:
+        log.FluLogKeeper.set_debug(opts.debug)
+
+    histories = journaler.read_histories(filename)
+    if opts.agent_ids:
+        histories = [x for x in histories if x.agent_id in opts.agent_ids]
+
+    started = time.time()
+    total = 0
+    failed = 0
+    results = replay_histories(filename, histories, opts.jobs,
+                               opts.from_snapshot, opts.page_size)
+    for history, entries, elapsed, message in results:
+        total += entries
+        print ("%-4s %s/%s: %d entries in %.2fs"
+               % ("OK" if message is None else "FAIL", history.agent_id,
+                  history.instance_id, entries, elapsed))
+        if message is not None:
+            failed += 1
+            for line in message.splitlines():
+                print "     %s" % (line, )
+    elapsed = time.time() - started
+    print ("Replayed %d histories (%d failed), %d entries in %.2fs: "
+           "%.1f entries/s" % (len(histories), failed, total, elapsed,
+                               total / elapsed if elapsed else 0))
+    sys.exit(1 if failed else 0)
+
+
+### private ###
+
+
+def _replay_task(task):
+    filename, history_id, agent_id, instance_id, from_snapshot, page_size \
+        = task
+    history = journaler.History(history_id=history_id, agent_id=agent_id,
+                                instance_id=instance_id)
+    return (history_id, ) + replay_history(filename, history,
+                                           from_snapshot, page_size)
@@ -268,6 +268,8 @@ class BaseProtocol(log.Logger, basic.LineReceiver, timeout.Mixin):
         self.add_timeout("inactivity", self.inactivity_timeout,
                          self._on_inactivity_timeout)
 
+        self._pipelined = None # [DATA] received while processing data
+
         self._reset()
 
     ### public ###
@@ -323,6 +325,23 @@ class BaseProtocol(log.Logger, basic.LineReceiver, timeout.Mixin):
 
     ### overridden ###
 
+    def dataReceived(self, data):
+        # The data following a request or response is processed after
+        # the current one instead of recursively, so many pipelined
+        # requests received at once do not exhaust the stack.
+        if self._pipelined is not None:
+            self._pipelined.append(data)
+            return
+        self._pipelined = []
+        try:
+            basic.LineReceiver.dataReceived(self, data)
+            while self._pipelined:
+                data = "".join(self._pipelined)
+                del self._pipelined[:]
+                basic.LineReceiver.dataReceived(self, data)
+        finally:
+            self._pipelined = None
+
     def connectionMade(self):
         peer = self.transport.getPeer()
         self.log_name = "%s:%s" % (peer.host, peer.port)
@@ -1,3 +1,5 @@
+import collections
+
 from zope.interface import Interface, Attribute, implements
 
 from twisted.internet import reactor
@@ -8,6 +10,7 @@ from feat.web import http, security
 
 
 DEFAULT_CONNECT_TIMEOUT = 30
+DEFAULT_MAX_CONNECTIONS = 4
 
 
 class RequestError(error.FeatError):
@@ -73,6 +76,7 @@ class Protocol(http.BaseProtocol):
 
         self._response = None
         self._requests = []
+        self._consumers = []
 
         self.debug("HTTP client protocol created")
 
@@ -80,7 +84,11 @@ class Protocol(http.BaseProtocol):
         return http.BaseProtocol.is_idle(self) and not self._requests
 
     def request(self, method, location,
-                protocol=None, headers=None, body=None):
+                protocol=None, headers=None, body=None, consumer=None):
+        '''
+        If a consumer is given it is called with the body data as it is
+        received, the response is then given without body.
+        '''
         headers = dict(headers) if headers is not None else {}
         if body:
             # without typecast to str, in case of unicode input
@@ -104,6 +112,7 @@ class Protocol(http.BaseProtocol):
 
         d = defer.Deferred()
         self._requests.append(d)
+        self._consumers.append(consumer)
 
         self.transport.writeSequence(seq)
 
@@ -122,6 +131,7 @@ class Protocol(http.BaseProtocol):
         for d in self._requests:
             d.errback(RequestError())
         self._requests = None
+        self._consumers = None
 
     def process_reset(self):
         self._response = None
@@ -155,12 +165,16 @@ class Protocol(http.BaseProtocol):
 
     def process_body_data(self, data):
         assert self._response is not None, "No response information"
+        if self._consumers[0] is not None:
+            self._consumers[0](data)
+            return
         if self._response.body is None:
             self._response.body = ''
         self._response.body += data
 
     def process_body_finished(self):
         d = self._requests.pop(0)
+        self._consumers.pop(0)
         d.callback(self._response)
 
     def process_timeout(self):
@@ -173,6 +187,7 @@ class Protocol(http.BaseProtocol):
 
     def _client_error(self, exception):
         d = self._requests.pop(0)
+        self._consumers.pop(0)
         d.errback(exception)
         self.transport.loseConnection()
 
@@ -265,14 +280,16 @@ class Connection(log.LogProxy, log.Logger):
     def is_idle(self):
         return self._protocol is None or self._protocol.is_idle()
 
-    def request(self, method, location, headers=None, body=None):
+    def request(self, method, location, headers=None, body=None,
+                consumer=None):
         if self._protocol is None:
             d = self._connect()
             d.addCallback(self._on_connected)
         else:
             d = defer.succeed(self._protocol)
 
-        d.addCallback(self._request, method, location, headers, body)
+        d.addCallback(self._request, method, location, headers, body,
+                      consumer)
         return d
 
     def disconnect(self):
@@ -317,17 +334,102 @@ class Connection(log.LogProxy, log.Logger):
         self._protocol = protocol
         return protocol
 
-    def _request(self, protocol, method, location, headers, body):
+    def _request(self, protocol, method, location, headers, body,
+                 consumer):
         self._pending += 1
         headers = dict(headers) if headers is not None else {}
         if "host" not in headers:
             headers["host"] = self._host
         d = protocol.request(method, location,
                              self._http_protocol,
-                             headers, body)
+                             headers, body, consumer)
         d.addBoth(self._request_done)
         return d
 
     def _request_done(self, param):
         self._pending -= 1
         return param
+
+
+class ConnectionPool(log.LogProxy, log.Logger):
+    '''
+    Pool of keep-alive connections to the same server. Each connection
+    does one request at a time, the requests made while all of them are
+    busy wait for the first one to be free. The connections are only
+    opened when needed and kept open for the next requests.
+    '''
+
+    connection_factory = Connection
+
+    def __init__(self, host, port=None, protocol=None,
+                 security_policy=None, logger=None, max_connections=None):
+        logger = logger if logger is not None else log.FluLogKeeper()
+        log.LogProxy.__init__(self, logger)
+        log.Logger.__init__(self, logger)
+
+        self._host = host
+        self._port = port
+        self._protocol = protocol
+        self._security_policy = security_policy
+        self.max_connections = max_connections or DEFAULT_MAX_CONNECTIONS
+
+        self._connections = []
+        self._idle = []
+        self._waiting = collections.deque() # [Deferred]
+
+    ### public ###
+
+    def is_idle(self):
+        return len(self._idle) == len(self._connections)
+
+    def request(self, method, location, headers=None, body=None,
+                consumer=None):
+        d = self._acquire()
+        d.addCallback(self._request, method, location, headers, body,
+                      consumer)
+        return d
+
+    def disconnect(self):
+        waiting, self._waiting = self._waiting, collections.deque()
+        for d in waiting:
+            d.errback(RequestCanceled("Connection pool disconnected"))
+        for connection in self._connections:
+            connection.disconnect()
+
+    def get_stats(self):
+        return [('connections', len(self._connections)),
+                ('busy connections',
+                 len(self._connections) - len(self._idle)),
+                ('waiting requests', len(self._waiting))]
+
+    ### virtual ###
+
+    def create_connection(self):
+        return self.connection_factory(self._host, self._port,
+                                       self._protocol, self._security_policy,
+                                       logger=self)
+
+    ### private ###
+
+    def _acquire(self):
+        if self._idle:
+            return defer.succeed(self._idle.pop())
+        if len(self._connections) < self.max_connections:
+            connection = self.create_connection()
+            self._connections.append(connection)
+            return defer.succeed(connection)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def _request(self, connection, method, location, headers, body,
+                 consumer):
+        d = connection.request(method, location, headers, body, consumer)
+        d.addBoth(defer.bridge_param, self._release, connection)
+        return d
+
+    def _release(self, connection):
+        if self._waiting:
+            self._waiting.popleft().callback(connection)
+        else:
+            self._idle.append(connection)
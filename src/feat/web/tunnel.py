@@ -21,6 +21,7 @@
 # Headers in this file shall remain intact.
 
 import random
+import zlib
 
 from zope.interface import Interface, implements
 
@@ -31,9 +32,16 @@ from feat.web import http, security, base, httpserver, httpclient
 
 DEFAULT_REQUEST_TIMEOUT = 5*60
 DEFAULT_RESPONSE_TIMEOUT = 5*60+1
+DEFAULT_BATCH_SIZE = 100 # Maximum number of messages posted at once
+COMPRESSION_THRESHOLD = 4096 # Minimum size of the compressed bodies
 
 FEAT_IDENT = "FeatTunnel"
 
+CONTENT_TYPE = "application/json"
+# Body with a list of [LOCATION, MESSAGE], peers supporting it announce
+# it in the accept-post header of the HEAD response.
+BATCH_CONTENT_TYPE = "application/x-feat-batch+json"
+
 
 class TunnelError(error.FeatError):
     pass
@@ -54,6 +62,7 @@ class Tunnel(base.RangeServer):
     request_timeout = DEFAULT_REQUEST_TIMEOUT
     response_timeout = DEFAULT_RESPONSE_TIMEOUT
     idle_timeout = None # Default value
+    batch_size = DEFAULT_BATCH_SIZE
 
     # Taken from flumotion reconnectin client factory
     max_delay = 600
@@ -326,10 +335,12 @@ class Peer(httpclient.Connection):
         self._key = key
         self._peer_version = None
         self._target_version = None
+        self._batching = False
+        self._batch = [] # [(LOCATION, DATA, DEFERRED)]
         self._headers = {}
 
         self._headers["host"] = "%s:%d" % (host, port)
-        self._headers["content-type"] = "application/json"
+        self._headers["content-type"] = CONTENT_TYPE
         ver = tunnel._version
         self._headers["user-agent"] = http.compose_user_agent(FEAT_IDENT, ver)
 
@@ -341,11 +352,24 @@ class Peer(httpclient.Connection):
         return d
 
     def post(self, location, data):
-        body = self._serialize(data)
-        return self.request(http.Methods.POST, location, self._headers, body)
+        if not self._batching:
+            body = self._serialize(data)
+            return self.request(http.Methods.POST, location,
+                                self._headers, body)
+
+        # messages posted during the same reactor iteration
+        # are sent in the same request
+        d = defer.Deferred()
+        self._batch.append((location, data, d))
+        if len(self._batch) == 1:
+            time.call_next(self._post_batch)
+        return d
 
     ### overridden ###
 
+    def is_idle(self):
+        return not self._batch and httpclient.Connection.is_idle(self)
+
     def onClientConnectionFailed(self, reason):
         httpclient.Connection.onClientConnectionFailed(self, reason)
         self._tunnel._remove_peer(self._key)
@@ -375,6 +399,10 @@ class Peer(httpclient.Connection):
         self._peer_version = vser
         self._target_version = vout
 
+        accepted = response.headers.get("accept-post", "")
+        types = [t.strip() for t in accepted.split(",")]
+        self._batching = BATCH_CONTENT_TYPE in types
+
         self._headers["user-agent"] = http.compose_user_agent(FEAT_IDENT, vout)
 
         return response
@@ -383,10 +411,42 @@ class Peer(httpclient.Connection):
         vin = self._tunnel._version
         vtar = self._target_version
         vout = vtar if vtar is not None else vin
-        serializer = json.Serializer(indent=2, force_unicode=True,
-                                     source_ver=vin, target_ver=vout)
         self._headers["user-agent"] = http.compose_user_agent(FEAT_IDENT, vout)
-        return serializer.convert(data)
+        return json.serializer_pool.convert(data, separators=(",", ":"),
+                                            force_unicode=True,
+                                            source_ver=vin, target_ver=vout)
+
+    def _post_batch(self):
+        batch, self._batch = self._batch, []
+        if self._tunnel is None:
+            # disconnected before posting
+            for _location, _data, d in batch:
+                d.errback(TunnelError("Peer disconnected"))
+            return
+
+        size = self._tunnel.batch_size
+        for i in range(0, len(batch), size):
+            self._post_messages(batch[i:i + size])
+
+    def _post_messages(self, messages):
+        body = self._serialize([[l, m] for l, m, _d in messages])
+        headers = dict(self._headers)
+        headers["content-type"] = BATCH_CONTENT_TYPE
+        if len(body) >= COMPRESSION_THRESHOLD:
+            body = zlib.compress(body)
+            headers["content-encoding"] = ["deflate"]
+
+        d = self.request(http.Methods.POST, "/", headers, body)
+        d.addCallbacks(self._messages_posted, self._messages_failed,
+                       callbackArgs=(messages, ), errbackArgs=(messages, ))
+
+    def _messages_posted(self, response, messages):
+        for _location, _data, d in messages:
+            d.callback(response)
+
+    def _messages_failed(self, failure, messages):
+        for _location, _data, d in messages:
+            d.errback(failure)
 
 
 class Request(httpserver.Request):
@@ -403,10 +463,11 @@ class Request(httpserver.Request):
         vout = self.channel.owner._version
 
         ctype = self.get_received_header("content-type")
-        if ctype != "application/json":
+        if ctype not in (CONTENT_TYPE, BATCH_CONTENT_TYPE):
             self._error(http.Status.UNSUPPORTED_MEDIA_TYPE,
                         "Message content type not supported, "
-                        "only application/json is.")
+                        "only %s and %s are."
+                        % (CONTENT_TYPE, BATCH_CONTENT_TYPE))
             return
 
         agent_header = self.get_received_header("user-agent")
@@ -427,6 +488,8 @@ class Request(httpserver.Request):
             vin = vcli if vcli is not None and vcli < vout else vout
             server_header = http.compose_user_agent(FEAT_IDENT, vin)
             self.set_header("server", server_header)
+            self.set_header("accept-post", "%s, %s"
+                            % (CONTENT_TYPE, BATCH_CONTENT_TYPE))
             self.set_length(0)
             self.finish()
             return
@@ -449,11 +512,21 @@ class Request(httpserver.Request):
             uri = http.compose(self.uri, host=host, port=port, scheme=scheme)
 
             vin = vcli if vcli is not None else vout
-            unserializer = json.Unserializer(registry=self._registry,
-                                             source_ver=vin, target_ver=vout)
             body = "".join(self._buffer)
+            encoding = self.get_received_header("content-encoding") or []
             try:
-                data = unserializer.convert(body)
+                if "deflate" in encoding:
+                    body = zlib.decompress(body)
+                data = json.unserializer_pool.convert(
+                    body, registry=self._registry,
+                    source_ver=vin, target_ver=vout)
+                if ctype == BATCH_CONTENT_TYPE:
+                    messages = [(http.compose(str(location), host=host,
+                                              port=port, scheme=scheme),
+                                 message)
+                                for location, message in data]
+                else:
+                    messages = [(uri, data)]
             except Exception as e:
                 msg = "Error while unserializing tunnel message"
                 error.handle_exception(self, e, msg)
@@ -461,7 +534,8 @@ class Request(httpserver.Request):
                             "Invalid message, unserialization failed.")
                 return
 
-            self.channel.owner._dispatch(uri, data)
+            for message_uri, message in messages:
+                self.channel.owner._dispatch(message_uri, message)
 
             self.set_response_code(http.Status.OK)
             server_header = http.compose_user_agent(FEAT_IDENT, vin)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+'''
+Measures the number of messages per second the AMQP channel publishes,
+committing every message in its own transaction or in batches, the
+number of messages per second consumed from a queue and the number of
+bindings per second created. The publishing is also measured through a
+pool of channels committing their transactions concurrently.
+
+By default the broker is simulated by a channel answering the commits
+after the given round trip time. With --host the messages are published
+to a real RabbitMQ server, the consumption is only measured with the
+simulated broker.
+
+Run it through the env script: ./env python tools/benchmarks/amqp.py
+'''
+import optparse
+import time
+
+from twisted.internet import reactor
+
+from feat.agencies.messaging import net
+from feat.agents.base import message
+from feat.common import defer, log
+from feat.common.serialization import banana
+from feat.extern.txamqp.content import Content
+from feat.extern.txamqp.queue import TimeoutDeferredQueue
+
+
+class SimulatedChannel(object):
+
+    id = 1
+
+    def __init__(self, round_trip):
+        self.round_trip = round_trip
+
+    def channel_open(self):
+        return defer.succeed(None)
+
+    def tx_select(self):
+        return self._answer()
+
+    def tx_commit(self):
+        return self._answer()
+
+    def tx_rollback(self):
+        return self._answer()
+
+    def exchange_declare(self, nowait=False, **_kwargs):
+        return defer.succeed(None) if nowait else self._answer()
+
+    def queue_bind(self, nowait=False, **_kwargs):
+        return defer.succeed(None) if nowait else self._answer()
+
+    def basic_publish(self, **_kwargs):
+        return defer.succeed(None)
+
+    def basic_ack(self, *_args, **_kwargs):
+        return defer.succeed(None)
+
+    def _answer(self):
+        d = defer.Deferred()
+        reactor.callLater(self.round_trip, d.callback, None)
+        return d
+
+
+class SimulatedClient(object):
+
+    def __init__(self, round_trip):
+        self.round_trip = round_trip
+
+    def get_free_channel(self):
+        return defer.succeed(SimulatedChannel(self.round_trip))
+
+    def add_flow_cb(self, _channel_id, _cb):
+        pass
+
+
+class Delivery(object):
+
+    def __init__(self, delivery_tag, body):
+        self.delivery_tag = delivery_tag
+        self.content = Content(body)
+
+
+class SimulatedFactory(object):
+
+    def add_connection_lost_cb(self, _cb):
+        pass
+
+
+@defer.inlineCallbacks
+def measure(name, opts, batch_size, backend=None):
+    logger = log.FluLogKeeper()
+    if backend is None:
+        client = SimulatedClient(opts.round_trip / 1000.0)
+        channel = net.Channel(logger, defer.succeed(client),
+                              SimulatedFactory(), batch_size=batch_size,
+                              batch_window=opts.window)
+    else:
+        factory = backend._factory
+        channel = net.Channel(logger, factory.get_client(), factory,
+                              batch_size=batch_size,
+                              batch_window=opts.window)
+    yield channel.define_exchange('benchmark')
+
+    start = time.time()
+    defers = [channel.publish('key', 'benchmark', message.BaseMessage())
+              for _ in xrange(opts.count)]
+    yield defer.DeferredList(defers, fireOnOneErrback=True)
+    elapsed = time.time() - start
+    print ("%-30s %8d messages in %6.2fs: %10.1f messages/s"
+           % (name, opts.count, elapsed, opts.count / elapsed))
+
+
+@defer.inlineCallbacks
+def measure_pool(name, opts, batch_size):
+    logger = log.FluLogKeeper()
+    channels = []
+    for _ in xrange(opts.channels):
+        client = SimulatedClient(opts.round_trip / 1000.0)
+        channel = net.Channel(logger, defer.succeed(client),
+                              SimulatedFactory(), batch_size=batch_size,
+                              batch_window=opts.window)
+        yield channel.define_exchange('benchmark')
+        channels.append(channel)
+    pool = net.ChannelPool(logger, channels)
+
+    start = time.time()
+    defers = [pool.publish('key%d' % (i, ), 'benchmark',
+                           message.BaseMessage())
+              for i in xrange(opts.count)]
+    yield defer.DeferredList(defers, fireOnOneErrback=True)
+    elapsed = time.time() - start
+    print ("%-30s %8d messages in %6.2fs: %10.1f messages/s"
+           % (name, opts.count, elapsed, opts.count / elapsed))
+
+
+@defer.inlineCallbacks
+def measure_consume(name, opts):
+    logger = log.FluLogKeeper()
+    client = SimulatedClient(opts.round_trip / 1000.0)
+    channel = net.Channel(logger, defer.succeed(client), SimulatedFactory(),
+                          batch_size=opts.batch_size,
+                          batch_window=opts.window)
+    yield channel.define_exchange('benchmark')
+    bare_queue = TimeoutDeferredQueue()
+    for tag in xrange(opts.count):
+        msg = message.BaseMessage(message_id=str(tag))
+        bare_queue.put(Delivery(tag + 1, banana.serialize(msg)))
+
+    start = time.time()
+    queue = net.WrappedQueue(channel, 'benchmark')
+    queue.configure(bare_queue)
+    for _ in xrange(opts.count):
+        yield queue.get()
+    elapsed = time.time() - start
+    print ("%-30s %8d messages in %6.2fs: %10.1f messages/s"
+           % (name, opts.count, elapsed, opts.count / elapsed))
+
+
+@defer.inlineCallbacks
+def measure_bindings(name, opts, backend=None):
+    logger = log.FluLogKeeper()
+    if backend is None:
+        client = SimulatedClient(opts.round_trip / 1000.0)
+        channel = net.Channel(logger, defer.succeed(client),
+                              SimulatedFactory(), batch_size=opts.batch_size,
+                              batch_window=opts.window)
+        queue = 'benchmark'
+    else:
+        factory = backend._factory
+        channel = net.Channel(logger, factory.get_client(), factory,
+                              batch_size=opts.batch_size,
+                              batch_window=opts.window)
+        queue = yield channel.define_queue('benchmark')
+        queue = queue.name
+    yield channel.define_exchange('benchmark')
+
+    start = time.time()
+    defers = [channel.create_binding('benchmark', queue, 'key%d' % (i, ))
+              for i in xrange(opts.count)]
+    yield defer.DeferredList(defers, fireOnOneErrback=True)
+    elapsed = time.time() - start
+    print ("%-30s %8d bindings in %6.2fs: %10.1f bindings/s"
+           % (name, opts.count, elapsed, opts.count / elapsed))
+
+
+@defer.inlineCallbacks
+def main(opts):
+    backend = None
+    try:
+        if opts.host:
+            backend = net.RabbitMQ(opts.host, opts.port)
+            yield backend.connect()
+        yield measure('commit per message', opts, 1, backend)
+        yield measure('batched commits', opts, opts.batch_size, backend)
+        if backend is None:
+            yield measure_pool('pool commit per message', opts, 1)
+            yield measure_pool('pool batched commits', opts,
+                               opts.batch_size)
+            yield measure_consume('consume', opts)
+        yield measure_bindings('bindings', opts, backend)
+    finally:
+        if backend is not None:
+            backend.disconnect()
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type="int", default=5000,
+                      help="number of messages published (default: 5000)")
+    parser.add_option('-b', '--batch-size', type="int",
+                      default=net.DEFAULT_BATCH_SIZE,
+                      help="messages committed at once (default: %s)"
+                           % net.DEFAULT_BATCH_SIZE)
+    parser.add_option('-w', '--window', type="float",
+                      default=net.DEFAULT_BATCH_WINDOW,
+                      help="seconds to wait for more messages (default: %s)"
+                           % net.DEFAULT_BATCH_WINDOW)
+    parser.add_option('-t', '--round-trip', type="float", default=0.5,
+                      help="simulated broker round trip in milliseconds "
+                           "(default: 0.5)")
+    parser.add_option('-c', '--channels', type="int", default=4,
+                      help="channels of the simulated pool (default: 4)")
+    parser.add_option('-H', '--host',
+                      help="host of the RabbitMQ server to use instead "
+                           "of the simulated one")
+    parser.add_option('-P', '--port', type="int", default=5672,
+                      help="port of the RabbitMQ server (default: 5672)")
+    opts, _ = parser.parse_args()
+    log.FluLogKeeper.init()
+    reactor.callWhenRunning(main, opts)
+    reactor.run()
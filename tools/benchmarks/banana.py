@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+'''
+Compares the banana codec with twisted's banana protocol encoding
+and decoding the s-expressions of message-sized objects and of
+big journal snapshots.
+
+Run it through the env script: ./env python tools/benchmarks/banana.py
+'''
+import optparse
+import time
+
+from cStringIO import StringIO
+
+from twisted.spread import banana as twisted_banana
+
+from feat.agents.base import message, recipient
+from feat.common.serialization import banana, sexp
+
+
+class TwistedCodec(object):
+
+    def __init__(self):
+        self._banana = twisted_banana.Banana()
+        self._banana.connectionMade()
+        self._banana._selectDialect("pb")
+
+    def encode(self, lst):
+        io = StringIO()
+        self._banana.transport = io
+        self._banana.sendEncoded(lst)
+        return io.getvalue()
+
+    def decode(self, data):
+        heap = []
+        self._banana.expressionReceived = heap.append
+        try:
+            self._banana.dataReceived(data)
+        finally:
+            self._banana.buffer = ''
+            del self._banana.expressionReceived
+        return heap[0]
+
+
+def generate_message(index):
+    msg = message.Announcement()
+    msg.message_id = 'message-%d' % (index, )
+    msg.protocol_id = 'some-protocol'
+    msg.expiration_time = 1300000000.5 + index
+    msg.traversal_id = 'traversal-%d' % (index, )
+    msg.reply_to = recipient.Agent('agent-%d' % (index, ), 'shard')
+    msg.payload = dict(level=index % 3,
+                       values=[1, 2.5, 'string', u'unicode', None, True],
+                       nested=dict(key=(1, 2, 3), other=['a', 'b', 'c']),
+                       owner=recipient.Agent('owner', 'shard'))
+    return msg
+
+
+def measure(name, function, values, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        for value in values:
+            function(value)
+    elapsed = time.time() - start
+    count = len(values) * repeat
+    print ("%-30s %8d values in %6.2fs: %10.1f values/s"
+           % (name, count, elapsed, count / elapsed))
+
+
+def compare(kind, expressions, repeat):
+    twisted_codec = TwistedCodec()
+    encoded = [banana.encode(x) for x in expressions]
+    measure('%s twisted encode' % kind, twisted_codec.encode,
+            expressions, repeat)
+    measure('%s encode' % kind, banana.encode, expressions, repeat)
+    measure('%s twisted decode' % kind, twisted_codec.decode,
+            encoded, repeat)
+    measure('%s decode' % kind, banana.decode, encoded, repeat)
+
+
+def main(opts):
+    serializer = sexp.Serializer()
+    messages = [serializer.convert(generate_message(x))
+                for x in xrange(opts.count)]
+    compare('message', messages, opts.repeat)
+    snapshots = [[serializer.convert(generate_message(y))
+                  for y in xrange(x, x + 100)]
+                 for x in xrange(max(1, opts.count / 100))]
+    compare('snapshot', snapshots, opts.repeat)
+    data = "".join(banana.encode(x) for x in messages)
+    measure('decode_many', banana.decode_many, [data], opts.repeat)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type="int", default=1000,
+                      help="number of different messages (default: 1000)")
+    parser.add_option('-r', '--repeat', type="int", default=10,
+                      help="number of times each value is converted "
+                           "(default: 10)")
+    opts, _ = parser.parse_args()
+    main(opts)
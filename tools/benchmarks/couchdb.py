@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+'''
+Measures the number of documents per second fetched and saved by the
+CouchDB driver from a local stand-in answering after a fixed latency,
+for different limits of concurrent requests.
+
+Run it through the env script: ./env python tools/benchmarks/couchdb.py
+'''
+import json
+import optparse
+import time
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+from feat.agencies.net import database
+from feat.common import defer, log
+
+
+class CouchDBStandIn(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, latency):
+        resource.Resource.__init__(self)
+        self.latency = latency
+
+    def render(self, request):
+        doc_id = request.path.rsplit("/", 1)[-1]
+        if request.method == "GET":
+            result = {"_id": doc_id, "_rev": "1-%s" % (doc_id, )}
+        else:
+            result = {"ok": True, "id": doc_id, "rev": "2-%s" % (doc_id, )}
+        reactor.callLater(self.latency, self._finish, request, result)
+        return server.NOT_DONE_YET
+
+    def _finish(self, request, result):
+        request.write(json.dumps(result))
+        request.finish()
+
+
+@defer.inlineCallbacks
+def measure(opts, port, connections):
+    db = database.Database("127.0.0.1", port, "benchmark", connections)
+    try:
+        start = time.time()
+        defers = []
+        for i in xrange(opts.count):
+            doc_id = "doc%d" % (i, )
+            if i % 2:
+                defers.append(db.save_doc('{"field": %d}' % (i, ), doc_id))
+            else:
+                defers.append(db.open_doc(doc_id))
+        yield defer.DeferredList(defers, fireOnOneErrback=True)
+        elapsed = time.time() - start
+        print ("%-30s %8d documents in %6.2fs: %10.1f documents/s"
+               % ("%d connections" % (connections, ), opts.count,
+                  elapsed, opts.count / elapsed))
+    finally:
+        db.disconnect()
+
+
+@defer.inlineCallbacks
+def main(opts):
+    site = server.Site(CouchDBStandIn(opts.latency))
+    listener = reactor.listenTCP(0, site, interface="127.0.0.1")
+    try:
+        port = listener.getHost().port
+        for connections in opts.connections:
+            yield measure(opts, port, connections)
+    finally:
+        yield listener.stopListening()
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type="int", default=2000,
+                      help="number of documents fetched or saved "
+                           "(default: 2000)")
+    parser.add_option('-l', '--latency', type="float", default=0.005,
+                      help="seconds the stand-in takes to answer "
+                           "(default: 0.005)")
+    parser.add_option('-c', '--connections', type="int", action="append",
+                      help="limit of concurrent requests, can be repeated "
+                           "(default: 1, 4, 8 and 16)")
+    opts, _ = parser.parse_args()
+    opts.connections = opts.connections or [1, 4, 8, 16]
+    log.FluLogKeeper.init()
+    reactor.callWhenRunning(main, opts)
+    reactor.run()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+'''
+Measures the number of DNS name documents per second read through a
+database connection from a local CouchDB stand-in answering after a fixed
+latency, with and without the document cache of the agency.
+
+Run it through the env script: ./env python tools/benchmarks/dbcache.py
+'''
+import optparse
+import time
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+from feat.agencies.net import database
+from feat.agents.dns import dns_agent
+from feat.common import defer, log
+from feat.common.serialization import json
+
+
+class CouchDBStandIn(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, latency):
+        resource.Resource.__init__(self)
+        self.latency = latency
+
+    def render(self, request):
+        doc_id = unicode(request.path.rsplit("/", 1)[-1])
+        doc = dns_agent.DnsName(doc_id=doc_id, rev=u"1-x", zone=u"test.lan",
+                                name=doc_id + u".test.lan")
+        result = json.serializer_pool.convert(doc)
+        reactor.callLater(self.latency, self._finish, request, result)
+        return server.NOT_DONE_YET
+
+    def _finish(self, request, result):
+        request.write(result)
+        request.finish()
+
+
+@defer.inlineCallbacks
+def measure(opts, port, cache_size):
+    db = database.Database("127.0.0.1", port, "benchmark",
+                           cache_size=cache_size)
+    connection = db.get_connection()
+    try:
+        start = time.time()
+        for _ in xrange(opts.count // opts.documents):
+            yield defer.DeferredList(
+                [connection.get_document(u"dns_%d" % (i, ))
+                 for i in xrange(opts.documents)], fireOnOneErrback=True)
+        elapsed = time.time() - start
+        print ("%-30s %8d documents in %6.2fs: %10.1f documents/s"
+               % ("cache of %d documents" % (cache_size, ), opts.count,
+                  elapsed, opts.count / elapsed))
+    finally:
+        db.disconnect()
+
+
+@defer.inlineCallbacks
+def main(opts):
+    site = server.Site(CouchDBStandIn(opts.latency))
+    listener = reactor.listenTCP(0, site, interface="127.0.0.1")
+    try:
+        port = listener.getHost().port
+        for cache_size in opts.cache_sizes:
+            yield measure(opts, port, cache_size)
+    finally:
+        yield listener.stopListening()
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type="int", default=10000,
+                      help="number of documents read (default: 10000)")
+    parser.add_option('-d', '--documents', type="int", default=100,
+                      help="number of different documents read "
+                           "(default: 100)")
+    parser.add_option('-l', '--latency', type="float", default=0.005,
+                      help="seconds the stand-in takes to answer "
+                           "(default: 0.005)")
+    parser.add_option('-s', '--cache-size', type="int", action="append",
+                      dest="cache_sizes",
+                      help="maximum number of documents cached, can be "
+                           "repeated (default: 0, 50 and 1000)")
+    opts, _ = parser.parse_args()
+    opts.cache_sizes = opts.cache_sizes or [0, 50, 1000]
+    log.FluLogKeeper.init()
+    reactor.callWhenRunning(main, opts)
+    reactor.run()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+'''
+Measures the number of agent descriptors with hundreds of partners
+per second which can be snapshot, serialized and unserialized
+the way the database connection does it.
+
+Run it through the env script: ./env python tools/benchmarks/descriptor.py
+'''
+import optparse
+import time
+
+from feat.agents.base import descriptor, partners, recipient
+from feat.common.serialization import json
+
+
+def generate_descriptor(index, count):
+    desc = descriptor.Descriptor(doc_id='agent-%d' % (index, ),
+                                 rev='1-%032x' % (index, ),
+                                 shard=u'shard', instance_id=index)
+    desc.partners = [partners.BasePartner(recipient.Agent('partner-%d' % x,
+                                                          'shard'),
+                                          allocation_id=x, role=u'role')
+                     for x in xrange(count)]
+    return desc
+
+
+def measure(name, function, values, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        for value in values:
+            function(value)
+    elapsed = time.time() - start
+    count = len(values) * repeat
+    print ("%-32s %8d descriptors in %6.2fs: %10.1f descriptors/s"
+           % (name, count, elapsed, count / elapsed))
+
+
+def main(opts):
+    descriptors = [generate_descriptor(x, opts.partners)
+                   for x in xrange(opts.count)]
+    snapshots = [x.snapshot() for x in descriptors]
+    measure('snapshot', descriptor.Descriptor.snapshot,
+            descriptors * 100, opts.repeat)
+    measure('restore', descriptor.Descriptor.restore,
+            snapshots * 100, opts.repeat)
+    measure('serialize (new serializer)',
+            lambda value: json.Serializer().convert(value),
+            descriptors, opts.repeat)
+    measure('serialize (pooled)', json.serializer_pool.convert,
+            descriptors, opts.repeat)
+    documents = [json.serialize(x) for x in descriptors]
+    measure('unserialize (new unserializer)',
+            lambda data: json.Unserializer().convert(data),
+            documents, opts.repeat)
+    measure('unserialize (pooled)', json.unserializer_pool.convert,
+            documents, opts.repeat)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type="int", default=10,
+                      help="number of different descriptors (default: 10)")
+    parser.add_option('-p', '--partners', type="int", default=300,
+                      help="number of partners of each descriptor "
+                           "(default: 300)")
+    parser.add_option('-r', '--repeat', type="int", default=10,
+                      help="number of times each descriptor is converted "
+                           "(default: 10)")
+    opts, _ = parser.parse_args()
+    main(opts)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+# Headers in this file shall remain intact.
+'''
+Measures the time and the memory needed to remember message identifiers
+the way the messaging channels do, with an ExpDict and with an ExpSet.
+The time is simulated, the identifiers are added at a fixed rate and
+expire after a fixed delay. Each container is measured in its own
+forked process, the memory is the growth of its maximum resident size.
+
+Run it through the env script: ./env python tools/benchmarks/expset.py
+'''
+import optparse
+import os
+import resource
+import time
+import uuid
+
+from zope.interface import implements
+
+from feat.common import container
+from feat.interface.generic import ITimeProvider
+
+
+class SimulatedTime(object):
+
+    implements(ITimeProvider)
+
+    def __init__(self):
+        self.time = 0.0
+
+    def get_time(self):
+        return self.time
+
+
+def fill_dict(clock, keys, opts):
+    result = container.ExpDict(clock)
+    for key in keys:
+        clock.time += 1.0 / opts.rate
+        result.set(key, True, opts.expiration, relative=True)
+    return result
+
+
+def fill_set(clock, keys, opts):
+    result = container.ExpSet(clock)
+    for key in keys:
+        clock.time += 1.0 / opts.rate
+        result.add(key, opts.expiration, relative=True)
+    return result
+
+
+def measure(name, fill, keys, opts):
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    result = fill(SimulatedTime(), keys, opts)
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print ("%-10s %8d keys in %7.2fs, %7d kept, %7.1f MB"
+           % (name, len(keys), elapsed, result.size(),
+              (after - before) / 1024.0))
+    os._exit(0)
+
+
+def main(opts):
+    keys = [str(uuid.uuid1()) for _ in xrange(opts.count)]
+    measure('ExpDict', fill_dict, keys, opts)
+    measure('ExpSet', fill_set, keys, opts)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type="int", default=300000,
+                      help="number of identifiers added (default: 300000)")
+    parser.add_option('-r', '--rate', type="float", default=1000,
+                      help="identifiers added per second (default: 1000)")
+    parser.add_option('-e', '--expiration', type="float", default=600,
+                      help="seconds before an identifier expires "
+                           "(default: 600)")
+    opts, _ = parser.parse_args()
+    main(opts)
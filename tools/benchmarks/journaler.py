@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+'''
+Measures the number of entries per second the journal writer is able
+to store for a journal-heavy and a log-heavy mix of entries.
+
+Run it through the env script: ./env python tools/benchmarks/journaler.py
+'''
+import optparse
+import os
+import tempfile
+
+from twisted.internet import reactor
+
+from feat.agencies import journaler
+from feat.common import defer, log, time
+from feat.common.serialization import banana
+
+
+MIXES = {'journal': 0.9, 'log': 0.1}
+
+
+def generate_entries(count, journal_ratio):
+    serializer = banana.Serializer()
+    journal_id = serializer.convert(('some_id', 1, 0, ))
+    args = serializer.convert((42, 'some string', [1, 2, 3]))
+    kwargs = serializer.convert(dict(key='value', other=1.5))
+    side_effects = serializer.convert([])
+    result = serializer.freeze(dict(status='ok'))
+    now = int(time.time())
+    journal_per_ten = int(journal_ratio * 10)
+
+    entries = []
+    for index in xrange(count):
+        if index % 10 < journal_per_ten:
+            entries.append(dict(entry_type='journal',
+                                agent_id='agent_%d' % (index % 50, ),
+                                instance_id=1,
+                                journal_id=journal_id,
+                                function_id='some.canonical.name',
+                                fiber_id='some fiber id',
+                                fiber_depth=1,
+                                args=args,
+                                kwargs=kwargs,
+                                side_effects=side_effects,
+                                result=result,
+                                timestamp=now))
+        else:
+            entries.append(dict(entry_type='log',
+                                level=4,
+                                log_name='agent_%d' % (index % 50, ),
+                                category='benchmark',
+                                file_path='journaler.py',
+                                line_num=index,
+                                message='Some log message number %d' % index,
+                                timestamp=now))
+    return entries
+
+
+@defer.inlineCallbacks
+def run_mix(name, opts, **writer_opts):
+    fd, filename = tempfile.mkstemp(suffix='_journal.sqlite')
+    os.close(fd)
+    os.remove(filename)
+    try:
+        writer = journaler.SqliteWriter(log.get_default(),
+                                        filename=filename, encoding='zip',
+                                        **writer_opts)
+        yield writer.initiate()
+
+        entries = generate_entries(opts.count, MIXES[name])
+        start = time.time()
+        # the entries come in chunks, like they would from the reactor
+        defers = []
+        for index in xrange(0, len(entries), opts.chunk):
+            chunk = entries[index:index + opts.chunk]
+            defers.append(writer.insert_entries(chunk))
+        yield defer.DeferredList(defers)
+        elapsed = time.time() - start
+        yield writer.close()
+
+        print ("%-8s %-45s %8d entries in %6.2fs: %10.1f entries/s"
+               % (name, describe(writer_opts), opts.count, elapsed,
+                  opts.count / elapsed))
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+
+
+def describe(writer_opts):
+    return ", ".join("%s=%s" % i for i in sorted(writer_opts.items()))
+
+
+@defer.inlineCallbacks
+def main(opts):
+    try:
+        for name in ('journal', 'log'):
+            # sqlite defaults: rollback journal, full sync
+            yield run_mix(name, opts, journal_mode=None, synchronous=None,
+                          flush_size=None)
+            yield run_mix(name, opts, flush_size=opts.flush_size)
+            yield run_mix(name, opts, flush_size=opts.flush_size,
+                          synchronous='off')
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type="int", default=20000,
+                      help="number of entries to write (default: 20000)")
+    parser.add_option('-c', '--chunk', type="int", default=10,
+                      help="number of entries per insert (default: 10)")
+    parser.add_option('-f', '--flush-size', type="int",
+                      default=journaler.DEFAULT_FLUSH_SIZE,
+                      help=("maximum entries per transaction (default: %s)"
+                            % journaler.DEFAULT_FLUSH_SIZE))
+    opts, _ = parser.parse_args()
+    log.set_default(log.VoidLogKeeper())
+    time.call_next(main, opts)
+    reactor.run()
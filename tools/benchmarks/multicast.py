@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+'''
+Measures the number of messages per second posted to many recipients
+and serialized by the outgoing sink like the AMQP backend does.
+
+Run it through the env script: ./env python tools/benchmarks/multicast.py
+'''
+import optparse
+import time
+
+from zope.interface import implements
+
+from feat.agencies.messaging import messaging, routing
+from feat.agents.base import message, recipient
+from feat.common import log
+from feat.common.serialization import banana
+
+
+class Messaging(log.Logger, log.LogProxy):
+    '''Dispatches the messages right away instead of
+    scheduling them like the agency messaging does.'''
+
+    def __init__(self, logger):
+        log.Logger.__init__(self, logger)
+        log.LogProxy.__init__(self, logger)
+        self.routing = routing.Table(self)
+
+    def dispatch(self, message, outgoing=True):
+        self.routing.dispatch(message, outgoing)
+
+
+class Sink(object):
+
+    implements(routing.ISink)
+
+    def __init__(self):
+        self.serializer = banana.Serializer()
+        self.sent = 0
+
+    def on_message(self, message):
+        if hasattr(message, "serialize"):
+            message.serialize(self.serializer)
+        else:
+            self.serializer.convert(message)
+        self.sent += 1
+
+
+def main(opts):
+    log.FluLogKeeper.init()
+    backend = Messaging(log.FluLogKeeper())
+    sink = Sink()
+    backend.routing.set_outgoing_sink(sink)
+    channel = messaging.Channel(backend, None)
+
+    payload = dict(('key%d' % i, {'values': range(10), 'name': u'name%d' % i})
+                   for i in xrange(opts.size))
+    recipients = [recipient.Agent('agent%d' % i, 'shard')
+                  for i in xrange(opts.recipients)]
+
+    start = time.time()
+    for _ in xrange(opts.repeat):
+        channel.post(recipients, message.BaseMessage(payload=payload))
+    elapsed = time.time() - start
+    print ("%-30s %8d messages in %6.2fs: %10.1f messages/s"
+           % ('post to %d recipients' % (opts.recipients, ), sink.sent,
+              elapsed, sink.sent / elapsed))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--recipients', type="int", default=50,
+                      help="number of recipients (default: 50)")
+    parser.add_option('-s', '--size', type="int", default=20,
+                      help="number of entries of the payload (default: 20)")
+    parser.add_option('-r', '--repeat', type="int", default=100,
+                      help="number of messages posted (default: 100)")
+    opts, _ = parser.parse_args()
+    main(opts)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+'''
+Measures the routing table with thousands of routes: the time needed
+to bind them, the number of messages per second dispatched and the time
+needed to bind them when messages are waiting for each of them.
+
+Run it through the env script: ./env python tools/benchmarks/routing.py
+'''
+import optparse
+import time
+
+from zope.interface import implements
+
+from feat.agencies.messaging import routing
+from feat.agents.base import message, recipient
+from feat.common import log
+
+
+class Sink(object):
+
+    implements(routing.ISink)
+
+    def __init__(self):
+        self.received = 0
+
+    def on_message(self, message):
+        self.received += 1
+
+
+def main(opts):
+    log.FluLogKeeper.init()
+    table = routing.Table(log.FluLogKeeper())
+    sinks = [Sink() for _ in xrange(opts.routes / opts.bindings)]
+    keys = [('agent-%d' % (x, ), 'shard') for x in xrange(len(sinks))]
+
+    start = time.time()
+    for sink, key in zip(sinks, keys):
+        table.append_route(routing.Route(sink, key, priority=0, final=True))
+        for index in xrange(1, opts.bindings):
+            interest = ('interest-%d-%d' % (index, hash(key) % 100), 'shard')
+            table.append_route(routing.Route(sink, interest, priority=index,
+                                             final=False))
+    elapsed = time.time() - start
+    count = len(sinks) * opts.bindings
+    print ("%-30s %8d routes in %6.2fs: %10.1f routes/s"
+           % ('append_route', count, elapsed, count / elapsed))
+
+    messages = [message.BaseMessage(recipient=recipient.Agent(*key),
+                                    message_id='message-%d' % (index, ))
+                for index, key in enumerate(keys)]
+    start = time.time()
+    for _ in xrange(opts.repeat):
+        for msg in messages:
+            table.dispatch(msg, outgoing=False)
+    elapsed = time.time() - start
+    count = len(messages) * opts.repeat
+    print ("%-30s %8d messages in %6.2fs: %10.1f messages/s"
+           % ('dispatch', count, elapsed, count / elapsed))
+
+    # messages waiting for the agents which bind later
+    table = routing.Table(log.FluLogKeeper())
+    expiration = time.time() + 3600
+    for sink, key in zip(sinks, keys):
+        table.dispatch(message.BaseMessage(
+            recipient=recipient.Agent(*key), expiration_time=expiration,
+            message_id='late-%s' % (key[0], )), outgoing=False)
+    start = time.time()
+    for sink, key in zip(sinks, keys):
+        table.append_route(routing.Route(sink, key, priority=0, final=True))
+    elapsed = time.time() - start
+    count = len(sinks)
+    print ("%-30s %8d routes in %6.2fs: %10.1f routes/s"
+           % ('late binding', count, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--routes', type="int", default=10000,
+                      help="number of routes (default: 10000)")
+    parser.add_option('-b', '--bindings', type="int", default=3,
+                      help="number of routes of each sink (default: 3)")
+    parser.add_option('-r', '--repeat', type="int", default=3,
+                      help="number of messages dispatched to each sink "
+                           "(default: 3)")
+    opts, _ = parser.parse_args()
+    main(opts)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+'''
+Measures the number of message-sized objects per second the json and
+banana serializers are able to convert, with and without tracking
+the references.
+
+Run it through the env script: ./env python tools/benchmarks/serialization.py
+'''
+import optparse
+import time
+
+from feat.agents.base import message, recipient
+from feat.common.serialization import banana, json
+
+
+def generate_message(index):
+    msg = message.Announcement()
+    msg.message_id = 'message-%d' % (index, )
+    msg.protocol_id = 'some-protocol'
+    msg.expiration_time = 1300000000.5 + index
+    msg.traversal_id = 'traversal-%d' % (index, )
+    msg.reply_to = recipient.Agent('agent-%d' % (index, ), 'shard')
+    msg.payload = dict(level=index % 3,
+                       values=[1, 2.5, 'string', u'unicode', None, True],
+                       nested=dict(key=(1, 2, 3), other=['a', 'b', 'c']),
+                       owner=recipient.Agent('owner', 'shard'))
+    return msg
+
+
+def measure(name, serializer, messages, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        for msg in messages:
+            serializer.convert(msg)
+    elapsed = time.time() - start
+    count = len(messages) * repeat
+    print ("%-30s %8d messages in %6.2fs: %10.1f messages/s"
+           % (name, count, elapsed, count / elapsed))
+
+
+def main(opts):
+    messages = [generate_message(x) for x in xrange(opts.count)]
+    measure('json', json.Serializer(), messages, opts.repeat)
+    measure('json (acyclic)', json.Serializer(acyclic=True),
+            messages, opts.repeat)
+    measure('banana', banana.Serializer(), messages, opts.repeat)
+    measure('banana (acyclic)', banana.Serializer(acyclic=True),
+            messages, opts.repeat)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type="int", default=1000,
+                      help="number of different messages (default: 1000)")
+    parser.add_option('-r', '--repeat', type="int", default=10,
+                      help="number of times each message is serialized "
+                           "(default: 10)")
+    opts, _ = parser.parse_args()
+    main(opts)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+'''
+Measures the number of messages per second posted through the HTTP
+tunnel between two local tunnels, with the messages of a peer posted
+in batches and posted one by one like the peers not supporting them.
+
+Run it through the env script: ./env python tools/benchmarks/tunnel.py
+'''
+import optparse
+import time
+
+from twisted.internet import reactor
+from zope.interface import implements
+
+from feat.agents.base import message
+from feat.common import defer, log
+from feat.web import http, tunnel
+
+
+class Dispatcher(object):
+
+    implements(tunnel.ITunnelDispatcher)
+
+    def dispatch(self, uri, data):
+        pass
+
+
+@defer.inlineCallbacks
+def measure(name, opts, batching):
+    logger = log.FluLogKeeper()
+    ports = range(opts.port, opts.port + 100)
+    source = tunnel.Tunnel(logger, ports, Dispatcher(), "localhost")
+    target = tunnel.Tunnel(logger, ports, Dispatcher(), "localhost")
+    yield source.start_listening()
+    yield target.start_listening()
+    try:
+        url = http.append_location(target.uri, "benchmark")
+        yield source.post(url, message.BaseMessage())
+        source._peers.values()[0]._batching = batching
+
+        start = time.time()
+        defers = [source.post(url, message.BaseMessage(payload=opts.payload))
+                  for _ in xrange(opts.count)]
+        yield defer.DeferredList(defers, fireOnOneErrback=True)
+        elapsed = time.time() - start
+        print ("%-30s %8d messages in %6.2fs: %10.1f messages/s"
+               % (name, opts.count, elapsed, opts.count / elapsed))
+    finally:
+        yield source.stop_listening()
+        yield target.stop_listening()
+        source.disconnect()
+        target.disconnect()
+
+
+@defer.inlineCallbacks
+def main(opts):
+    try:
+        yield measure('one message per request', opts, False)
+        yield measure('batched messages', opts, True)
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type="int", default=2000,
+                      help="number of messages posted (default: 2000)")
+    parser.add_option('-s', '--size', type="int", default=100,
+                      help="size of the message payload (default: 100)")
+    parser.add_option('-p', '--port', type="int", default=5500,
+                      help="first port tried by the tunnels (default: 5500)")
+    opts, _ = parser.parse_args()
+    opts.payload = {'data': 'x' * opts.size}
+    log.FluLogKeeper.init()
+    reactor.callWhenRunning(main, opts)
+    reactor.run()